@@ -0,0 +1,216 @@
+""" chunked and concurrent batch deletes shared by the delete lambda functions """
+import base64
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from botocore.exceptions import ClientError
+from renditions import DERIVATIVE_PREFIXES
+
+# s3 and r2 reject delete_objects calls with more than 1000 keys
+MAX_KEYS_PER_REQUEST = 1000
+MAX_WORKERS = int(os.environ.get("DELETE_MAX_WORKERS", 4))
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.2
+# prefix deletes stop listing once less than this is left of the lambda timeout
+TIME_MARGIN_MS = 10_000
+# every user uploads under `uploads/<timestamp>-<uid>/`, prefix deletes stay inside it
+UPLOADS_ROOT = "uploads"
+# per-key errors that will not go away by retrying
+PERMANENT_ERROR_CODES = {"AccessDenied", "NoSuchBucket",
+                         "AllAccessDisabled", "InvalidObjectState", "MethodNotAllowed"}
+
+
+def delete_keys(s3, bucket: str, keys: List[str], include_derivatives: bool = False,
+                derivatives_bucket: Optional[str] = None) -> Tuple[List[dict], List[dict], dict]:
+    """ Deletes any number of keys, returning `(deleted, errors, derivatives)`.
+
+    `deleted` and `errors` only cover the requested keys, with `include_derivatives` the
+    derivatives of every key are deleted too and reported as `{"deleted", "errors"}`.
+    Keys are split into chunks of at most `MAX_KEYS_PER_REQUEST` that are deleted
+    concurrently; only keys reported in a response's `Errors` are retried.
+    """
+    groups = [(bucket, list(dict.fromkeys(keys)))]
+    if include_derivatives:
+        groups.append((derivatives_bucket or bucket, [prefix + key for key in dict.fromkeys(keys)
+                                                      for prefix in DERIVATIVE_PREFIXES]))
+
+    chunks = [(group, target_bucket, group_keys[i:i + MAX_KEYS_PER_REQUEST])
+              for group, (target_bucket, group_keys) in enumerate(groups)
+              for i in range(0, len(group_keys), MAX_KEYS_PER_REQUEST)]
+
+    results = [([], []) for _ in range(2)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(chunks)))) as pool:
+            for (group, _, _), (chunk_deleted, chunk_errors) in zip(
+                    chunks, pool.map(lambda chunk: _delete_chunk(s3, *chunk[1:]), chunks)):
+                results[group][0].extend(chunk_deleted)
+                results[group][1].extend(chunk_errors)
+    (deleted, errors), (derivatives_deleted, derivatives_errors) = results
+    return deleted, errors, {"deleted": derivatives_deleted, "errors": derivatives_errors}
+
+
+def _delete_chunk(s3, bucket: str, keys: List[str]) -> Tuple[List[dict], List[dict]]:
+    deleted, permanent_errors, errors = [], [], []
+    pending = keys
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(BACKOFF_SECONDS * (2 ** (attempt - 1)))
+        try:
+            response = s3.delete_objects(
+                Bucket=bucket,
+                Delete={"Objects": [{"Key": key} for key in pending]}
+            )
+        except ClientError as e:
+            # the whole request failed (throttled, timed out...), every key is still pending
+            error = e.response.get("Error", {})
+            errors = [{"Key": key, "Code": error.get("Code", "Unknown"), "Message": error.get("Message", str(e))}
+                      for key in pending]
+            if error.get("Code") in PERMANENT_ERROR_CODES:
+                break
+            continue
+
+        deleted += response.get("Deleted", [])
+        errors = []
+        for error in response.get("Errors", []):
+            if error.get("Code") in PERMANENT_ERROR_CODES:
+                permanent_errors.append(error)
+            else:
+                errors.append(error)
+        pending = [error["Key"] for error in errors]
+        if not pending:
+            break
+    return deleted, permanent_errors + errors
+
+
+def is_own_prefix(prefix: str, uid: Optional[str]) -> bool:
+    """ Whether `prefix` is, or is inside, one of the folders the user `uid` uploads to. """
+    parts = prefix.strip("/").split("/")
+    if not uid or len(parts) < 2 or parts[0] != UPLOADS_ROOT or "" in parts or ".." in parts:
+        return False
+    timestamp, _, owner = parts[1].partition("-")
+    return bool(timestamp) and owner == uid
+
+
+def delete_prefix(s3, bucket: str, prefix: str, dry_run: bool = False, orphans_only: bool = False,
+                  derivatives_bucket: Optional[str] = None, continuation_token: Optional[str] = None,
+                  context=None) -> dict:
+    """ Deletes every object under `prefix` along with its derivatives, page by page.
+
+    With `orphans_only` the originals are kept and only derivatives whose original is gone
+    are removed. Deleting a page overlaps with listing the next one, with at most
+    `MAX_WORKERS` pages in flight. When the lambda is about to run out of time, counting the
+    time needed to finish those pages, a `continuationToken` is returned to resume from, it is
+    only accepted again for the same prefix and raises ValueError otherwise.
+    """
+    prefix = prefix.strip("/") + "/"
+    derivatives_bucket = derivatives_bucket or bucket
+    phases = [] if orphans_only else [(bucket, prefix, None)]
+    phases += [(derivatives_bucket, derivative_prefix + prefix, derivative_prefix)
+               for derivative_prefix in DERIVATIVE_PREFIXES]
+    phase, list_token = _decode_token(continuation_token, prefix)
+
+    result = {"matchedCount": 0, "deletedCount": 0, "errors": [],
+              "dryRun": dry_run, "continuationToken": None}
+    pending = deque()
+    # the slowest page delete so far
+    slowest_ms = None
+
+    def collect(future):
+        nonlocal slowest_ms
+        (deleted, errors), elapsed_ms = future.result()
+        slowest_ms = max(slowest_ms or 0, elapsed_ms)
+        result["deletedCount"] += len(deleted)
+        result["errors"] += errors
+
+    with ThreadPoolExecutor(max_workers=max(1, MAX_WORKERS)) as pool:
+        while phase < len(phases):
+            # the pages still in flight are deleted concurrently, finishing them takes about as
+            # long as the slowest page delete, or the margin again until one has finished
+            drain_ms = (TIME_MARGIN_MS if slowest_ms is None else slowest_ms) if pending else 0
+            if _out_of_time(context, TIME_MARGIN_MS + drain_ms):
+                result["continuationToken"] = _encode_token(phase, list_token, prefix)
+                break
+            list_bucket, list_prefix, derivative_prefix = phases[phase]
+            params = {"Bucket": list_bucket,
+                      "Prefix": list_prefix, "MaxKeys": MAX_KEYS_PER_REQUEST}
+            if list_token:
+                params["ContinuationToken"] = list_token
+            page = s3.list_objects_v2(**params)
+
+            keys = [obj["Key"] for obj in page.get("Contents", [])]
+            if derivative_prefix is not None and orphans_only and keys:
+                originals = _existing_keys(
+                    s3, bucket, [key[len(derivative_prefix):] for key in keys])
+                keys = [key for key in keys
+                        if key[len(derivative_prefix):] not in originals]
+            result["matchedCount"] += len(keys)
+            if keys and not dry_run:
+                # deleting this page runs while the next one is being listed
+                pending.append(pool.submit(
+                    _timed_delete_chunk, s3, list_bucket, keys))
+                # listing is faster than deleting, don't queue up every page of a large prefix
+                while len(pending) > MAX_WORKERS:
+                    collect(pending.popleft())
+
+            if page.get("IsTruncated"):
+                list_token = page["NextContinuationToken"]
+            else:
+                phase, list_token = phase + 1, None
+
+        while pending:
+            collect(pending.popleft())
+    return result
+
+
+def _existing_keys(s3, bucket: str, keys: List[str]) -> set:
+    """ Which of `keys` exist, listing the key range instead of one head_object per key. """
+    keys = sorted(keys)
+    common_prefix = os.path.commonprefix(keys)
+    existing = set()
+    params = {"Bucket": bucket, "Prefix": common_prefix,
+              "MaxKeys": MAX_KEYS_PER_REQUEST}
+    if len(keys[0]) > 1:
+        # start right before the first candidate, everything listed earlier cannot match
+        params["StartAfter"] = keys[0][:-1]
+    while True:
+        page = s3.list_objects_v2(**params)
+        listed = [obj["Key"] for obj in page.get("Contents", [])]
+        existing.update(listed)
+        if not page.get("IsTruncated") or not listed or listed[-1] >= keys[-1]:
+            break
+        params.pop("StartAfter", None)
+        params["ContinuationToken"] = page["NextContinuationToken"]
+    return existing.intersection(keys)
+
+
+def _timed_delete_chunk(s3, bucket: str, keys: List[str]) -> Tuple[Tuple[List[dict], List[dict]], float]:
+    start = time.monotonic()
+    return _delete_chunk(s3, bucket, keys), (time.monotonic() - start) * 1000
+
+
+def _out_of_time(context, margin_ms: float = TIME_MARGIN_MS) -> bool:
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return False
+    return context.get_remaining_time_in_millis() < margin_ms
+
+
+def _encode_token(phase: int, list_token: Optional[str], prefix: str) -> str:
+    payload = json.dumps({"phase": phase, "token": list_token, "prefix": prefix})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("utf-8")
+
+
+def _decode_token(token: Optional[str], prefix: str) -> Tuple[int, Optional[str]]:
+    if not token:
+        return 0, None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("utf-8")))
+        phase = int(payload["phase"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("'continuationToken' is not valid") from e
+    # listing tokens of one prefix would otherwise resume a delete somewhere else
+    if payload.get("prefix") != prefix:
+        raise ValueError("'continuationToken' belongs to a different prefix")
+    return phase, payload.get("token")
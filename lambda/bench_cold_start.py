@@ -0,0 +1,79 @@
+""" cold start benchmark reporting import and first-use init time of every handler module """
+
+import json
+import os
+import subprocess
+import sys
+
+# handler module -> statement that performs its lazy first-use initialization
+HANDLER_MODULES = {
+    "uploads": "import r2configs; r2configs.get_s3()",
+    "downloads": "import r2configs; r2configs.get_s3()",
+    "deletes": "import r2configs; r2configs.get_s3()",
+    "s3_upload": "import s3configs; s3configs.get_s3()",
+    "s3_delete": "import s3configs; s3configs.get_s3()",
+    "thumbnail_gen": "import s3configs, image_codecs; s3configs.get_s3(); image_codecs.register_heif()",
+    "flex_thumbnail_gen": "import image_codecs; image_codecs.register_heif()",
+    "verify": "verify.get_app()",
+}
+TOP_IMPORTS = 3
+
+_SNIPPET = """
+import json, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+error = None
+try:
+    {init}
+except Exception as e:
+    error = str(e)
+print(json.dumps({{"import_ms": (imported - started) * 1000,
+                  "init_ms": (time.perf_counter() - imported) * 1000, "init_error": error}}))
+"""
+
+
+def _parse_importtime(stderr: str):
+    """ `(package, cumulative us)` of the top level imports in `-X importtime` output. """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        # nested imports are indented below the package that pulled them in
+        if not package[1:].startswith(" "):
+            imports.append((package.strip(), int(cumulative)))
+    return imports
+
+
+def measure(module: str, init: str) -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+            _SNIPPET.format(module=module, init=init)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"module": module, "error": completed.stderr.strip().splitlines()[-1]}
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    imports = sorted(_parse_importtime(completed.stderr),
+                     key=lambda item: item[1], reverse=True)
+    result["module"] = module
+    result["heaviest_imports"] = [(package, round(us / 1000, 1))
+                                  for package, us in imports[:TOP_IMPORTS]]
+    return result
+
+
+def bench_cold_start():
+    for module, init in HANDLER_MODULES.items():
+        result = measure(module, init)
+        if "error" in result:
+            print(f"{module:<20} failed to import: {result['error']}")
+            continue
+        init_note = f" (init failed: {result['init_error']})" if result["init_error"] else ""
+        heaviest = ", ".join(f"{package} {ms} ms" for package,
+                             ms in result["heaviest_imports"])
+        print(f"{module:<20} import {result['import_ms']:7.1f} ms  "
+              f"init {result['init_ms']:7.1f} ms{init_note}  [{heaviest}]")
+
+
+if __name__ == "__main__":
+    bench_cold_start()
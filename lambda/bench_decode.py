@@ -0,0 +1,78 @@
+""" benchmark for full versus reduced-resolution decoding of large phone photos """
+
+import io
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from image_decode import fit_within, open_for_size
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+    HEIF_SUPPORTED = True
+except ImportError:
+    HEIF_SUPPORTED = False
+
+# 12 MP and 48 MP are the common main-camera resolutions of current phones
+SOURCE_SIZES = {"12MP": (4000, 3000), "48MP": (8000, 6000)}
+TARGET_SIZES = [256, 1024]
+RUNS = 3
+
+
+def _make_source(size, fmt: str) -> bytes:
+    # low frequency noise scaled up compresses like a photo, unlike raw noise
+    small = Image.effect_noise((size[0] // 16, size[1] // 16), 64)
+    image = Image.merge("RGB", (small, small.rotate(90, expand=False), small)).resize(
+        size, Image.Resampling.BICUBIC)
+    buffer = io.BytesIO()
+    if fmt == "HEIF":
+        # phones embed a small preview in HEIC files, which is what reduced decoding can use
+        image.save(buffer, format=fmt, quality=90, thumbnails=[512])
+    else:
+        image.save(buffer, format=fmt, quality=90)
+    return buffer.getvalue()
+
+
+def _decode_full(data: bytes, target: int) -> Image.Image:
+    # what the handlers did before: decode every pixel, then shrink with the same resampler
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return fit_within(image, (target, target))
+
+
+def _decode_reduced(data: bytes, target: int) -> Image.Image:
+    image = open_for_size(io.BytesIO(data), (target, target))
+    return fit_within(image, (target, target))
+
+
+def _measure(variant: str, data: bytes, target: int):
+    # runs in a fresh process so ru_maxrss only reflects this decode
+    decode = _decode_full if variant == "full" else _decode_reduced
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        decode(data, target)
+        timings.append((time.perf_counter() - started) * 1000)
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+               rss_before) / 1024
+    return min(timings), peak_mb
+
+
+def bench_decode():
+    formats = ["JPEG"] + (["HEIF"] if HEIF_SUPPORTED else [])
+    for fmt in formats:
+        for label, size in SOURCE_SIZES.items():
+            data = _make_source(size, fmt)
+            for target in TARGET_SIZES:
+                for variant in ("full", "reduced"):
+                    with ProcessPoolExecutor(max_workers=1) as pool:
+                        elapsed, peak_mb = pool.submit(
+                            _measure, variant, data, target).result()
+                    print(f"{fmt:<5} {label} -> {target:>4}px  {variant:<8} "
+                          f"{elapsed:8.1f} ms  peak +{peak_mb:7.1f} MB")
+
+
+if __name__ == "__main__":
+    bench_decode()
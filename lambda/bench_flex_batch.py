@@ -0,0 +1,72 @@
+""" benchmark of flex_thumbnail_gen throughput, one request per image against batch requests """
+
+import base64
+import io
+import json
+import os
+import time
+from PIL import Image
+import flex_thumbnail_gen
+
+IMAGES = 16
+INPUT_SIZE = (3000, 2000)
+# an album view wants a few sizes of every photo
+OUTPUT_CONFIGS = [
+    {"width": 1024, "height": 1024, "outputImageFileExtension": "webp"},
+    {"width": 512, "height": 512, "outputImageFileExtension": "webp"},
+    {"width": 256, "height": 256, "outputImageFileExtension": "webp"},
+]
+RUNS = 3
+
+
+def _input_images() -> list:
+    images = []
+    for seed in range(IMAGES):
+        small = Image.effect_noise((INPUT_SIZE[0] // 16, INPUT_SIZE[1] // 16), 32 + seed)
+        image = Image.merge("RGB", (small, small.rotate(180), small)).resize(
+            INPUT_SIZE, Image.Resampling.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        images.append(base64.b64encode(buffer.getvalue()).decode("utf-8"))
+    return images
+
+
+def _single(images: list, output_configs: list):
+    for image in images:
+        for config in output_configs:
+            response = flex_thumbnail_gen.lambda_handler(
+                {"body": json.dumps({"inputImage": image, "outputConfigs": config})}, None)
+            assert response["statusCode"] == 200
+
+
+def _batch(images: list, output_configs: list):
+    response = flex_thumbnail_gen.lambda_handler({"body": json.dumps({
+        "inputs": [{"inputImage": image} for image in images],
+        "outputConfigs": output_configs
+    })}, None)
+    assert json.loads(response["body"])["failedCount"] == 0
+
+
+def _best_of(func, *args) -> float:
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def bench_flex_batch():
+    images = _input_images()
+    print(f"{IMAGES} images of {INPUT_SIZE[0]}x{INPUT_SIZE[1]}, "
+          f"{flex_thumbnail_gen.MAX_WORKERS} workers on {os.cpu_count()} cpus")
+    for output_configs in (OUTPUT_CONFIGS[-1:], OUTPUT_CONFIGS):
+        single = _best_of(_single, images, output_configs)
+        batch = _best_of(_batch, images, output_configs)
+        label = f"{len(output_configs)} output(s) per image"
+        print(f"{label:<22} single {IMAGES / single:6.1f} images/s  "
+              f"batch {IMAGES / batch:6.1f} images/s  x{single / batch:.1f}")
+
+
+if __name__ == "__main__":
+    bench_flex_batch()
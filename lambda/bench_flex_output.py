@@ -0,0 +1,75 @@
+""" benchmark of response size and serialisation time across the flex_thumbnail_gen output modes """
+
+import base64
+import io
+import json
+import time
+from PIL import Image
+from local_s3 import LocalS3
+import r2configs
+import flex_thumbnail_gen
+
+OUTPUT_MODES = ["byte_array", "base64", "binary", "objectKey"]
+OUTPUT_SIZE = (1024, 768)
+RUNS = 20
+
+
+def _input_image() -> str:
+    small = Image.effect_noise((OUTPUT_SIZE[0] // 8, OUTPUT_SIZE[1] // 8), 64)
+    image = Image.merge("RGB", (small, small, small)).resize(
+        OUTPUT_SIZE, Image.Resampling.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def _event(input_image: str, mode: str) -> dict:
+    return {"body": json.dumps({
+        "inputImage": input_image,
+        "outputConfigs": {"outputImageDataType": mode, "outputImageFileExtension": "webp",
+                          "width": OUTPUT_SIZE[0], "height": OUTPUT_SIZE[1]}
+    })}
+
+
+def _build_response(mode: str, output_bytes: bytes) -> dict:
+    output_data = {"outputImageFileExtension": "webp",
+                   "outputImageName": "thumbnail.webp"}
+    if mode == "binary":
+        return flex_thumbnail_gen._binary_response(output_bytes, {}, output_data)
+    if mode == "objectKey":
+        output_data["outputObjectKey"] = "gen/flex/thumbnail.webp"
+        output_data["outputImageUrl"] = "https://bucket.example/gen/flex/thumbnail.webp"
+    output_data["outputImage"] = flex_thumbnail_gen._encode_output_data(output_bytes, mode)[1]
+    return flex_thumbnail_gen._response(200, True, {}, output_data=output_data)
+
+
+def bench_output_modes():
+    store = LocalS3()
+    store.create_bucket(Bucket=r2configs.R2_BUCKET_NAME)
+    r2configs.set_s3(store)
+    input_image = _input_image()
+    output_bytes = base64.b64decode(json.loads(flex_thumbnail_gen.lambda_handler(
+        _event(input_image, "base64"), None)["body"])["outputData"]["outputImage"])
+    for mode in OUTPUT_MODES:
+        handler_ms, serialise_ms, payload_ms = [], [], []
+        for _ in range(RUNS):
+            started = time.perf_counter()
+            response = flex_thumbnail_gen.lambda_handler(
+                _event(input_image, mode), None)
+            handler_ms.append((time.perf_counter() - started) * 1000)
+            # what the lambda runtime does with the returned dict
+            started = time.perf_counter()
+            serialised = json.dumps(response)
+            serialise_ms.append((time.perf_counter() - started) * 1000)
+            # building the response from already encoded image bytes, without decode/resize/encode
+            started = time.perf_counter()
+            _build_response(mode, output_bytes)
+            payload_ms.append((time.perf_counter() - started) * 1000)
+        assert response["statusCode"] == 200, response
+        print(f"{mode:<11} response {len(serialised):>9} B  "
+              f"response build {min(payload_ms):6.3f} ms  runtime serialise {min(serialise_ms):6.3f} ms  "
+              f"handler {min(handler_ms):7.2f} ms")
+
+
+if __name__ == "__main__":
+    bench_output_modes()
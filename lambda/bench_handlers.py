@@ -0,0 +1,331 @@
+""" benchmark suite covering every handler against the local s3 stand-in and a mocked verifier
+
+Every case runs in its own process so peak RSS is per case. Results are written as JSON,
+`--compare` checks them against an earlier run and exits non-zero on p50 regressions.
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+# deterministic inputs, the same corpus is generated on every machine and every run
+CORPUS_SIZES = {"1mp": (1152, 864), "4mp": (2304, 1728), "12mp": (4000, 3000)}
+CORPUS_FORMATS = {"jpeg": ("JPEG", "jpg"), "png": ("PNG", "png"), "webp": ("WEBP", "webp"),
+                  "gif": ("GIF", "gif"), "heic": ("HEIF", "heic")}
+CORPUS_SEED = 1234
+BATCH_KEYS = 100
+REQUEST_CASES = ["uploads", "downloads", "downloads:nocache", "s3_upload", "deletes", "s3_delete",
+                 "verify", "verify:nocache"]
+IMAGE_HANDLERS = ["thumbnail_gen", "flex_thumbnail_gen"]
+# the benchmark measures work, not the caches that would skip it
+CHILD_ENV = {"FLEX_RESULT_CACHE_SIZE": "0", "FLEX_RESULT_CACHE_BUCKET": "false",
+             "THUMBNAIL_USE_PROCESSES": "false"}
+
+
+# ----------------- Corpus -------------------
+
+def _corpus_image(size: Tuple[int, int], seed: int):
+    from PIL import Image
+    # seeded low frequency noise scaled up compresses like a photo, gradients add structure
+    rng = random.Random(seed)
+    small = (max(1, size[0] // 16), max(1, size[1] // 16))
+    noise = Image.frombytes("L", small, rng.randbytes(small[0] * small[1])).resize(
+        size, Image.Resampling.BICUBIC)
+    gradient = Image.linear_gradient("L").resize(size)
+    radial = Image.radial_gradient("L").resize(size)
+    return Image.merge("RGB", (noise, gradient, radial))
+
+
+def build_corpus(corpus_dir: str, sizes: List[str]) -> List[str]:
+    """ Writes `<format>-<size>.<ext>` for every corpus entry that is missing, returns their names. """
+    from image_codecs import register_heif
+    os.makedirs(corpus_dir, exist_ok=True)
+    names = []
+    for size_index, size_name in enumerate(sizes):
+        image = None
+        for fmt, (save_format, ext) in CORPUS_FORMATS.items():
+            if fmt == "heic" and not register_heif():
+                continue
+            name = f"{fmt}-{size_name}.{ext}"
+            names.append(name)
+            path = os.path.join(corpus_dir, name)
+            if os.path.exists(path):
+                continue
+            image = image or _corpus_image(CORPUS_SIZES[size_name], CORPUS_SEED + size_index)
+            if fmt == "gif":
+                image.quantize(256).save(path, format=save_format)
+            elif fmt == "png":
+                image.save(path, format=save_format)
+            else:
+                image.save(path, format=save_format, quality=90)
+    return names
+
+
+# ----------------- Cases -------------------
+
+def _bench_client(endpoint_url: Optional[str] = None):
+    # real botocore signing with fixed credentials, presigning needs no network access
+    import boto3
+    from botocore.client import Config
+    return boto3.client("s3", config=Config(signature_version="s3v4"),
+                        aws_access_key_id="bench-access-key",
+                        aws_secret_access_key="bench-secret-key",
+                        endpoint_url=endpoint_url, region_name="us-east-1")
+
+
+def _api_event(body: dict) -> dict:
+    return {"body": json.dumps(body),
+            "requestContext": {"authorizer": {"uid": "bench-user", "email": "bench@example.com"}}}
+
+
+def _presign_case(name: str):
+    import r2configs
+    import s3configs
+    file_names = [f"photo-{i}.jpg" for i in range(BATCH_KEYS)]
+    event = _api_event({"folder": "uploads/bench", "fileNames": file_names})
+    if name == "s3_upload":
+        import s3_upload
+        s3configs.set_s3(_bench_client())
+        handler = s3_upload.upload_handler
+    else:
+        import downloads
+        import uploads
+        r2configs.set_s3(_bench_client(
+            "https://bench-account.r2.cloudflarestorage.com"))
+        handler = uploads.handler if name == "uploads" else downloads.handler
+        if name == "downloads:nocache":
+            from presign import WindowedPresignCache
+            downloads._presign_cache = WindowedPresignCache(
+                0, downloads.PRESIGN_WINDOW_SECONDS, downloads.PRESIGN_MIN_VALIDITY_SECONDS)
+    return None, lambda: handler(event, None), BATCH_KEYS, "urls"
+
+
+def _delete_case(name: str):
+    from local_s3 import LocalS3
+    store = LocalS3()
+    keys = [f"uploads/bench/photo-{i}.jpg" for i in range(BATCH_KEYS)]
+    if name == "deletes":
+        import deletes
+        import r2configs
+        buckets = [r2configs.R2_BUCKET_NAME]
+        r2configs.set_s3(store)
+        event = _api_event({"folder": "uploads/bench", "fileNames": [
+            key.rsplit("/", 1)[1] for key in keys], "includeThumbnails": True})
+        handler = deletes.handler
+    else:
+        import s3_delete
+        import s3configs
+        buckets = [s3configs.S3_BUCKET_NAME, s3configs.S3_BUCKET_NAME_2]
+        s3configs.set_s3(store)
+        event = _api_event({"objectKeys": keys, "includeThumbnails": True})
+        handler = s3_delete.delete_bykeys_handler
+    for bucket in buckets:
+        store.create_bucket(Bucket=bucket)
+
+    def refill():
+        for key in keys:
+            store.put_object(Bucket=buckets[0], Key=key, Body=b"original")
+            store.put_object(Bucket=buckets[-1], Key=f"gen/thumbs/{key}", Body=b"thumb")
+    return refill, lambda: handler(event, None), BATCH_KEYS, "keys"
+
+
+def _verify_case(name: str):
+    from bench_verify import _rs256_verifier, _signing_key, _tokens
+    from bounded_cache import BoundedCache
+    import verify
+    private_key = _signing_key()
+    tokens = _tokens(private_key)
+    verify._verify_with_firebase = _rs256_verifier(private_key.public_key())
+    if name == "verify:nocache":
+        verify._token_cache = BoundedCache(0)
+    calls = iter(range(sys.maxsize))
+
+    def call():
+        token = tokens[next(calls) % len(tokens)]
+        verify.verify_handler({"headers": {"authorization": f"Bearer {token}"}}, None)
+    return None, call, 1, "tokens"
+
+
+def _image_case(name: str, corpus_dir: str):
+    handler_name, corpus_name = name.split(":", 1)
+    with open(os.path.join(corpus_dir, corpus_name), "rb") as file:
+        data = file.read()
+    if handler_name == "flex_thumbnail_gen":
+        import flex_thumbnail_gen
+        event = {"body": json.dumps({
+            "inputImage": base64.b64encode(data).decode("utf-8"),
+            "inputImageName": corpus_name,
+            "outputConfigs": {"width": 512, "height": 512, "outputImageFileExtension": "webp"}
+        })}
+        return None, lambda: flex_thumbnail_gen.lambda_handler(event, None), 1, "images"
+
+    from local_s3 import LocalS3
+    import s3configs
+    import thumbnail_gen
+    store = LocalS3()
+    store.create_bucket(Bucket=s3configs.S3_BUCKET_NAME)
+    store.create_bucket(Bucket=s3configs.S3_BUCKET_NAME_2)
+    store.put_object(Bucket=s3configs.S3_BUCKET_NAME,
+                     Key=f"uploads/bench/{corpus_name}", Body=data)
+    s3configs.set_s3(store)
+    # repeated runs would otherwise find the derivatives up to date and skip them
+    thumbnail_gen.SKIP_UP_TO_DATE = False
+    event = {"Records": [{"s3": {"object": {"key": f"uploads/bench/{corpus_name}"}}}]}
+    return None, lambda: thumbnail_gen.lambda_handler(event, None), 1, "images"
+
+
+def _prepare_case(name: str, corpus_dir: str):
+    if name in ("uploads", "downloads", "downloads:nocache", "s3_upload"):
+        return _presign_case(name)
+    if name in ("deletes", "s3_delete"):
+        return _delete_case(name)
+    if name.startswith("verify"):
+        return _verify_case(name)
+    return _image_case(name, corpus_dir)
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    # nearest rank
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+def run_case(name: str, runs: int, corpus_dir: str) -> dict:
+    """ Runs one case in this process, after one untimed warm-up call. """
+    with contextlib.redirect_stdout(io.StringIO()):
+        before_each, call, units, unit_name = _prepare_case(name, corpus_dir)
+        latencies = []
+        for run in range(runs + 1):
+            if before_each is not None:
+                before_each()
+            started = time.perf_counter()
+            call()
+            if run:
+                latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "case": name,
+        "runs": runs,
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p90_ms": round(_percentile(latencies, 90), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "throughput": round(units * runs / (sum(latencies) / 1000), 1),
+        "throughput_unit": f"{unit_name}/s",
+        "peak_rss_mb": round(_peak_rss_kb() / 1024, 1)
+    }
+
+
+def _peak_rss_kb() -> int:
+    # ru_maxrss survives exec on Linux and would report the parent's peak, VmHWM does not
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # KB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+
+# ----------------- Suite -------------------
+
+def _run_in_child(name: str, runs: int, corpus_dir: str) -> dict:
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", name,
+         "--runs", str(runs), "--corpus-dir", corpus_dir],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+        env={**os.environ, **CHILD_ENV})
+    if completed.returncode != 0:
+        return {"case": name, "error": completed.stderr.strip().splitlines()[-1]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _print_result(result: dict):
+    if "error" in result:
+        print(f"{result['case']:<34} failed: {result['error']}")
+        return
+    print(f"{result['case']:<34} p50 {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  "
+          f"p99 {result['p99_ms']:9.2f} ms  {result['throughput']:10.1f} {result['throughput_unit']:<9} "
+          f"rss {result['peak_rss_mb']:7.1f} MB")
+
+
+def compare(results: List[dict], baseline_path: str, threshold: float) -> int:
+    """ Prints the p50 change of every case against `baseline_path`, returns the regression count. """
+    with open(baseline_path) as file:
+        baseline = {result["case"]: result for result in json.load(file)["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline.get(result["case"])
+        if before is None or "error" in before or "error" in result:
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        regressed = change > threshold
+        regressions += regressed
+        print(f"{result['case']:<34} p50 {before['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms  "
+              f"{change:+7.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def bench_handlers(args) -> int:
+    corpus_dir = args.corpus_dir or os.path.join(tempfile.gettempdir(), "bench_handlers_corpus")
+    sizes = args.sizes.split(",")
+    corpus = build_corpus(corpus_dir, sizes)
+    cases = [(name, args.runs) for name in REQUEST_CASES]
+    cases += [(f"{handler}:{corpus_name}", args.image_runs)
+              for handler in IMAGE_HANDLERS for corpus_name in corpus]
+    if args.only:
+        cases = [(name, runs) for name, runs in cases if args.only in name]
+
+    results = []
+    for name, runs in cases:
+        result = _run_in_child(name, runs, corpus_dir)
+        _print_result(result)
+        results.append(result)
+
+    import PIL
+    with open(args.output, "w") as file:
+        json.dump({
+            "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                     "pillow": PIL.__version__, "cpus": os.cpu_count(),
+                     "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+            "results": results
+        }, file, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=50, help="timed calls per request case")
+    parser.add_argument("--image-runs", type=int, default=5, help="timed calls per image case")
+    parser.add_argument("--sizes", default=",".join(CORPUS_SIZES), help="corpus sizes to run")
+    parser.add_argument("--only", help="only run cases whose name contains this")
+    parser.add_argument("--corpus-dir", help="where the generated corpus is kept between runs")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="p50 slowdown reported as a regression")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.run_case:
+        print(json.dumps(run_case(arguments.run_case, arguments.runs, arguments.corpus_dir)))
+    else:
+        sys.exit(bench_handlers(arguments))
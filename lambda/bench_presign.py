@@ -0,0 +1,66 @@
+""" microbenchmark for batch presigning against the per-key generate_presigned_url loop """
+
+import datetime
+import time
+import boto3
+import botocore.auth
+from botocore.client import Config
+from presign import presign_urls
+
+KEYS = [f"uploads/20250101T000000-some-uid/photo-{i}.jpg" for i in range(500)]
+RUNS = 5
+
+
+def _client():
+    # same shape as the r2configs client, presigning needs no network access
+    return boto3.client("s3", config=Config(signature_version="s3v4"),
+                        aws_access_key_id="bench-access-key",
+                        aws_secret_access_key="bench-secret-key",
+                        endpoint_url="https://bench-account.r2.cloudflarestorage.com",
+                        region_name="apac")
+
+
+def _loop(s3, keys):
+    return [s3.generate_presigned_url("get_object", Params={"Bucket": "bench-bucket", "Key": key},
+                                      ExpiresIn=600) for key in keys]
+
+
+def _batch(s3, keys):
+    return presign_urls(s3, "get_object", "bench-bucket", keys, expires_in=600)
+
+
+def _best_of(func, s3) -> float:
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        func(s3, KEYS)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def check_identical():
+    # freeze botocore's clock so both paths sign with the same timestamp
+    frozen = datetime.datetime(2025, 1, 1, 12, 0, 0)
+    original = botocore.auth.get_current_datetime
+    botocore.auth.get_current_datetime = lambda: frozen
+    try:
+        s3 = _client()
+        identical = _loop(s3, KEYS) == _batch(s3, KEYS)
+    finally:
+        botocore.auth.get_current_datetime = original
+    print(f"byte-identical to botocore: {identical}")
+
+
+def bench_presign():
+    s3 = _client()
+    _loop(s3, KEYS[:10])  # warm up botocore's lazily loaded models
+    loop_time = _best_of(_loop, s3)
+    batch_time = _best_of(_batch, s3)
+    print(f"generate_presigned_url loop  {len(KEYS) / loop_time:10.0f} urls/s")
+    print(f"presign_urls batch           {len(KEYS) / batch_time:10.0f} urls/s  "
+          f"x{loop_time / batch_time:.1f}")
+
+
+if __name__ == "__main__":
+    check_identical()
+    bench_presign()
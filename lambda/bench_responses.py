@@ -0,0 +1,59 @@
+""" benchmark of response bytes and encode time for a large downloads presign batch """
+
+import base64
+import gzip
+import json
+import time
+import r2configs
+import responses
+import downloads
+from bench_handlers import _api_event, _bench_client
+
+BATCH_KEYS = 500
+RUNS = 20
+
+
+def _best_ms(func) -> float:
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def bench_responses():
+    r2configs.set_s3(_bench_client(
+        "https://bench-account.r2.cloudflarestorage.com"))
+    event = _api_event({"folder": "uploads/bench",
+                        "fileNames": [f"photo-{i}.jpg" for i in range(BATCH_KEYS)]})
+    body = json.loads(downloads.handler(event, None)["body"])
+
+    encoders = {
+        # the handlers' previous response bodies
+        "json indent=2": lambda: json.dumps(body, indent=2),
+        "json compact": lambda: json.dumps(body, separators=(",", ":")),
+    }
+    if responses.ORJSON_AVAILABLE:
+        encoders["orjson"] = lambda: responses.dumps(body)
+    for name, encode in encoders.items():
+        print(f"{name:<16} body {len(encode()):>8} B  encode {_best_ms(encode):7.3f} ms")
+
+    for encoding in ["gzip", "br"]:
+        if encoding == "br" and not responses.BROTLI_AVAILABLE:
+            continue
+        event["headers"] = {"Accept-Encoding": encoding}
+        response = downloads.handler(event, None)
+        assert response["headers"].get("Content-Encoding") == encoding, response["headers"]
+        compressed = base64.b64decode(response["body"])
+        if encoding == "gzip":
+            assert json.loads(gzip.decompress(compressed)) == body
+        payload = responses.dumps(body)
+        encode_ms = _best_ms(lambda: responses.negotiate_encoding(
+            {"statusCode": 200, "headers": {}, "body": payload}, event))
+        print(f"{encoding:<16} body {len(compressed):>8} B  encode {encode_ms:7.3f} ms"
+              f"  (base64 on the wire {len(response['body'])} B)")
+
+
+if __name__ == "__main__":
+    bench_responses()
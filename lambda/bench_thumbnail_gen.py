@@ -0,0 +1,56 @@
+""" benchmark for concurrent record processing in the thumbnail_gen lambda function """
+
+import contextlib
+import io
+import time
+from PIL import Image
+from local_s3 import LocalS3
+import s3configs
+import thumbnail_gen
+
+RECORDS = 50
+IMAGE_SIZE = (2000, 1500)
+# simulated round trip per s3 call, roughly what a same-region get/put costs
+S3_LATENCY = 0.05
+WORKER_COUNTS = [1, 2, 4, 8, 16]
+
+
+def _build_store() -> LocalS3:
+    store = LocalS3(latency=S3_LATENCY)
+    store.create_bucket(Bucket=thumbnail_gen.S3_BUCKET_NAME)
+    store.create_bucket(Bucket=thumbnail_gen.S3_BUCKET_NAME_2)
+    buffer = io.BytesIO()
+    Image.effect_noise(IMAGE_SIZE, 40).convert(
+        "RGB").save(buffer, format="JPEG", quality=85)
+    for i in range(RECORDS):
+        store.put_object(Bucket=thumbnail_gen.S3_BUCKET_NAME,
+                         Key=f"uploads/bench/photo-{i}.jpg", Body=buffer.getvalue())
+    return store
+
+
+def _event() -> dict:
+    return {"Records": [{"s3": {"object": {"key": f"uploads/bench/photo-{i}.jpg"}}}
+                        for i in range(RECORDS)]}
+
+
+def bench_workers():
+    store = _build_store()
+    s3configs.set_s3(store)
+    # every run renders the same sources again, measure the work rather than the skip
+    thumbnail_gen.SKIP_UP_TO_DATE = False
+    baseline = None
+    for workers in WORKER_COUNTS:
+        thumbnail_gen.MAX_WORKERS = workers
+        started = time.perf_counter()
+        # keep the per-record log lines out of the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = thumbnail_gen.lambda_handler(_event(), None)
+        elapsed = time.perf_counter() - started
+        throughput = RECORDS / elapsed
+        baseline = baseline or throughput
+        print(f"workers={workers:>2}  {elapsed:6.2f} s  {throughput:6.1f} images/s  "
+              f"x{throughput / baseline:4.1f}  failures={len(result['batchItemFailures'])}")
+
+
+if __name__ == "__main__":
+    bench_workers()
@@ -0,0 +1,65 @@
+""" benchmark of per-call authorizer latency with and without the verified-token cache """
+
+import statistics
+import time
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from bounded_cache import BoundedCache
+import verify
+
+CALLS = 2000
+# the app sends the same ID token for its whole lifetime, spread over a few users
+USERS = 4
+
+
+def _signing_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _tokens(private_key) -> list:
+    now = int(time.time())
+    return [jwt.encode({"uid": f"user-{i}", "sub": f"user-{i}", "email": f"user-{i}@example.com",
+                        "aud": "bench-project", "iat": now, "exp": now + 3600},
+                       private_key, algorithm="RS256") for i in range(USERS)]
+
+
+def _rs256_verifier(public_key):
+    # stands in for firebase_admin: RS256 signature and claim checks on every call
+    def _verify(token: str) -> dict:
+        return jwt.decode(token, public_key, algorithms=["RS256"], audience="bench-project")
+    return _verify
+
+
+def _run(tokens) -> list:
+    latencies = []
+    for i in range(CALLS):
+        event = {"headers": {"authorization": f"Bearer {tokens[i % len(tokens)]}"}}
+        started = time.perf_counter()
+        result = verify.verify_handler(event, None)
+        latencies.append((time.perf_counter() - started) * 1_000_000)
+        assert result["isAuthorized"]
+    return latencies
+
+
+def _report(label: str, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{label:<10} mean {statistics.mean(latencies):8.1f} us  "
+          f"p50 {statistics.median(latencies):8.1f} us  p99 {p99:8.1f} us")
+
+
+def bench_verify():
+    private_key = _signing_key()
+    tokens = _tokens(private_key)
+    verify._verify_with_firebase = _rs256_verifier(private_key.public_key())
+
+    verify._token_cache = BoundedCache(0)
+    _report("no cache", _run(tokens))
+
+    verify._token_cache = BoundedCache(verify.TOKEN_CACHE_MAX_ENTRIES)
+    _report("cache", _run(tokens))
+    print("cache stats:", verify.cache_stats())
+
+
+if __name__ == "__main__":
+    bench_verify()
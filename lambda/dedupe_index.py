@@ -0,0 +1,185 @@
+""" checksum to object key index of uploaded content, kept as sharded json objects under a bucket prefix """
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from botocore.exceptions import ClientError
+from bounded_cache import BoundedCache
+from object_exists import MISSING_OBJECT_CODES, head_objects
+
+# shards live in the bucket they index, next to the other generated objects,
+# thumbnail_gen skips notifications for them
+INDEX_PREFIX = os.environ.get("DEDUPE_INDEX_PREFIX", "gen/index/md5/")
+# keys under these prefixes are never indexed, besides the index itself
+EXCLUDED_PREFIXES = [prefix.strip() for prefix in os.environ.get(
+    "DEDUPE_EXCLUDED_PREFIXES", "gen/").split(",") if prefix.strip()]
+# the first hex characters of a checksum pick its shard, 2 make 256 shards
+SHARD_CHARS = 2
+# shards read by a warm container are reused this long, a stale shard can only
+# cost a duplicate upload since every hit is checked against the object's ETag
+CACHE_SECONDS = int(os.environ.get("DEDUPE_INDEX_CACHE_SECONDS", 60))
+# at most the connection pool of the shared clients (S3_MAX_POOL_CONNECTIONS)
+MAX_WORKERS = int(os.environ.get("DEDUPE_MAX_WORKERS", 16))
+MAX_KEYS_PER_REQUEST = 1000
+# keys handed out for the same content that may still be uploaded, the oldest are dropped first
+MAX_CANDIDATES = 4
+# the lowercase hex MD5 the client computes, which is also the ETag of a single part upload
+CHECKSUM_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_shards = BoundedCache(16 ** SHARD_CHARS * 4)
+
+
+def is_checksum(value) -> bool:
+    return isinstance(value, str) and CHECKSUM_PATTERN.match(value) is not None
+
+
+def parse_checksums(body: dict) -> Optional[List[str]]:
+    """ The request's `checksum` or `checksums`, matching `fileName` or `fileNames`, None if invalid. """
+    if "fileName" in body:
+        checksums = [body.get("checksum")]
+    else:
+        checksums = body.get("checksums")
+        if not isinstance(checksums, list) or len(checksums) != len(body.get("fileNames") or []):
+            return None
+    checksums = [checksum.lower() if isinstance(checksum, str) else checksum for checksum in checksums]
+    return checksums if all(is_checksum(checksum) for checksum in checksums) else None
+
+
+def find_duplicates(s3, bucket: str, checksums: List[Optional[str]],
+                    prefix: str = INDEX_PREFIX) -> List[Optional[dict]]:
+    """ `{"key", "size", "eTag", "lastModified"}` of an object holding each checksum's content, or None.
+
+    Index entries are only trusted once a head_object shows the object exists with an ETag
+    equal to the checksum, entries of deleted, overwritten or never uploaded objects are ignored.
+    """
+    entries = _lookup(s3, bucket, [checksum for checksum in checksums if checksum], prefix)
+    candidates = list(dict.fromkeys(key for keys in entries.values() for key in keys))
+    found = dict(zip(candidates, head_objects(s3, bucket, candidates)))
+    duplicates = []
+    for checksum in checksums:
+        duplicate = None
+        for key in entries.get(checksum, []):
+            obj = found[key]
+            if obj is not None and (obj.get("eTag") or "").strip('"') == checksum:
+                duplicate = {"key": key, **obj}
+                break
+        duplicates.append(duplicate)
+    return duplicates
+
+
+def record(s3, bucket: str, entries: Dict[str, str], prefix: str = INDEX_PREFIX):
+    """ Adds the object key of every checksum in `entries` to its candidates.
+
+    Called when upload urls are handed out, before the objects exist, find_duplicates()
+    ignores a candidate until an upload with that content actually arrived. Shards are read
+    again right before being written, a concurrent writer can still drop an entry, which
+    only costs a duplicate upload and is restored by rebuild_index().
+    """
+    by_shard = {}
+    for checksum, key in entries.items():
+        by_shard.setdefault(_shard(checksum), {})[checksum] = key
+    _for_each_shard(lambda shard: _merge_shard(s3, bucket, prefix, shard, by_shard[shard]), list(by_shard))
+
+
+def rebuild_index(s3, bucket: str, prefix: str = INDEX_PREFIX) -> dict:
+    """ Rewrites the whole index from the ETags of the objects in the bucket.
+
+    The ETag of an object uploaded in a single part is the MD5 of its content, multipart
+    objects have a digest of their parts instead and can't be indexed. Content stored under
+    several keys is indexed under the oldest of them.
+    """
+    oldest = {}
+    scanned = skipped_multipart = 0
+    existing_shards = []
+    params = {"Bucket": bucket, "MaxKeys": MAX_KEYS_PER_REQUEST}
+    while True:
+        page = s3.list_objects_v2(**params)
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.startswith(prefix):
+                existing_shards.append(key)
+                continue
+            if any(key.startswith(excluded) for excluded in EXCLUDED_PREFIXES):
+                continue
+            scanned += 1
+            checksum = obj.get("ETag", "").strip('"')
+            if not is_checksum(checksum):
+                skipped_multipart += 1
+                continue
+            if checksum not in oldest or (obj["LastModified"], key) < oldest[checksum]:
+                oldest[checksum] = (obj["LastModified"], key)
+        if not page.get("IsTruncated"):
+            break
+        params["ContinuationToken"] = page["NextContinuationToken"]
+
+    by_shard = {}
+    for checksum, (_, key) in oldest.items():
+        by_shard.setdefault(_shard(checksum), {})[checksum] = [key]
+    _for_each_shard(lambda shard: _write_shard(s3, bucket, prefix, shard, by_shard[shard]), list(by_shard))
+    stale = [key for key in existing_shards
+             if key[len(prefix):-len(".json")] not in by_shard]
+    for i in range(0, len(stale), MAX_KEYS_PER_REQUEST):
+        s3.delete_objects(Bucket=bucket, Delete={
+            "Objects": [{"Key": key} for key in stale[i:i + MAX_KEYS_PER_REQUEST]], "Quiet": True})
+    for key in stale:
+        _shards.set((bucket, key), {}, time.time() + CACHE_SECONDS)
+    return {"objectsScanned": scanned, "checksumsIndexed": len(oldest),
+            "skippedMultipart": skipped_multipart,
+            "shardsWritten": len(by_shard), "shardsDeleted": len(stale)}
+
+
+def _lookup(s3, bucket: str, checksums: List[str], prefix: str) -> Dict[str, List[str]]:
+    shards = list(dict.fromkeys(_shard(checksum) for checksum in checksums))
+    contents = dict(zip(shards, _for_each_shard(
+        lambda shard: _read_shard(s3, bucket, prefix, shard), shards)))
+    return {checksum: contents[_shard(checksum)][checksum] for checksum in checksums
+            if checksum in contents[_shard(checksum)]}
+
+
+def _merge_shard(s3, bucket: str, prefix: str, shard: str, entries: Dict[str, str]):
+    current = _read_shard(s3, bucket, prefix, shard, fresh=True)
+    merged = dict(current)
+    for checksum, key in entries.items():
+        keys = [candidate for candidate in current.get(checksum, []) if candidate != key] + [key]
+        merged[checksum] = keys[-MAX_CANDIDATES:]
+    if merged != current:
+        _write_shard(s3, bucket, prefix, shard, merged)
+
+
+def _read_shard(s3, bucket: str, prefix: str, shard: str, fresh: bool = False) -> Dict[str, List[str]]:
+    key = _shard_key(prefix, shard)
+    entries = None if fresh else _shards.get((bucket, key))
+    if entries is not None:
+        return entries
+    try:
+        entries = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in MISSING_OBJECT_CODES:
+            raise
+        entries = {}
+    _shards.set((bucket, key), entries, time.time() + CACHE_SECONDS)
+    return entries
+
+
+def _write_shard(s3, bucket: str, prefix: str, shard: str, entries: Dict[str, List[str]]):
+    key = _shard_key(prefix, shard)
+    s3.put_object(Bucket=bucket, Key=key, ContentType="application/json",
+                  Body=json.dumps(entries, separators=(",", ":"), sort_keys=True).encode())
+    _shards.set((bucket, key), entries, time.time() + CACHE_SECONDS)
+
+
+def _for_each_shard(function, shards: List[str]) -> list:
+    if not shards:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(shards)))) as pool:
+        return list(pool.map(function, shards))
+
+
+def _shard(checksum: str) -> str:
+    return checksum[:SHARD_CHARS]
+
+
+def _shard_key(prefix: str, shard: str) -> str:
+    return f"{prefix}{shard}.json"
@@ -1,7 +1,11 @@
-from r2configs import R2_BUCKET_NAME, s3
+from r2configs import R2_BUCKET_NAME, get_s3
+from batch_delete import delete_keys, delete_prefix, is_own_prefix
+from metrics import count, instrumented, record_error, span
+from responses import error_response, json_response
 import json
 
 
+@instrumented("deletes")
 def handler(event, context):
     try:
         # Extract user context
@@ -10,7 +14,10 @@ def handler(event, context):
         uid = authorizer.get('uid')
 
         # Parse input
-        body = json.loads(event["body"])
+        with span("parse"):
+            body = json.loads(event["body"])
+        if "prefix" in body:  # Delete everything under a folder
+            return _delete_prefix(event, body, authorizer, uid, context)
         filenames = body["fileNames"]  # Expecting a list
         folder = body.get("folder", "")
 
@@ -20,27 +27,49 @@ def handler(event, context):
             for filename in filenames
         ]
 
-        # Perform batch delete
-        response = s3.delete_objects(
-            Bucket=R2_BUCKET_NAME,
-            Delete={"Objects": objects_to_delete}
-        )
+        # Perform batch delete, chunked to the 1000 keys per request limit
+        with span("delete"):
+            deleted, errors, derivatives = delete_keys(
+                get_s3(), R2_BUCKET_NAME, [obj["Key"] for obj in objects_to_delete],
+                include_derivatives=body.get("includeThumbnails", False)
+            )
 
+        count("keysDeleted", len(deleted))
         returning_results = {
-            "deleted": response.get("Deleted", []),
-            "errors": response.get("Errors", []),
+            "deleted": deleted,
+            "errors": errors,
             "requestContext": {"authorizer": authorizer}
         }
+        if body.get("includeThumbnails", False):
+            # reported apart, `deleted` only ever lists the requested keys
+            returning_results["deletedDerivatives"] = derivatives["deleted"]
+            returning_results["derivativeErrors"] = derivatives["errors"]
 
-        return {
-            "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps(returning_results, indent=2)
-        }
+        return json_response(200, returning_results, event)
 
     except Exception as e:
-        return {
-            "statusCode": 500,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps({"error": str(e)})
-        }
+        record_error(e)
+        return error_response(500, str(e), event)
+
+
+def _delete_prefix(event, body, authorizer, uid, context):
+    prefix = body["prefix"].strip("/")
+    if not prefix:
+        return error_response(400, "'prefix' must not be empty", event)
+    if not is_own_prefix(prefix, uid):
+        return error_response(403, "'prefix' must be inside one of your upload folders", event)
+
+    try:
+        with span("delete"):
+            returning_results = delete_prefix(
+                get_s3(), R2_BUCKET_NAME, prefix,
+                dry_run=body.get("dryRun", False),
+                orphans_only=body.get("orphansOnly", False),
+                continuation_token=body.get("continuationToken"),
+                context=context
+            )
+    except ValueError as e:
+        return error_response(400, str(e), event)
+    returning_results["requestContext"] = {"authorizer": authorizer}
+
+    return json_response(200, returning_results, event)
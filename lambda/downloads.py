@@ -1,7 +1,28 @@
-from r2configs import R2_BUCKET_NAME, s3
+from r2configs import R2_BUCKET_NAME, get_s3
+from presign import WindowedPresignCache, presign_urls
+from metrics import count, instrumented, record_error, span
+from responses import error_response, json_response
 import json
+import os
 
+# urls are signed at the start of fixed windows so a key keeps its url for a whole window,
+# 0 signs every url at request time as before
+PRESIGN_WINDOW_SECONDS = int(os.environ.get("PRESIGN_WINDOW_SECONDS", 300))
+# remaining validity of every url handed out, however late in its window
+PRESIGN_MIN_VALIDITY_SECONDS = int(os.environ.get("PRESIGN_MIN_VALIDITY_SECONDS", 600))
+PRESIGN_CACHE_SIZE = int(os.environ.get("PRESIGN_CACHE_SIZE", 10000))
 
+_presign_cache = None
+if PRESIGN_WINDOW_SECONDS > 0:
+    _presign_cache = WindowedPresignCache(
+        PRESIGN_CACHE_SIZE, PRESIGN_WINDOW_SECONDS, PRESIGN_MIN_VALIDITY_SECONDS)
+
+
+def presign_cache_stats() -> dict:
+    return _presign_cache.stats() if _presign_cache is not None else {"enabled": False}
+
+
+@instrumented("downloads")
 def handler(event, context):
     try:
         # Get requestContext or empty dict if missing
@@ -9,7 +30,8 @@ def handler(event, context):
         # Get authorizer or empty dict if missing
         authorizer = request_context.get('authorizer', {})
         uid = authorizer.get('uid')  # Get uid or None if missing
-        body = json.loads(event["body"])
+        with span("parse"):
+            body = json.loads(event["body"])
         folder = body.get("folder", "")
 
         filenames = []
@@ -18,38 +40,30 @@ def handler(event, context):
         elif "fileNames" in body:  # Multiple file uploads
             filenames = body["fileNames"]
         else:
-            return {
-                "statusCode": 400,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({"error": "Missing 'fileName' or 'fileNames'"})
-            }
-
-        results = []
-        for filename in filenames:
-            key = f"{folder}/{filename}".strip("/")
-            url = s3.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": R2_BUCKET_NAME,
-                        "Key": key},
-                ExpiresIn=600
-            )
-            results.append({
-                "fileName": filename,
-                "key": key,
-                "url": url
-            })
+            return error_response(400, "Missing 'fileName' or 'fileNames'", event)
+
+        keys = [f"{folder}/{filename}".strip("/") for filename in filenames]
+        with span("presign"):
+            s3 = get_s3()
+            if _presign_cache is not None:
+                hits = _presign_cache.cache.hits
+                urls = _presign_cache.urls(s3, "get_object", R2_BUCKET_NAME, keys)
+                count("presignCacheHits", _presign_cache.cache.hits - hits)
+            else:
+                # signing key and canonical request parts are derived once for the whole batch
+                urls = presign_urls(s3, "get_object", R2_BUCKET_NAME, keys,
+                                    expires_in=PRESIGN_MIN_VALIDITY_SECONDS)
+        count("urls", len(urls))
+        results = [{
+            "fileName": filename,
+            "key": key,
+            "url": url
+        } for filename, key, url in zip(filenames, keys, urls)]
 
         returning_results = {"results": (results if len(results) > 1 else results[0]), "requestContext": {
             "authorizer": authorizer}}
 
-        return {
-            "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps(returning_results, indent=2)
-        }
+        return json_response(200, returning_results, event)
     except Exception as e:
-        return {
-            "statusCode": 500,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps({"error": str(e)})
-        }
+        record_error(e)
+        return error_response(500, str(e), event)
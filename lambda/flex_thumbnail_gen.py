@@ -1,109 +1,420 @@
 """ flex thumbnail generator lambda function """
 import base64
+import hashlib
 import json
 import io
 import os
-from PIL import Image, UnidentifiedImageError
-import imghdr
-from typing import Dict, Any, Optional, Tuple
-
-# HEIC support
-try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-    HEIF_SUPPORTED = True
-except ImportError:
-    HEIF_SUPPORTED = False
-
-SUPPORTED_FORMATS = {"jpeg", "jpg", "png", "webp",
-                     "gif", "heic" if HEIF_SUPPORTED else None}
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps, UnidentifiedImageError
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import quote
+from size_target_encoder import SizeTargetEncoder
+from image_decode import REDUCING_GAP, draft_for_size, fit_size
+from r2configs import R2_BUCKET_NAME, get_s3
+from result_cache import ResultCache, cache_key, digest_source
+from object_exists import MISSING_OBJECT_CODES
+from metrics import count, instrumented, record_error, span
+from placeholder import placeholders
+from responses import json_response, negotiate_encoding
+# HEIC support, pillow_heif is only loaded once a HEIF input shows up
+from image_codecs import AVIF_SUPPORTED, HEIF_SUPPORTED, register_heif
+from image_probe import HEADER_BYTES, ImageProbe, probe_image, sniff_format
+
+SUPPORTED_FORMATS = {"jpeg", "jpg", "png", "webp", "gif",
+                     "heic" if HEIF_SUPPORTED else None, "avif" if AVIF_SUPPORTED else None}
 UNSUPPORTED_FORMATS = {"svg"}
 DEFAULT_MAX_WIDTH = 1920
 DEFAULT_MAX_HEIGHT = 1080
+# `outputImageDataType`s that skip the JSON image payload: the raw image as the HTTP body,
+# or the image written to the bucket with a presigned url to fetch it
+BINARY_OUTPUT = "binary"
+OBJECT_KEY_OUTPUT = "objectKey"
+OUTPUT_KEY_PREFIX = "gen/flex/"
+OUTPUT_URL_EXPIRES_IN = 600
+# `inputObjectKey` originals are streamed from the bucket, spilling to /tmp above this size
+INPUT_SPOOL_MAX_BYTES = int(os.environ.get(
+    "FLEX_INPUT_SPOOL_MAX_BYTES", 32 * 1024 * 1024))
+MAX_INPUT_OBJECT_BYTES = int(os.environ.get(
+    "FLEX_MAX_INPUT_OBJECT_BYTES", 200 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 1024 * 1024
+# the optional ranged probe reads this much, enough to hold the dimensions of most containers
+PROBE_RANGE_BYTES = 64 * 1024
+# batch inputs run concurrently, Pillow releases the GIL while decoding, resizing and encoding
+MAX_WORKERS = int(os.environ.get("FLEX_MAX_WORKERS", os.cpu_count() or 1))
+MAX_BATCH_INPUTS = int(os.environ.get("FLEX_MAX_BATCH_INPUTS", 50))
+# generated outputs keyed on the input bytes and output settings, kept in an LRU of this many
+# entries and, when enabled, under `gen/cache/` in the bucket, which needs the lifecycle rule
+# from result_cache.lifecycle_rule() so the entries expire
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("FLEX_RESULT_CACHE_SIZE", 128))
+# total size of the outputs kept in memory, larger outputs are only cached in the bucket
+RESULT_CACHE_MAX_BYTES = int(os.environ.get(
+    "FLEX_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_BUCKET = os.environ.get(
+    "FLEX_RESULT_CACHE_BUCKET", "false").lower() == "true"
+
+_result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES,
+                            get_s3 if RESULT_CACHE_BUCKET else None, R2_BUCKET_NAME,
+                            max_bytes=RESULT_CACHE_MAX_BYTES)
+
+
+@instrumented("flex_thumbnail_gen")
+def lambda_handler(event, context):
+    """ Generates thumbnails for one input, or for every entry of `inputs` in batch requests.
 
+    A batch input is decoded once for all of its `outputConfigs`, inputs run concurrently
+    and every input and output reports its own status instead of failing the request.
+    """
+    return negotiate_encoding(_handle(event), event)
 
-def lambda_handler(event, context):
+
+def _handle(event):
+    input_object_key = None
+    try:
+        with span("parse"):
+            body = json.loads(event.get("body", "{}"))
+        if "inputs" in body:
+            return _handle_batch(body)
+
+        input_object_key = body.get("inputObjectKey")
+        source, input_image_name, error = _open_input(body)
+        if error is not None:
+            return _response(error[0], False, error=error[1])
+
+        with source:
+            input_metadata, error, outputs = _render(
+                source, input_image_name, [body.get("outputConfigs", {})], input_object_key)
+        if error is not None:
+            return _response(error[0], False, input_metadata, error=error[1])
+
+        output = outputs[0]
+        if output["error"] is not None:
+            return _response(output["statusCode"], False, input_metadata, error=output["error"])
+        if output["outputData"]["outputImageDataType"] == BINARY_OUTPUT:
+            return _binary_response(output["outputBytes"], input_metadata, output["outputData"])
+        return _response(200, True, input_metadata, output_data=output["outputData"])
+
+    except Exception as e:
+        record_error(e)
+        status_code, message = _exception_error(e, input_object_key)
+        return _response(status_code, False, error=message)
+
+
+def _handle_batch(body: dict):
+    inputs = body.get("inputs")
+    if not isinstance(inputs, list) or not inputs:
+        return _response(400, False, error="'inputs' must be a non-empty list.")
+    if len(inputs) > MAX_BATCH_INPUTS:
+        return _response(400, False, error=f"At most {MAX_BATCH_INPUTS} inputs are allowed per request.")
+
+    # inputs without their own outputConfigs use the request level ones
+    default_configs = body.get("outputConfigs", {})
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(inputs)))) as pool:
+        results = list(pool.map(
+            lambda spec: _process_batch_input(spec, default_configs), inputs))
+
+    generated = sum(output["isGenerated"]
+                    for result in results for output in result["outputs"])
+    # an input that failed before producing outputs counts as a single failure
+    outputs_count = sum(len(result["outputs"]) or 1 for result in results)
+    return json_response(200, {
+        "results": results,
+        "generatedCount": generated,
+        "failedCount": outputs_count - generated
+    })
+
+
+def _process_batch_input(spec: dict, default_configs) -> dict:
+    input_object_key = spec.get("inputObjectKey")
+    input_metadata = {}
     try:
-        body = json.loads(event.get("body", "{}"))
-        input_data = body.get("inputImage")
-        input_data_type = body.get("inputImageDataType", "base64")
-        input_encoding = body.get("inputEncoding", "base64")
-        input_image_name = body.get("inputImageName", "image")
-        output_configs = body.get("outputConfigs", {})
-
-        preserve_aspect_ratio = output_configs.get("preserveAspectRatio", True)
-        output_image_data_type = output_configs.get(
-            "outputImageDataType", "base64")
-        output_file_ext = output_configs.get(
-            "outputImageFileExtension", "webp").lower()
-        output_image_name = output_configs.get(
-            "outputImageName", f"thumbnail.{output_file_ext}")
-        image_quality = int(output_configs.get("imageQuality", 70))
-        max_file_size = output_configs.get("maxFileSize", 512)
-        max_file_size_unit = output_configs.get("maxFileSizeUnit", "KB")
-        resize_width = output_configs.get("width", DEFAULT_MAX_WIDTH)
-        resize_height = output_configs.get("height", DEFAULT_MAX_HEIGHT)
-
-        image_bytes = _decode_input_data(input_data, input_data_type)
-        if image_bytes is None:
-            return _response(400, False, error="Unsupported inputImageDataType or corrupted data.")
-
-        detected_ext = _detect_extension(image_bytes, input_image_name)
-        if detected_ext not in SUPPORTED_FORMATS:
-            return _response(415, False, error=f"'{detected_ext}' format is not supported for thumbnail generation.")
-
-        mime_type = f"image/{detected_ext}" if detected_ext != "jpg" else "image/jpeg"
-        size_value, size_unit = _format_file_size(len(image_bytes))
-        input_metadata = {
-            "inputImageName": input_image_name,
-            "detectedInputImageSize": size_value,
-            "detectedInputImageSizeUnit": size_unit,
-            "detectedInputFileExtension": detected_ext,
-            "detectedInputMimeType": mime_type
+        source, input_image_name, error = _open_input(spec)
+        if error is None:
+            output_configs = spec.get("outputConfigs", default_configs)
+            if isinstance(output_configs, dict):
+                output_configs = [output_configs]
+            with source:
+                input_metadata, error, outputs = _render(
+                    source, input_image_name, output_configs, input_object_key, batch=True)
+    except Exception as e:
+        record_error(e)
+        error = _exception_error(e, input_object_key)
+
+    if error is not None:
+        return {"statusCode": error[0], "inputMetadata": input_metadata, "outputs": [],
+                "errorMessage": f"error: {error[1]}"}
+
+    results = []
+    for output in outputs:
+        result = {"statusCode": output["statusCode"], "isGenerated": output["error"] is None,
+                  "outputData": output["outputData"] if output["error"] is None else None}
+        if output["error"] is not None:
+            result["errorMessage"] = f"error: {output['error']}"
+        results.append(result)
+    return {"statusCode": 200, "inputMetadata": input_metadata, "outputs": results}
+
+
+def _exception_error(e: Exception, input_object_key: Optional[str]) -> Tuple[int, str]:
+    if isinstance(e, UnidentifiedImageError):
+        return 400, "Could not identify image file."
+    if isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in MISSING_OBJECT_CODES:
+        return 404, f"'{input_object_key}' does not exist."
+    return 500, f"Internal server error: {str(e)}"
+
+
+def _open_input(spec: dict):
+    """ Returns `(seekable source, input image name, error)` for an inline or bucket input. """
+    input_object_key = spec.get("inputObjectKey")
+    input_image_name = spec.get("inputImageName") or (
+        os.path.basename(input_object_key) if input_object_key else "image")
+
+    if input_object_key:
+        if spec.get("probeInputHeader", False):
+            # reject unsupported or oversized originals before downloading them
+            probe_error = _probe_object(input_object_key, input_image_name)
+            if probe_error is not None:
+                return None, input_image_name, probe_error
+        source, fetch_error = _fetch_object(input_object_key)
+        return source, input_image_name, fetch_error
+
+    with span("decodeInput"):
+        image_bytes = _decode_input_data(spec.get("inputImage"),
+                                         spec.get("inputImageDataType", "base64"))
+    if image_bytes is None:
+        return None, input_image_name, (400, "Unsupported inputImageDataType or corrupted data.")
+    return io.BytesIO(image_bytes), input_image_name, None
+
+
+def _render(source, input_image_name: str, output_configs_list: List[dict],
+            input_object_key: Optional[str] = None, batch: bool = False):
+    """ Decodes the seekable `source` once and generates every entry of `output_configs_list`.
+
+    Returns `(input metadata, input error, outputs)` with outputs in the order of their configs.
+    Outputs found in the result cache skip decoding and encoding, and once every output
+    is cached the probe as well.
+    """
+    header = source.read(HEADER_BYTES)
+    input_size = source.seek(0, io.SEEK_END)
+    source.seek(0)
+    count("bytesIn", input_size)
+
+    detected_ext = _detect_format(header, input_image_name)
+    if detected_ext not in SUPPORTED_FORMATS:
+        return {}, (415, f"'{detected_ext}' format is not supported for thumbnail generation."), []
+    outputs: List[Optional[dict]] = [None] * len(output_configs_list)
+    encoded: Dict[int, Tuple[bytes, dict]] = {}
+    cache_keys: Dict[int, str] = {}
+    # looked up ahead of the probe, which some containers can only answer by reading far into the file
+    with span("cacheLookup"):
+        input_digest = digest_source(source) if _result_cache.enabled else None
+        for index, output_configs in enumerate(output_configs_list):
+            if batch and output_configs.get("outputImageDataType") == BINARY_OUTPUT:
+                outputs[index] = _output_error(
+                    400, f"'{BINARY_OUTPUT}' output is not available in batch requests.")
+            elif input_digest is not None:
+                cache_keys[index] = cache_key(
+                    input_digest, _output_settings(output_configs))
+                cached = _result_cache.get(cache_keys[index])
+                if cached is not None:
+                    encoded[index] = cached
+    count("cacheHits", len(encoded))
+
+    # only outputs missing from the cache need the source probed and decoded at all,
+    # cached results carry what the probe found out about their input
+    pending = [index for index, output in enumerate(outputs)
+               if output is None and index not in encoded]
+    input_probe = next((result["inputProbe"] for _, result in encoded.values()
+                        if "inputProbe" in result), None)
+    probe = None
+    if pending or input_probe is None:
+        # container header only, corrupt inputs and decompression bombs never reach the decoder
+        try:
+            with span("probe"):
+                probe = probe_image(source, detected_ext)
+        except Image.DecompressionBombError as e:
+            return {}, (413, f"Image is too large: {str(e)}."), []
+        except (OSError, SyntaxError, ValueError):
+            return {}, (400, "Could not identify image file."), []
+        input_probe = {
+            "detectedInputWidth": probe.upright_size[0],
+            "detectedInputHeight": probe.upright_size[1],
+            "detectedInputFrameCount": probe.frames,
+            "detectedInputOrientation": probe.orientation
         }
 
-        img = _load_image(image_bytes, detected_ext)
-        if img is None:
-            return _response(400, False, input_metadata, error="Failed to decode the image.")
+    size_value, size_unit = _format_file_size(input_size)
+    input_metadata = {
+        "inputImageName": input_image_name,
+        "detectedInputImageSize": size_value,
+        "detectedInputImageSizeUnit": size_unit,
+        "detectedInputFileExtension": detected_ext,
+        "detectedInputMimeType": _mime_type(detected_ext),
+        **input_probe
+    }
+    if input_object_key:
+        input_metadata["inputObjectKey"] = input_object_key
+
+    if pending:
+        fresh = _encode_outputs(probe, [output_configs_list[index] for index in pending])
+        if fresh is None:
+            return input_metadata, (400, "Failed to decode the image."), []
+        for index, (output_bytes, result) in zip(pending, fresh):
+            result["inputProbe"] = input_probe
+            encoded[index] = (output_bytes, result)
+            if index in cache_keys:
+                with span("cacheStore"):
+                    _result_cache.set(cache_keys[index], output_bytes, result,
+                                      _mime_type(result["outputImageFileExtension"]))
+
+    placeholder = next((result["placeholder"] for _, result in encoded.values()
+                        if "placeholder" in result), None)
+    if placeholder is not None:
+        input_metadata["placeholder"] = placeholder
+    for index, (output_bytes, result) in encoded.items():
+        count("bytesOut", len(output_bytes))
+        with span("package"):
+            outputs[index] = _package_output(output_bytes, result, output_configs_list[index],
+                                             from_cache=index not in pending)
+    return input_metadata, None, outputs
+
+
+def _encode_outputs(probe: ImageProbe, output_configs_list: List[dict]) -> Optional[List[Tuple[bytes, dict]]]:
+    """ Decodes the probed image once and returns `(output bytes, encode result)` for every config.
+
+    Returns None if the image can't be decoded.
+    """
+    boxes = [_output_box(output_configs) for output_configs in output_configs_list]
+    decode_box = (max(box[0] for box, _ in boxes),
+                  max(box[1] for box, _ in boxes))
+    with span("decode"):
+        img = _load_image(probe, decode_box,
+                          all(preserve for _, preserve in boxes))
+    if img is None:
+        return None
 
+    # largest outputs first, so every preserved aspect ratio output is downscaled from the
+    # previous one rather than from the full decoded image
+    order = sorted(range(len(output_configs_list)),
+                   key=lambda index: boxes[index][0][0] * boxes[index][0][1], reverse=True)
+    in_place = len(output_configs_list) == 1
+    encoded: List[Optional[Tuple[bytes, dict]]] = [None] * len(output_configs_list)
+    current = img
+    smallest = None
+    for index in order:
+        box, preserve_aspect_ratio = boxes[index]
+        with span("resize"):
+            if preserve_aspect_ratio:
+                target = fit_size(img.size, box)
+                if target[0] > current.width or target[1] > current.height:
+                    current = img
+                resized = current if in_place else current.copy()
+                resized.thumbnail(box, reducing_gap=REDUCING_GAP)
+                current = resized
+            else:
+                resized = img.resize(box, reducing_gap=REDUCING_GAP)
         if preserve_aspect_ratio:
-            img.thumbnail((resize_width, resize_height))
-        else:
-            img = img.resize((resize_width, resize_height))
-
-        quality = image_quality
-        output_bytes = _compress_image(img, output_file_ext, quality)
-
-        if max_file_size:
-            max_bytes = _convert_size_to_bytes(
-                max_file_size, max_file_size_unit)
-            while len(output_bytes) > max_bytes and quality > 10:
-                quality -= 5
-                output_bytes = _compress_image(img, output_file_ext, quality)
-
-        output_encoding, encoded_output = _encode_output_data(
-            output_bytes, output_image_data_type)
-
-        out_size_value, out_size_unit = _format_file_size(len(output_bytes))
-        output_data = {
-            "outputImage": encoded_output,
-            "outputImageDataType": output_image_data_type,
-            "outputImageFileExtension": output_file_ext,
-            "outputImageName": output_image_name,
-            "imageQuality": quality,
-            "fileSize": out_size_value,
-            "fileSizeUnit": out_size_unit,
-            "width": img.width,
-            "height": img.height,
-            "outputEncoding": output_encoding
-        }
+            smallest = resized
+        encoded[index] = _encode_output(resized, output_configs_list[index])
 
-        return _response(200, True, input_metadata, output_data=output_data)
+    # computed from the smallest undistorted output, kept with every result so cache hits have it
+    with span("placeholder"):
+        placeholder = placeholders(smallest if smallest is not None else img)
+    if placeholder:
+        for _, result in encoded:
+            result["placeholder"] = placeholder
+    return encoded
+
+
+def _output_box(output_configs: dict) -> Tuple[Tuple[int, int], bool]:
+    return ((output_configs.get("width", DEFAULT_MAX_WIDTH),
+             output_configs.get("height", DEFAULT_MAX_HEIGHT)),
+            output_configs.get("preserveAspectRatio", True))
+
+
+def _output_settings(output_configs: dict) -> dict:
+    """ The `outputConfigs` entries that change the encoded bytes, with defaults filled in. """
+    (width, height), preserve_aspect_ratio = _output_box(output_configs)
+    return {
+        "width": width,
+        "height": height,
+        "preserveAspectRatio": preserve_aspect_ratio,
+        "outputImageFileExtension": output_configs.get("outputImageFileExtension", "webp").lower(),
+        "imageQuality": int(output_configs.get("imageQuality", 70)),
+        "maxFileSize": output_configs.get("maxFileSize", 512),
+        "maxFileSizeUnit": output_configs.get("maxFileSizeUnit", "KB").upper()
+    }
+
+
+def _encode_output(img: Image.Image, output_configs: dict) -> Tuple[bytes, dict]:
+    """ Encodes the already resized `img` for one `outputConfigs` entry. """
+    output_file_ext = output_configs.get(
+        "outputImageFileExtension", "webp").lower()
+    image_quality = int(output_configs.get("imageQuality", 70))
+    max_file_size = output_configs.get("maxFileSize", 512)
+    max_file_size_unit = output_configs.get("maxFileSizeUnit", "KB")
+
+    max_bytes = _convert_size_to_bytes(
+        max_file_size, max_file_size_unit) if max_file_size else None
+    encoder = SizeTargetEncoder(img, output_file_ext)
+    with span("encode"):
+        img, quality, output_bytes = encoder.fit(image_quality, max_bytes)
+    return output_bytes, {
+        "outputImageFileExtension": output_file_ext,
+        "imageQuality": quality,
+        "width": img.width,
+        "height": img.height,
+        "encodeAttempts": encoder.attempts
+    }
 
-    except UnidentifiedImageError:
-        return _response(400, False, error="Could not identify image file.")
-    except Exception as e:
-        return _response(500, False, error=f"Internal server error: {str(e)}")
+
+def _package_output(output_bytes: bytes, result: dict, output_configs: dict, from_cache: bool = False) -> dict:
+    """ Wraps encoded bytes into the `outputData` requested by `output_configs`. """
+    output_image_data_type = output_configs.get(
+        "outputImageDataType", "base64")
+    output_file_ext = result["outputImageFileExtension"]
+    output_image_name = output_configs.get(
+        "outputImageName", f"thumbnail.{output_file_ext}")
+
+    output_encoding, encoded_output = _encode_output_data(
+        output_bytes, output_image_data_type)
+
+    out_size_value, out_size_unit = _format_file_size(len(output_bytes))
+    output_data = {
+        "outputImage": encoded_output,
+        "outputImageDataType": output_image_data_type,
+        "outputImageFileExtension": output_file_ext,
+        "outputImageName": output_image_name,
+        "imageQuality": result["imageQuality"],
+        "fileSize": out_size_value,
+        "fileSizeUnit": out_size_unit,
+        "width": result["width"],
+        "height": result["height"],
+        "outputEncoding": output_encoding,
+        "encodeAttempts": result["encodeAttempts"],
+        "fromCache": from_cache
+    }
+
+    if output_image_data_type == OBJECT_KEY_OUTPUT:
+        output_key = _output_object_key(
+            output_configs.get("outputObjectKey"), output_bytes, output_file_ext)
+        if output_key is None:
+            return _output_error(400, f"'outputObjectKey' must be under '{OUTPUT_KEY_PREFIX}'.")
+        output_data["outputObjectKey"] = output_key
+        output_data["outputImageUrl"] = _store_output(
+            output_bytes, output_key, output_file_ext)
+
+    return {"statusCode": 200, "outputData": output_data, "outputBytes": output_bytes, "error": None}
+
+
+def _output_error(status_code: int, error: str) -> dict:
+    return {"statusCode": status_code, "outputData": None, "outputBytes": None, "error": error}
+
+
+def cache_stats() -> dict:
+    """ Hit, miss and eviction counts of the result cache in this container. """
+    return _result_cache.stats()
 
 
 # ----------------- Utilities -------------------
@@ -119,21 +430,26 @@ def _decode_input_data(data, data_type: str) -> Optional[bytes]:
         return None
 
 
-def _detect_extension(image_bytes: bytes, fallback_name: str) -> str:
-    fmt = imghdr.what(None, image_bytes)
+def _detect_format(header: bytes, fallback_name: str) -> str:
+    fmt = sniff_format(header)
+    if fmt == "heic":
+        return "heic" if register_heif() else "heif"
     if fmt:
-        if fmt == "jpeg":
-            return "jpg"
         return fmt
-    ext = os.path.splitext(fallback_name)[-1].lower().replace(".", "")
-    return ext if ext in SUPPORTED_FORMATS else "jpg"
+    # unrecognised content, the name only decides which error is reported
+    return os.path.splitext(fallback_name)[-1].lower().replace(".", "") or "unknown"
 
 
-def _load_image(image_bytes: bytes, ext: str) -> Optional[Image.Image]:
+def _load_image(probe: ImageProbe, size: Optional[Tuple[int, int]] = None,
+                preserve_aspect_ratio: bool = True) -> Optional[Image.Image]:
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        if ext == "gif":
+        # decode only at the resolution needed for `size`, then turn the image upright
+        image = probe.image
+        if size:
+            image = draft_for_size(image, size, preserve_aspect_ratio, probe.orientation)
+        if probe.format == "gif":
             image.seek(0)
+        image = ImageOps.exif_transpose(image)
         if image.mode in ("RGBA", "P"):
             image = image.convert("RGB")
         return image
@@ -141,19 +457,118 @@ def _load_image(image_bytes: bytes, ext: str) -> Optional[Image.Image]:
         return None
 
 
-def _compress_image(image: Image.Image, fmt: str, quality: int) -> bytes:
-    buffer = io.BytesIO()
-    save_format = "JPEG" if fmt == "jpg" else fmt.upper()
-    image.save(buffer, format=save_format, quality=quality)
-    return buffer.getvalue()
+def _probe_object(key: str, input_image_name: str) -> Optional[Tuple[int, str]]:
+    """ Ranged read of the first bytes of `key`, returns `(status code, error)` if it can't be processed. """
+    with span("probeObject"):
+        response = get_s3().get_object(Bucket=R2_BUCKET_NAME, Key=key,
+                                       Range=f"bytes=0-{PROBE_RANGE_BYTES - 1}")
+        header = response["Body"].read()
+    # `bytes 0-65535/<total size>`, or no range at all when the object is smaller than the probe
+    content_range = response.get("ContentRange")
+    object_size = int(content_range.rsplit("/", 1)[1]) if content_range else len(header)
+    if object_size > MAX_INPUT_OBJECT_BYTES:
+        return _too_large_error(key, object_size)
+    detected_ext = _detect_format(header, input_image_name)
+    if detected_ext not in SUPPORTED_FORMATS:
+        return 415, f"'{detected_ext}' format is not supported for thumbnail generation."
+    try:
+        probe_image(io.BytesIO(header), detected_ext)
+    except Image.DecompressionBombError as e:
+        return 413, f"Image is too large: {str(e)}."
+    except Exception:
+        # the dimensions are past the probed range, the full download checks them again
+        pass
+    return None
+
+
+def _fetch_object(key: str):
+    """ Streams `key` from the bucket into a spooled file, kept in memory unless it is large.
+
+    Returns `(source, error)`, objects over MAX_INPUT_OBJECT_BYTES are rejected before any
+    of their body is read.
+    """
+    with span("fetch"):
+        response = get_s3().get_object(Bucket=R2_BUCKET_NAME, Key=key)
+        object_size = response.get("ContentLength")
+        if object_size is not None and object_size > MAX_INPUT_OBJECT_BYTES:
+            response["Body"].close()
+            return None, _too_large_error(key, object_size)
+        source = tempfile.SpooledTemporaryFile(max_size=INPUT_SPOOL_MAX_BYTES)
+        try:
+            shutil.copyfileobj(response["Body"], source, STREAM_CHUNK_SIZE)
+        except Exception:
+            source.close()
+            raise
+    source.seek(0)
+    return source, None
+
+
+def _too_large_error(key: str, object_size: int) -> Tuple[int, str]:
+    size_value, size_unit = _format_file_size(object_size)
+    return 413, f"'{key}' is {size_value} {size_unit}, larger than the input limit."
 
 
 def _encode_output_data(image_bytes: bytes, output_type: str) -> Tuple[str, Any]:
     if output_type == "base64":
         return "base64", base64.b64encode(image_bytes).decode("utf-8")
+    if output_type == BINARY_OUTPUT:
+        return "binary", None
+    if output_type == OBJECT_KEY_OUTPUT:
+        return "object_key", None
     return "byte_array", list(image_bytes)
 
 
+def _output_object_key(requested_key: Optional[str], image_bytes: bytes, ext: str) -> Optional[str]:
+    if requested_key:
+        key = requested_key.strip("/")
+        # never let a generated image overwrite an original upload
+        return key if key.startswith(OUTPUT_KEY_PREFIX) else None
+    # content addressed, the same output always lands on the same key
+    return f"{OUTPUT_KEY_PREFIX}{hashlib.sha256(image_bytes).hexdigest()}.{ext}"
+
+
+def _store_output(image_bytes: bytes, key: str, ext: str) -> str:
+    s3 = get_s3()
+    with span("store"):
+        s3.put_object(Bucket=R2_BUCKET_NAME, Key=key, Body=image_bytes,
+                      ContentType=_mime_type(ext))
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": R2_BUCKET_NAME, "Key": key},
+        ExpiresIn=OUTPUT_URL_EXPIRES_IN
+    )
+
+
+def _binary_response(image_bytes: bytes, input_metadata: dict, output_data: dict):
+    # API Gateway decodes the base64 body back into raw bytes for the client
+    metadata = {"inputMetadata": input_metadata, "outputData": output_data}
+    with span("serialize"):
+        response_body = base64.b64encode(image_bytes).decode("utf-8")
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": _mime_type(output_data["outputImageFileExtension"]),
+            "Content-Disposition": _content_disposition(output_data["outputImageName"]),
+            # header values must stay ASCII, the json encoder escapes everything else
+            "X-Thumbnail-Metadata": json.dumps(metadata, separators=(",", ":"))
+        },
+        "isBase64Encoded": True,
+        "body": response_body
+    }
+
+
+def _content_disposition(file_name: str) -> str:
+    # a plain ASCII fallback for old clients and the exact name as RFC 5987 `filename*`,
+    # quotes, backslashes and control characters never reach the header
+    file_name = "".join(char for char in file_name if char.isprintable()) or "thumbnail"
+    fallback = "".join(char if ord(char) < 0x7f and char not in '"\\' else "_" for char in file_name)
+    return f"inline; filename=\"{fallback}\"; filename*=UTF-8''{quote(file_name, safe='')}"
+
+
+def _mime_type(ext: str) -> str:
+    return "image/jpeg" if ext in ("jpg", "jpeg") else f"image/{ext}"
+
+
 def _format_file_size(num_bytes: int) -> Tuple[float, str]:
     if num_bytes < 1024:
         return num_bytes, "B"
@@ -181,8 +596,4 @@ def _response(status_code: int, is_generated: bool, input_metadata: dict | None
     }
     if error != None:
         payload["errorMessage"] = f"error: {error}"
-    return {
-        "statusCode": status_code,
-        "headers": {"Content-Type": "application/json"},
-        "body": json.dumps(payload)
-    }
+    return json_response(status_code, payload)
@@ -0,0 +1,50 @@
+""" lazily registered image codecs shared by the thumbnail generators """
+import importlib.util
+import threading
+
+# checked without importing, pillow_heif and libheif are only loaded for HEIF inputs
+HEIF_SUPPORTED = importlib.util.find_spec("pillow_heif") is not None
+# ISO BMFF major brands of HEIF/HEIC files, stored right after the `ftyp` box type
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim",
+               b"heis", b"hevm", b"hevs", b"mif1", b"msf1"}
+# AVIF shares the container, Pillow decodes it natively when built with libavif
+AVIF_SUPPORTED = importlib.util.find_spec("PIL._avif") is not None
+AVIF_BRANDS = {b"avif", b"avis"}
+
+_heif_registered = False
+_heif_lock = threading.Lock()
+
+
+def is_heif(header: bytes) -> bool:
+    return header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS
+
+
+def is_avif(header: bytes) -> bool:
+    return header[4:8] == b"ftyp" and header[8:12] in AVIF_BRANDS
+
+
+def register_heif() -> bool:
+    """ Registers the pillow_heif opener once per container, returns whether HEIF can be opened. """
+    global _heif_registered
+    if HEIF_SUPPORTED and not _heif_registered:
+        with _heif_lock:
+            if not _heif_registered:
+                import pillow_heif
+                pillow_heif.register_heif_opener()
+                _heif_registered = True
+    return _heif_registered
+
+
+def ensure_codec(source) -> None:
+    """ Registers whatever lazily loaded codec `source` (bytes, path or file object) needs. """
+    if isinstance(source, (bytes, bytearray)):
+        header = bytes(source[:16])
+    elif hasattr(source, "read"):
+        position = source.tell()
+        header = source.read(16)
+        source.seek(position)
+    else:
+        with open(source, "rb") as file:
+            header = file.read(16)
+    if is_heif(header):
+        register_heif()
@@ -0,0 +1,56 @@
+""" reduced-resolution image decoding shared by the thumbnail generators """
+import math
+from typing import Optional, Tuple
+from PIL import Image
+
+# decode-time and box reductions stop at this multiple of the target size,
+# the final resample from there keeps full LANCZOS/BICUBIC quality
+REDUCING_GAP = 2.0
+EXIF_ORIENTATION_TAG = 0x0112
+# orientations that rotate by 90 degrees, swapping width and height once transposed
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def fit_size(size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int]:
+    """ Largest size with the aspect ratio of `size` that fits `box`, never upscaled. """
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def open_for_size(source, size: Optional[Tuple[int, int]], preserve_aspect_ratio: bool = True) -> Image.Image:
+    """ Opens `source` lazily and asks the decoder for the smallest scale that still covers `size`. """
+    image = Image.open(source)
+    if not size:
+        return image
+    return draft_for_size(image, size, preserve_aspect_ratio)
+
+
+def draft_for_size(image: Image.Image, size: Tuple[int, int], preserve_aspect_ratio: bool = True,
+                   orientation: Optional[int] = None) -> Image.Image:
+    """ Configures the decoder of the not yet loaded `image` to produce as few pixels as `size` allows.
+
+    JPEG sources decode at 1/2, 1/4 or 1/8 scale through `draft()`, HEIF sources use an embedded
+    thumbnail where the installed pillow_heif supports it, other formats decode at full size.
+    `orientation` saves reading the EXIF block again when the caller already probed it.
+    """
+    if orientation is None:
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG)
+    box = size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        # the box applies to the upright image, the decoder sees it before transposing
+        box = (size[1], size[0])
+    target = fit_size(image.size, box) if preserve_aspect_ratio else box
+    if target[0] < image.width or target[1] < image.height:
+        image.draft(None, (math.ceil(target[0] * REDUCING_GAP),
+                           math.ceil(target[1] * REDUCING_GAP)))
+    return image
+
+
+def fit_within(image: Image.Image, box: Tuple[int, int],
+               resample: Image.Resampling = Image.Resampling.LANCZOS) -> Image.Image:
+    """ Returns `image` downscaled to fit `box`, or `image` itself if it already fits. """
+    target = fit_size(image.size, box)
+    if target == image.size:
+        return image
+    return image.resize(target, resample, reducing_gap=REDUCING_GAP)
@@ -0,0 +1,93 @@
+""" header-only image probing, what is known about an input before any of its pixels are decoded """
+import os
+from typing import NamedTuple, Optional, Tuple
+from PIL import Image
+from image_codecs import is_avif, is_heif, register_heif
+from image_decode import EXIF_ORIENTATION_TAG, TRANSPOSED_ORIENTATIONS
+
+# inputs above this many pixels are rejected as decompression bombs before decoding
+MAX_INPUT_PIXELS = int(os.environ.get(
+    "IMAGE_MAX_INPUT_PIXELS", Image.MAX_IMAGE_PIXELS))
+# enough for every signature below
+HEADER_BYTES = 32
+SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+]
+
+
+class ImageProbe(NamedTuple):
+    format: str
+    width: int
+    height: int
+    frames: int
+    orientation: int
+    # opened lazily, decoding starts on the first access to its pixels
+    image: Image.Image
+
+    @property
+    def upright_size(self) -> Tuple[int, int]:
+        """ Size once the EXIF orientation is applied. """
+        if self.orientation in TRANSPOSED_ORIENTATIONS:
+            return self.height, self.width
+        return self.width, self.height
+
+
+def sniff_format(header: bytes) -> Optional[str]:
+    """ Format of an image from its leading magic bytes, None if it isn't recognised. """
+    for signature, fmt in SIGNATURES:
+        if header.startswith(signature):
+            return fmt
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if is_heif(header):
+        return "heic"
+    if is_avif(header):
+        return "avif"
+    if header.lstrip()[:5] in (b"<svg ", b"<svg>", b"<?xml"):
+        return "svg"
+    return None
+
+
+def probe_image(source, fmt: str, max_pixels: int = MAX_INPUT_PIXELS) -> ImageProbe:
+    """ Reads the container header of the seekable `source` sniffed as `fmt`.
+
+    Raises PIL's UnidentifiedImageError (or another OSError) for corrupt headers and
+    DecompressionBombError when the image has more than `max_pixels` pixels.
+    """
+    if fmt == "heic":
+        register_heif()
+    image = Image.open(source)
+    if image.width * image.height > max_pixels:
+        raise Image.DecompressionBombError(
+            f"{image.width}x{image.height} exceeds the limit of {max_pixels} pixels")
+    return ImageProbe(
+        format=fmt,
+        width=image.width,
+        height=image.height,
+        # animated formats count their frames from the container, without decoding them
+        frames=getattr(image, "n_frames", 1),
+        orientation=_header_orientation(image, fmt),
+        image=image
+    )
+
+
+def _header_orientation(image: Image.Image, fmt: str) -> int:
+    # getexif() on a PNG loads the whole image to reach an eXIf chunk after the pixel data,
+    # only one ahead of it is already in `info`, anything else counts as upright
+    if fmt == "png":
+        exif = image.info.get("exif")
+        if not exif:
+            return 1
+        parsed = Image.Exif()
+        parsed.load(exif)
+        return parsed.get(EXIF_ORIENTATION_TAG, 1)
+    if fmt == "gif":
+        return 1
+    # jpeg app1, webp and heif/avif metadata are all read with the header
+    return image.getexif().get(EXIF_ORIENTATION_TAG, 1)
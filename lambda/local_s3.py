@@ -0,0 +1,310 @@
+""" in-process stand-in for the subset of the boto3 s3 client used by the lambda functions """
+import hashlib
+import io
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections.abc import MutableMapping
+from urllib.parse import quote, unquote
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+
+class LocalS3:
+    """ Keeps objects in memory and mimics the boto3 responses the handlers rely on.
+
+    `latency` (seconds) is slept on every call to stand in for the network round trip,
+    which is what makes concurrency visible in local benchmarks.
+    """
+    # s3 rejects a completed multipart upload whose parts, other than the last, are smaller
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._buckets: Dict[str, Dict[str, dict]] = {}
+        # in-progress multipart uploads by upload id, kept in memory even by DirectoryS3
+        self._uploads: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def create_bucket(self, Bucket: str, **kwargs):
+        self._call("create_bucket")
+        with self._lock:
+            self._buckets.setdefault(Bucket, {})
+        return {}
+
+    def put_object(self, Bucket: str, Key: str, Body=b"", ContentType: str = "binary/octet-stream",
+                   Metadata: Optional[dict] = None, **kwargs):
+        self._call("put_object")
+        data = Body.read() if hasattr(Body, "read") else bytes(Body)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self._lock:
+            self._bucket(Bucket)[Key] = {
+                "Body": data,
+                "ContentType": ContentType,
+                "Metadata": dict(Metadata or {}),
+                "ETag": etag,
+                "LastModified": datetime.now(timezone.utc)
+            }
+        return {"ETag": etag}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs: Optional[dict] = None, **kwargs):
+        self.put_object(Bucket=Bucket, Key=Key,
+                        Body=Fileobj.read(), **(ExtraArgs or {}))
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None, **kwargs):
+        self._call("get_object")
+        obj = self._object(Bucket, Key, "GetObject")
+        data = obj["Body"]
+        response = {}
+        if Range:
+            # only the `bytes=<first>-<last>` form the handlers send
+            first, last = Range[len("bytes="):].split("-")
+            first, last = int(first), min(int(last), len(data) - 1)
+            response["ContentRange"] = f"bytes {first}-{last}/{len(data)}"
+            data = data[first:last + 1]
+        return {
+            **response,
+            "Body": StreamingBody(io.BytesIO(data), len(data)),
+            "ContentLength": len(data),
+            "ContentType": obj["ContentType"],
+            "Metadata": dict(obj["Metadata"]),
+            "ETag": obj["ETag"],
+            "LastModified": obj["LastModified"]
+        }
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        self._call("head_object")
+        obj = self._object(Bucket, Key, "HeadObject")
+        return {
+            "ContentLength": len(obj["Body"]),
+            "ContentType": obj["ContentType"],
+            "Metadata": dict(obj["Metadata"]),
+            "ETag": obj["ETag"],
+            "LastModified": obj["LastModified"]
+        }
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs):
+        self._call("delete_objects")
+        objects = Delete.get("Objects", [])
+        if len(objects) > 1000:
+            raise ClientError({"Error": {"Code": "MalformedXML",
+                                         "Message": "The XML you provided was not well-formed"}},
+                              "DeleteObjects")
+        deleted = []
+        with self._lock:
+            bucket = self._bucket(Bucket)
+            for obj in objects:
+                bucket.pop(obj["Key"], None)
+                deleted.append({"Key": obj["Key"]})
+        return {"Deleted": deleted}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", MaxKeys: int = 1000,
+                        ContinuationToken: Optional[str] = None, StartAfter: Optional[str] = None, **kwargs):
+        self._call("list_objects_v2")
+        start = ContinuationToken or StartAfter or ""
+        with self._lock:
+            keys = sorted(key for key in self._bucket(Bucket)
+                          if key.startswith(Prefix) and key > start)
+            page = keys[:MaxKeys]
+            objects = [(key, self._buckets[Bucket][key]) for key in page]
+            contents = [{
+                "Key": key,
+                "Size": len(obj["Body"]),
+                "ETag": obj["ETag"],
+                "LastModified": obj["LastModified"]
+            } for key, obj in objects]
+        response = {"Contents": contents, "KeyCount": len(contents),
+                    "IsTruncated": len(keys) > MaxKeys}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def create_multipart_upload(self, Bucket: str, Key: str, ContentType: str = "binary/octet-stream",
+                                Metadata: Optional[dict] = None, **kwargs):
+        self._call("create_multipart_upload")
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._bucket(Bucket)
+            self._uploads[upload_id] = {
+                "Bucket": Bucket,
+                "Key": Key,
+                "ContentType": ContentType,
+                "Metadata": dict(Metadata or {}),
+                "Initiated": datetime.now(timezone.utc),
+                "Parts": {}
+            }
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body=b"", **kwargs):
+        """ What a client's PUT to a presigned upload_part url does. """
+        self._call("upload_part")
+        data = Body.read() if hasattr(Body, "read") else bytes(Body)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self._lock:
+            # a retried part replaces the earlier attempt
+            self._upload(Bucket, Key, UploadId, "UploadPart")["Parts"][int(PartNumber)] = (etag, data)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict, **kwargs):
+        self._call("complete_multipart_upload")
+        parts = MultipartUpload.get("Parts", [])
+        with self._lock:
+            upload = self._upload(Bucket, Key, UploadId, "CompleteMultipartUpload")
+            if not parts:
+                self._error("MalformedXML", "The XML you provided was not well-formed",
+                            "CompleteMultipartUpload")
+            numbers = [part["PartNumber"] for part in parts]
+            if numbers != sorted(set(numbers)):
+                self._error("InvalidPartOrder", "The list of parts was not in ascending order",
+                            "CompleteMultipartUpload")
+            chunks = []
+            for part in parts:
+                uploaded = upload["Parts"].get(part["PartNumber"])
+                if uploaded is None or uploaded[0] != part["ETag"]:
+                    self._error("InvalidPart", "One or more of the specified parts could not be found",
+                                "CompleteMultipartUpload")
+                chunks.append(uploaded[1])
+            if any(len(chunk) < self.MIN_PART_SIZE for chunk in chunks[:-1]):
+                self._error("EntityTooSmall", "Your proposed upload is smaller than the minimum allowed object size",
+                            "CompleteMultipartUpload")
+            # the etag of a multipart object is the md5 of its parts' md5s, suffixed by the part count
+            digest = hashlib.md5(b"".join(hashlib.md5(chunk).digest() for chunk in chunks))
+            etag = f'"{digest.hexdigest()}-{len(chunks)}"'
+            self._bucket(Bucket)[Key] = {
+                "Body": b"".join(chunks),
+                "ContentType": upload["ContentType"],
+                "Metadata": upload["Metadata"],
+                "ETag": etag,
+                "LastModified": datetime.now(timezone.utc)
+            }
+            del self._uploads[UploadId]
+        return {"Bucket": Bucket, "Key": Key, "ETag": etag,
+                "Location": f"http://localhost/{Bucket}/{quote(Key, safe='/~')}"}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs):
+        self._call("abort_multipart_upload")
+        with self._lock:
+            self._upload(Bucket, Key, UploadId, "AbortMultipartUpload")
+            del self._uploads[UploadId]
+        return {}
+
+    def list_multipart_uploads(self, Bucket: str, Prefix: str = "", MaxUploads: int = 1000,
+                               KeyMarker: Optional[str] = None, UploadIdMarker: Optional[str] = None, **kwargs):
+        self._call("list_multipart_uploads")
+        marker = (KeyMarker or "", UploadIdMarker or "")
+        with self._lock:
+            self._bucket(Bucket)
+            uploads = sorted((upload["Key"], upload_id, upload["Initiated"])
+                             for upload_id, upload in self._uploads.items()
+                             if upload["Bucket"] == Bucket and upload["Key"].startswith(Prefix)
+                             and (upload["Key"], upload_id) > marker)
+        page = uploads[:MaxUploads]
+        response = {"Uploads": [{"Key": key, "UploadId": upload_id, "Initiated": initiated}
+                                for key, upload_id, initiated in page],
+                    "IsTruncated": len(uploads) > MaxUploads}
+        if response["IsTruncated"]:
+            response["NextKeyMarker"], response["NextUploadIdMarker"] = page[-1][:2]
+        return response
+
+    def generate_presigned_url(self, ClientMethod: str, Params: dict, ExpiresIn: int = 3600, HttpMethod: Optional[str] = None):
+        # unsigned, only the shape of a presigned url matters locally
+        extra = "".join(f"&{name}={quote(str(Params[name]), safe='')}"
+                        for name in ("UploadId", "PartNumber") if name in Params)
+        return (f"http://localhost/{Params['Bucket']}/{quote(Params['Key'], safe='/~')}"
+                f"?X-Amz-Expires={ExpiresIn}&X-Local-Method={ClientMethod}{extra}")
+
+    def _call(self, operation: str):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _bucket(self, bucket: str) -> Dict[str, dict]:
+        if bucket not in self._buckets:
+            raise ClientError({"Error": {"Code": "NoSuchBucket", "Message": "The specified bucket does not exist"}},
+                              "Bucket")
+        return self._buckets[bucket]
+
+    def _upload(self, bucket: str, key: str, upload_id: str, operation: str) -> dict:
+        upload = self._uploads.get(upload_id)
+        if upload is None or upload["Bucket"] != bucket or upload["Key"] != key:
+            self._error("NoSuchUpload", "The specified upload does not exist", operation)
+        return upload
+
+    @staticmethod
+    def _error(code: str, message: str, operation: str):
+        raise ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+    def _object(self, bucket: str, key: str, operation: str) -> dict:
+        with self._lock:
+            obj = self._bucket(bucket).get(key)
+        if obj is None:
+            # head requests have no body, so s3 only reports the bare status code
+            code = "404" if operation == "HeadObject" else "NoSuchKey"
+            raise ClientError({"Error": {"Code": code, "Message": "Not Found"}}, operation)
+        return obj
+
+
+class DirectoryS3(LocalS3):
+    """ LocalS3 persisted under `root`, one directory per bucket and one file per object.
+
+    Objects survive across processes, which stands in for the bucket-backed tiers
+    that are meant to outlive a single container.
+    """
+
+    def __init__(self, root: str, latency: float = 0.0):
+        super().__init__(latency)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            self._buckets[name] = _DirectoryBucket(os.path.join(root, name))
+
+    def create_bucket(self, Bucket: str, **kwargs):
+        self._call("create_bucket")
+        with self._lock:
+            if Bucket not in self._buckets:
+                self._buckets[Bucket] = _DirectoryBucket(
+                    os.path.join(self.root, Bucket))
+        return {}
+
+
+class _DirectoryBucket(MutableMapping):
+    """ Maps object keys to pickled object dicts stored in `path`. """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, quote(key, safe=""))
+
+    def __getitem__(self, key: str) -> dict:
+        try:
+            with open(self._file(key), "rb") as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, obj: dict):
+        # write then rename, readers never see a partially written object
+        temp = f"{self._file(key)}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as file:
+            pickle.dump(obj, file)
+        os.replace(temp, self._file(key))
+
+    def __delitem__(self, key: str):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return (unquote(name) for name in os.listdir(self.path) if not name.endswith(".tmp"))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
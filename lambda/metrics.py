@@ -0,0 +1,167 @@
+""" per-invocation phase timings and counters, emitted as one structured log line per invocation
+
+Handlers are wrapped with `instrumented()` and mark their phases with `span()`. Spans from worker
+threads add up into the same phase. With METRICS_ENABLED unset the decorator returns the handler
+unchanged and `span()` hands out a shared no-op context manager.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Optional
+
+ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+# "emf" lines are turned into CloudWatch metrics by Lambda without any API calls,
+# "json" emits the same record as a plain structured log line
+FORMAT = os.environ.get("METRICS_FORMAT", "emf").lower()
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "OurJourneys")
+MAX_ERROR_LENGTH = 256
+
+_cold_start = True
+# Lambda runs one invocation at a time per container
+_current: Optional["_Invocation"] = None
+
+
+class _Invocation:
+    def __init__(self, handler_name: str):
+        self.handler_name = handler_name
+        self.phases = {}
+        self.counters = {}
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add_phase(self, name: str, ms: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def add(self, name: str, value: float):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class _Span:
+    __slots__ = ("invocation", "name", "started")
+
+    def __init__(self, invocation: _Invocation, name: str):
+        self.invocation = invocation
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.invocation.add_phase(
+            self.name, (time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str):
+    """ Context manager timing one phase of the current invocation, e.g. `with span("decode"):`. """
+    invocation = _current
+    return _NOOP_SPAN if invocation is None else _Span(invocation, name)
+
+
+def count(name: str, value: float = 1):
+    """ Adds `value` to a counter of the current invocation, e.g. `count("bytesIn", len(data))`. """
+    invocation = _current
+    if invocation is not None:
+        invocation.add(name, value)
+
+
+def record_error(e: Exception):
+    """ Keeps the type and message of an error the handler turns into a response. """
+    invocation = _current
+    if invocation is not None:
+        invocation.error = e
+
+
+def instrumented(handler_name: str):
+    """ Decorates a Lambda handler to emit one metrics record per invocation. """
+    def decorator(handler):
+        if not ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context=None):
+            global _cold_start, _current
+            invocation = _Invocation(handler_name)
+            cold_start, _cold_start = _cold_start, False
+            _current = invocation
+            started = time.perf_counter()
+            result = None
+            try:
+                result = handler(event, context)
+                return result
+            except Exception as e:
+                invocation.error = e
+                raise
+            finally:
+                _current = None
+                _emit(invocation, event, context, result, cold_start,
+                      (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorator
+
+
+def _emit(invocation: _Invocation, event, context, result: Any, cold_start: bool, duration_ms: float):
+    try:
+        authorizer = (event.get("requestContext") or {}).get("authorizer") or {}
+        uid = authorizer.get("uid")
+        if uid is None and isinstance(result, dict):
+            # the authorizer itself returns the uid it verified in its context
+            uid = (result.get("context") or {}).get("uid")
+        record = {
+            "handler": invocation.handler_name,
+            "requestId": getattr(context, "aws_request_id", None),
+            "uid": uid,
+            "coldStart": int(cold_start),
+            "durationMs": round(duration_ms, 3)
+        }
+        if isinstance(result, dict) and "statusCode" in result:
+            record["statusCode"] = result["statusCode"]
+        if invocation.error is not None:
+            record["errorType"] = type(invocation.error).__name__
+            record["errorMessage"] = str(invocation.error)[:MAX_ERROR_LENGTH]
+        metric_names = ["durationMs", "coldStart"]
+        for name, ms in invocation.phases.items():
+            record[f"{name}Ms"] = round(ms, 3)
+            metric_names.append(f"{name}Ms")
+        record.update(invocation.counters)
+        metric_names.extend(invocation.counters)
+
+        if FORMAT == "emf":
+            record["_aws"] = {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["handler"]],
+                    "Metrics": [{"Name": name, "Unit": _unit(name)} for name in metric_names]
+                }]
+            }
+        print(json.dumps(record, separators=(",", ":"), default=str))
+    except Exception as e:
+        # metrics must never fail the invocation they describe
+        print(f"metrics: failed to emit: {str(e)}")
+
+
+def _unit(name: str) -> str:
+    if name.endswith("Ms"):
+        return "Milliseconds"
+    if name.startswith("bytes"):
+        return "Bytes"
+    return "Count"
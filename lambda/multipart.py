@@ -0,0 +1,173 @@
+""" presigned multipart uploads, large files go straight to the bucket in individually retried parts
+
+A client creates the upload and gets one presigned upload_part url per part, PUTs the parts in
+any order and in parallel (a failed part is simply PUT again), then completes the upload with
+the ETag response header of every part. Browsers can only read that header when the bucket's
+CORS rules expose `ETag`. Uploads that are never completed keep their parts billed until they
+are aborted, by the client or by the stale upload sweep.
+"""
+import json
+import math
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Tuple
+from botocore.exceptions import ClientError
+from presign import presign_part_urls
+from metrics import count, record_error, span
+from responses import error_response, json_response
+
+# s3 and r2 reject parts smaller than this, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = int(os.environ.get(
+    "MULTIPART_PART_SIZE", 8 * 1024 * 1024))
+# long enough for a large video on a slow mobile link
+PART_URL_EXPIRES = int(os.environ.get("MULTIPART_URL_EXPIRES", 3600))
+STALE_UPLOAD_SECONDS = int(os.environ.get(
+    "MULTIPART_STALE_SECONDS", 24 * 60 * 60))
+# errors caused by the parts a client sent, not by the service
+INVALID_PART_CODES = {"InvalidPart", "InvalidPartOrder", "EntityTooSmall", "MalformedXML"}
+
+
+def plan_parts(file_size: int, part_size: int = DEFAULT_PART_SIZE) -> List[Tuple[int, int, int]]:
+    """ `(part number, offset, size)` of every part of a `file_size` byte file.
+
+    All parts but the last have the same size, which r2 requires. The size is clamped to the
+    service limits and grown when the file would otherwise need more than MAX_PARTS parts.
+    """
+    if not isinstance(file_size, int) or isinstance(file_size, bool) or file_size <= 0:
+        raise ValueError("'fileSize' must be a positive number of bytes")
+    if file_size > MAX_PART_SIZE * MAX_PARTS:
+        raise ValueError(f"'fileSize' exceeds {MAX_PART_SIZE * MAX_PARTS} bytes")
+    part_size = min(max(int(part_size), MIN_PART_SIZE), MAX_PART_SIZE)
+    part_size = max(part_size, math.ceil(file_size / MAX_PARTS))
+    return [(number + 1, offset, min(part_size, file_size - offset))
+            for number, offset in enumerate(range(0, file_size, part_size))]
+
+
+def create_upload(s3, bucket: str, key: str, file_size: int, part_size: int = DEFAULT_PART_SIZE,
+                  content_type: str = "binary/octet-stream", expires_in: int = PART_URL_EXPIRES) -> dict:
+    """ Starts a multipart upload of `key` and presigns the upload_part url of every part. """
+    parts = plan_parts(file_size, part_size)
+    upload_id = s3.create_multipart_upload(
+        Bucket=bucket, Key=key, ContentType=content_type)["UploadId"]
+    # one probe presign for the whole upload, the part urls are signed locally
+    urls = presign_part_urls(s3, bucket, key, upload_id,
+                             [number for number, _, _ in parts], expires_in)
+    return {
+        "key": key,
+        "uploadId": upload_id,
+        "partSize": parts[0][2],
+        "partCount": len(parts),
+        "expiresIn": expires_in,
+        "parts": [{"partNumber": number, "offset": offset, "size": size, "url": url}
+                  for (number, offset, size), url in zip(parts, urls)]
+    }
+
+
+def complete_upload(s3, bucket: str, key: str, upload_id: str, parts: List[dict]) -> dict:
+    """ Assembles the object from `parts`, `{"partNumber", "eTag"}` as the client PUT them. """
+    if not isinstance(parts, list) or not parts:
+        raise ValueError("'parts' must list the partNumber and eTag of every part")
+    by_number = {}
+    for part in parts:
+        if not isinstance(part, dict) or not isinstance(part.get("partNumber"), int) \
+                or not isinstance(part.get("eTag"), str):
+            raise ValueError("every part needs an integer 'partNumber' and a string 'eTag'")
+        if part["partNumber"] in by_number:
+            raise ValueError(f"part {part['partNumber']} is listed twice")
+        by_number[part["partNumber"]] = part["eTag"]
+    response = s3.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id,
+        # the service wants them in ascending order, clients finish them in any order
+        MultipartUpload={"Parts": [{"PartNumber": number, "ETag": by_number[number]}
+                                   for number in sorted(by_number)]})
+    return {"key": key, "uploadId": upload_id, "eTag": response.get("ETag"),
+            "partCount": len(by_number)}
+
+
+def abort_upload(s3, bucket: str, key: str, upload_id: str) -> dict:
+    s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    return {"key": key, "uploadId": upload_id, "aborted": True}
+
+
+def abort_stale_uploads(s3, bucket: str, prefix: str = "",
+                        max_age_seconds: int = STALE_UPLOAD_SECONDS) -> List[dict]:
+    """ Aborts every upload under `prefix` started more than `max_age_seconds` ago. """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)
+    aborted = []
+    markers = {}
+    while True:
+        page = s3.list_multipart_uploads(Bucket=bucket, Prefix=prefix, **markers)
+        for upload in page.get("Uploads", []):
+            if upload["Initiated"] > cutoff:
+                continue
+            try:
+                s3.abort_multipart_upload(
+                    Bucket=bucket, Key=upload["Key"], UploadId=upload["UploadId"])
+            except ClientError as e:
+                # completed or aborted by its client in the meantime
+                if e.response.get("Error", {}).get("Code") != "NoSuchUpload":
+                    raise
+                continue
+            aborted.append({"key": upload["Key"], "uploadId": upload["UploadId"]})
+        if not page.get("IsTruncated"):
+            return aborted
+        markers = {"KeyMarker": page["NextKeyMarker"],
+                   "UploadIdMarker": page["NextUploadIdMarker"]}
+
+
+def handle_request(operation: str, event, get_client: Callable, bucket: str) -> dict:
+    """ Runs the "create", "complete" or "abort" operation of an API Gateway `event`.
+
+    An abort event without a body, as sent by a schedule, sweeps stale uploads from the whole bucket.
+    """
+    try:
+        authorizer = event.get('requestContext', {}).get('authorizer', {})
+        if operation == "abort" and event.get("body") is None:
+            with span("abort"):
+                aborted = abort_stale_uploads(get_client(), bucket)
+            count("uploadsAborted", len(aborted))
+            print(f"Aborted {len(aborted)} stale multipart uploads")
+            return json_response(200, {"aborted": aborted}, event)
+
+        with span("parse"):
+            body = json.loads(event["body"])
+        with span(operation):
+            result = _run(operation, body, get_client(), bucket)
+        return json_response(200, {**result, "requestContext": {"authorizer": authorizer}}, event)
+    except ValueError as e:
+        record_error(e)
+        return error_response(400, str(e), event)
+    except ClientError as e:
+        record_error(e)
+        code = e.response.get("Error", {}).get("Code")
+        if code == "NoSuchUpload":
+            return error_response(404, "The multipart upload does not exist, it was completed or aborted", event)
+        if code in INVALID_PART_CODES:
+            return error_response(400, str(e), event)
+        return error_response(500, str(e), event)
+    except Exception as e:
+        record_error(e)
+        return error_response(500, str(e), event)
+
+
+def _run(operation: str, body: dict, s3, bucket: str) -> dict:
+    if operation == "create":
+        if "fileName" not in body or "fileSize" not in body:
+            raise ValueError("Missing 'fileName' or 'fileSize'")
+        key = f"{body.get('folder', '')}/{body['fileName']}".strip("/")
+        result = create_upload(s3, bucket, key, body["fileSize"],
+                               body.get("partSize") or DEFAULT_PART_SIZE,
+                               body.get("contentType") or "binary/octet-stream")
+        count("urls", result["partCount"])
+        return {"fileName": body["fileName"], **result}
+
+    if "key" not in body or "uploadId" not in body:
+        raise ValueError("Missing 'key' or 'uploadId'")
+    if operation == "complete":
+        return complete_upload(s3, bucket, body["key"], body["uploadId"], body.get("parts"))
+    if operation == "abort":
+        return abort_upload(s3, bucket, body["key"], body["uploadId"])
+    raise ValueError(f"Unknown multipart operation '{operation}'")
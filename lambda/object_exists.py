@@ -0,0 +1,41 @@
+""" concurrent head_object checks shared by the upload presign lambda functions """
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from botocore.exceptions import ClientError
+
+# at most the connection pool of the shared clients (S3_MAX_POOL_CONNECTIONS)
+MAX_WORKERS = int(os.environ.get("EXISTS_MAX_WORKERS", 16))
+# error codes of a missing object, head requests only report the bare status code
+MISSING_OBJECT_CODES = {"NoSuchKey", "404"}
+
+
+def head_objects(s3, bucket: str, keys: List[str]) -> List[Optional[dict]]:
+    """ `{"size", "eTag", "lastModified"}` of every key that exists, None for the others.
+
+    Keys are checked concurrently with at most MAX_WORKERS requests in flight. A key whose
+    check fails for another reason than a missing object also comes back None, so it is
+    uploaded again rather than wrongly skipped.
+    """
+    unique_keys = list(dict.fromkeys(keys))
+    if not unique_keys:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(unique_keys)))) as pool:
+        found = dict(zip(unique_keys, pool.map(
+            lambda key: _head_object(s3, bucket, key), unique_keys)))
+    return [found[key] for key in keys]
+
+
+def _head_object(s3, bucket: str, key: str) -> Optional[dict]:
+    try:
+        response = s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code not in MISSING_OBJECT_CODES:
+            print(f"Existence check of {key} failed: {str(e)}")
+        return None
+    return {
+        "size": response.get("ContentLength"),
+        "eTag": response.get("ETag"),
+        "lastModified": response["LastModified"].isoformat() if response.get("LastModified") else None
+    }
@@ -0,0 +1,94 @@
+""" tiny placeholders of an image, shown by the client before the image itself has arrived """
+import base64
+import importlib.util
+import io
+import os
+from typing import Tuple
+from PIL import Image
+
+# blurhash needs numpy, without it only the webp placeholder is produced
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+# comma separated, any of "lqip" and "blurhash", empty disables placeholders
+PLACEHOLDERS = {name.strip() for name in os.environ.get(
+    "PLACEHOLDERS", "lqip,blurhash").split(",") if name.strip()}
+LQIP_SIZE = int(os.environ.get("PLACEHOLDER_LQIP_SIZE", 16))
+LQIP_QUALITY = 40
+# placeholders travel as object metadata, which s3 limits to 2 KB per object
+MAX_LQIP_LENGTH = 1024
+BLURHASH_COMPONENTS = (4, 3)
+# blurhash only keeps the lowest frequencies, a few dozen pixels carry all of them
+BLURHASH_SAMPLE_SIZE = 32
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def placeholders(image: Image.Image) -> dict:
+    """ `{"lqip", "blurhash"}` of an upright image, whichever are enabled and available.
+
+    Meant to be given the smallest image already at hand, such as the smallest rendition.
+    """
+    result = {}
+    if "lqip" in PLACEHOLDERS:
+        data_uri = lqip(image)
+        if len(data_uri) <= MAX_LQIP_LENGTH:
+            result["lqip"] = data_uri
+    if "blurhash" in PLACEHOLDERS and NUMPY_AVAILABLE:
+        result["blurhash"] = blurhash(image)
+    return result
+
+
+def lqip(image: Image.Image, size: int = LQIP_SIZE) -> str:
+    """ `data:image/webp;base64,...` of the image at most `size` pixels wide and high. """
+    small = image.copy()
+    small.thumbnail((size, size), Image.Resampling.BOX)
+    if small.mode not in ("RGB", "RGBA"):
+        small = small.convert("RGBA" if "A" in small.mode or "transparency" in small.info else "RGB")
+    buffer = io.BytesIO()
+    small.save(buffer, format="WEBP", quality=LQIP_QUALITY, method=6)
+    return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def blurhash(image: Image.Image, components: Tuple[int, int] = BLURHASH_COMPONENTS) -> str:
+    """ BlurHash (https://blurha.sh) of the image, computed with numpy over a small downscale. """
+    # only loaded once the first placeholder is computed
+    import numpy as np
+    components_x, components_y = components
+    sample = image.convert("RGB")
+    sample.thumbnail((BLURHASH_SAMPLE_SIZE, BLURHASH_SAMPLE_SIZE), Image.Resampling.BOX)
+    srgb = np.asarray(sample, dtype=np.float64) / 255
+    pixels = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    height, width = pixels.shape[:2]
+
+    # every component is the cosine transform of the whole image at one frequency pair
+    basis_x = np.cos(np.pi * np.outer(np.arange(components_x), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(components_y), np.arange(height)) / height)
+    factors = np.einsum("jy,ix,yxc->jic", basis_y, basis_x, pixels) / (width * height)
+    # every component but the average colour counts twice
+    factors *= 2
+    factors[0, 0] /= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+
+    result = _base83((components_x - 1) + (components_y - 1) * 9, 1)
+    if len(ac):
+        quantised_max = int(max(0, min(82, np.floor(np.abs(ac).max() * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max, max_value = 0, 1
+    result += _base83(quantised_max, 1)
+    r, g, b = (_linear_to_srgb(value) for value in dc)
+    result += _base83((r << 16) + (g << 8) + b, 4)
+    quantised = np.clip(np.floor(np.sign(ac) * np.abs(ac / max_value) ** 0.5 * 9 + 9.5), 0, 18).astype(int)
+    for qr, qg, qb in quantised:
+        result += _base83(int(qr) * 19 * 19 + int(qg) * 19 + int(qb), 2)
+    return result
+
+
+def _linear_to_srgb(value: float) -> int:
+    value = max(0.0, min(1.0, float(value)))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(BASE83[value // 83 ** (length - 1 - i) % 83] for i in range(length))
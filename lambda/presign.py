@@ -0,0 +1,184 @@
+""" local batch presigning of s3/r2 urls, byte-identical to botocore's generate_presigned_url """
+import hashlib
+import hmac
+import time
+from functools import lru_cache
+from typing import List, Optional
+from urllib.parse import parse_qsl, quote, urlsplit
+from bounded_cache import BoundedCache
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+# the probe key botocore presigns once per batch, to learn the host, path style and scope
+_TEMPLATE_KEY = "presign-template"
+# sigv4 presigned urls are valid for at most 7 days
+MAX_EXPIRES_IN = 7 * 24 * 60 * 60
+
+
+@lru_cache(maxsize=32)
+def _signing_key(secret_key: str, date: str, region: str, service: str) -> bytes:
+    # only changes once a day per credential, so it is derived once and reused
+    key = hmac.new(f"AWS4{secret_key}".encode("utf-8"),
+                   date.encode("utf-8"), hashlib.sha256).digest()
+    for part in (region, service, "aws4_request"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    return key
+
+
+def _quote(value: str, safe: str = "-_.~") -> str:
+    return quote(value, safe=safe)
+
+
+class BatchPresigner:
+    """ Presigns many keys of one bucket with SigV4 query signing, without going through botocore.
+
+    botocore presigns a single probe key first. Its url supplies everything that is the same
+    for every key (endpoint, addressing style, credential scope), and re-signing the probe
+    locally must reproduce it exactly, otherwise every url falls back to botocore.
+    """
+
+    def __init__(self, s3, client_method: str, bucket: str, expires_in: int = 600,
+                 http_method: Optional[str] = None, params: Optional[dict] = None):
+        self.s3 = s3
+        self.client_method = client_method
+        self.bucket = bucket
+        self.expires_in = expires_in
+        self.http_method = http_method
+        # extra botocore Params shared by every url, e.g. the UploadId of upload_part
+        self.params = params or {}
+        self.method = http_method or (
+            "PUT" if client_method == "put_object" else "GET")
+        template = self._botocore_url(_TEMPLATE_KEY)
+        self.local = self._prepare(template)
+
+    def url(self, key: str, amz_date: Optional[str] = None, query_params: Optional[dict] = None,
+            params: Optional[dict] = None) -> str:
+        """ Presigned url of `key`, signed at `amz_date` (`%Y%m%dT%H%M%SZ`) or the batch's time.
+
+        `query_params` replace values of the probe's query string for this url only, `params`
+        are the same change expressed as botocore Params, used when signing falls back to botocore.
+        """
+        if not self.local:
+            return self._botocore_url(key, params)
+        amz_date = amz_date or self.amz_date
+        path = self.base_path + _quote(key, safe="/~")
+        credential = f"{self.access_key}/{amz_date[:8]}/{self.region}/{self.service}/aws4_request"
+        values = {**self.query_params, **(query_params or {}),
+                  "X-Amz-Credential": credential, "X-Amz-Date": amz_date}
+        canonical_query = "&".join(f"{name}={_quote(values[name])}" for name in sorted(values))
+        # the url keeps the probe's parameter order, only the canonical request is sorted
+        query = "&".join(f"{name}={_quote(values[name])}" for name in self.query_order)
+        canonical_request = "\n".join([
+            self.method, path, canonical_query, f"host:{self.host}", "", "host", UNSIGNED_PAYLOAD])
+        string_to_sign = "\n".join([
+            ALGORITHM, amz_date, credential.split("/", 1)[1],
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+        signing_key = _signing_key(
+            self.secret_key, amz_date[:8], self.region, self.service)
+        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"),
+                             hashlib.sha256).hexdigest()
+        return f"{self.scheme}://{self.host}{path}?{query}&X-Amz-Signature={signature}"
+
+    def urls(self, keys: List[str], amz_date: Optional[str] = None) -> List[str]:
+        return [self.url(key, amz_date) for key in keys]
+
+    def _botocore_url(self, key: str, params: Optional[dict] = None) -> str:
+        kwargs = {"Params": {"Bucket": self.bucket, "Key": key, **self.params, **(params or {})},
+                  "ExpiresIn": self.expires_in}
+        if self.http_method:
+            kwargs["HttpMethod"] = self.http_method
+        return self.s3.generate_presigned_url(self.client_method, **kwargs)
+
+    def _prepare(self, template: str) -> bool:
+        try:
+            parts = urlsplit(template)
+            params = dict(parse_qsl(parts.query, keep_blank_values=True))
+            encoded_key = _quote(_TEMPLATE_KEY, safe="/~")
+            if params.get("X-Amz-Algorithm") != ALGORITHM or params.get("X-Amz-SignedHeaders") != "host" \
+                    or not parts.path.endswith(encoded_key):
+                return False
+            access_key, date, region, service, _ = params["X-Amz-Credential"].split(
+                "/")
+            # botocore's credential chain already resolved these for the probe
+            credentials = self.s3._request_signer._credentials.get_frozen_credentials()
+            if credentials.access_key != access_key:
+                return False
+
+            self.scheme, self.host = parts.scheme, parts.netloc
+            self.base_path = parts.path[:-len(encoded_key)]
+            self.access_key, self.secret_key = access_key, credentials.secret_key
+            self.region, self.service = region, service
+            self.amz_date = params["X-Amz-Date"]
+            self.query_order = [name for name in params if name != "X-Amz-Signature"]
+            self.query_params = {name: value for name, value in params.items()
+                                 if name not in ("X-Amz-Signature", "X-Amz-Credential", "X-Amz-Date")}
+            self.local = True
+            # the local signature has to reproduce botocore's exactly before it is trusted
+            if self.url(_TEMPLATE_KEY) == template:
+                return True
+        except Exception as e:
+            print(f"Local presigning unavailable: {str(e)}")
+        return False
+
+
+def presign_urls(s3, client_method: str, bucket: str, keys: List[str], expires_in: int = 600,
+                 http_method: Optional[str] = None) -> List[str]:
+    """ Batch equivalent of calling `s3.generate_presigned_url` once per key. """
+    if not keys:
+        return []
+    return BatchPresigner(s3, client_method, bucket, expires_in, http_method).urls(keys)
+
+
+def presign_part_urls(s3, bucket: str, key: str, upload_id: str, part_numbers: List[int],
+                      expires_in: int = 600) -> List[str]:
+    """ Presigned upload_part urls of one multipart upload, one per part number. """
+    if not part_numbers:
+        return []
+    presigner = BatchPresigner(s3, "upload_part", bucket, expires_in, "PUT",
+                               params={"UploadId": upload_id, "PartNumber": part_numbers[0]})
+    return [presigner.url(key, query_params={"partNumber": str(number)},
+                          params={"PartNumber": number}) for number in part_numbers]
+
+
+class WindowedPresignCache:
+    """ Presigned urls signed at the start of fixed `window_seconds` time windows.
+
+    Every url of a window carries the same X-Amz-Date, so the same key yields the same url
+    until the window ends and browsers and CDNs can reuse what they fetched with it. Urls are
+    valid for the window plus `min_validity_seconds`, so even one handed out at the end of its
+    window stays valid for `min_validity_seconds`. Urls are kept in a bounded LRU until their
+    window ends.
+    """
+
+    def __init__(self, max_entries: int, window_seconds: int, min_validity_seconds: int):
+        if window_seconds + min_validity_seconds > MAX_EXPIRES_IN:
+            raise ValueError(f"window plus validity exceeds {MAX_EXPIRES_IN} seconds")
+        self.cache = BoundedCache(max_entries)
+        self.window_seconds = window_seconds
+        self.expires_in = window_seconds + min_validity_seconds
+
+    def urls(self, s3, client_method: str, bucket: str, keys: List[str],
+             http_method: Optional[str] = None, now: Optional[float] = None) -> List[str]:
+        if not keys:
+            return []
+        now = time.time() if now is None else now
+        window_start = int(now // self.window_seconds * self.window_seconds)
+        window_end = window_start + self.window_seconds
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(window_start))
+
+        urls = {}
+        for key in keys:
+            url = self.cache.get((client_method, bucket, key, window_start))
+            if url is not None:
+                urls[key] = url
+        missing = [key for key in dict.fromkeys(keys) if key not in urls]
+        if missing:
+            presigner = BatchPresigner(s3, client_method, bucket, self.expires_in, http_method)
+            for key, url in zip(missing, presigner.urls(missing, amz_date)):
+                urls[key] = url
+                self.cache.set((client_method, bucket, key, window_start), url, expires_at=window_end)
+        return [urls[key] for key in keys]
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "windowSeconds": self.window_seconds,
+                "expiresIn": self.expires_in}
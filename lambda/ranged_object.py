@@ -0,0 +1,105 @@
+""" seekable read-only file object over a bucket object, fetching only the byte ranges that are read """
+import io
+from collections import OrderedDict
+from typing import Optional
+
+# objects are fetched in aligned blocks, demuxers read in many small and often repeated steps
+DEFAULT_BLOCK_SIZE = 512 * 1024
+# blocks kept for re-reads, e.g. the mp4 index and the start of the stream
+DEFAULT_MAX_BLOCKS = 32
+
+
+class RangedObject(io.RawIOBase):
+    """ Raw reader over a bucket object that only fetches the blocks being read.
+
+    Containers such as mp4 keep their index at either end of the file, a reader that can seek
+    gets at a poster frame with a few ranged requests instead of downloading the whole video.
+    Missing blocks next to each other are fetched with a single ranged get_object, and the
+    most recently read `max_blocks` blocks are kept in memory.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, size: Optional[int] = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE, max_blocks: int = DEFAULT_MAX_BLOCKS):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else s3.head_object(
+            Bucket=bucket, Key=key)["ContentLength"]
+        self.block_size = block_size
+        self.max_blocks = max(1, max_blocks)
+        self.requests = 0
+        self.bytes_read = 0
+        self._position = 0
+        self._blocks: "OrderedDict[int, bytes]" = OrderedDict()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        end = min(self._position + len(buffer), self.size)
+        if self._position >= end:
+            return 0
+        # never more blocks at once than are kept, larger reads come back short
+        last_block = min((end - 1) // self.block_size,
+                         self._position // self.block_size + self.max_blocks - 1)
+        end = min(end, (last_block + 1) * self.block_size)
+        self._fetch(self._position // self.block_size, last_block)
+
+        written = 0
+        while self._position < end:
+            index, offset = divmod(self._position, self.block_size)
+            block = self._blocks[index]
+            self._blocks.move_to_end(index)
+            chunk = block[offset:offset + end - self._position]
+            buffer[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self._position += len(chunk)
+        return written
+
+    def _fetch(self, first_block: int, last_block: int):
+        index = first_block
+        while index <= last_block:
+            if index in self._blocks:
+                # kept ahead of the eviction below
+                self._blocks.move_to_end(index)
+                index += 1
+                continue
+            run_end = index
+            while run_end + 1 <= last_block and run_end + 1 not in self._blocks:
+                run_end += 1
+            first = index * self.block_size
+            last = min((run_end + 1) * self.block_size, self.size) - 1
+            data = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range=f"bytes={first}-{last}")["Body"].read()
+            self.requests += 1
+            self.bytes_read += len(data)
+            for block in range(index, run_end + 1):
+                start = (block - index) * self.block_size
+                self._blocks[block] = data[start:start + self.block_size]
+                self._blocks.move_to_end(block)
+            index = run_end + 1
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+
+def open_ranged(s3, bucket: str, key: str, size: Optional[int] = None,
+                block_size: int = DEFAULT_BLOCK_SIZE) -> io.BufferedReader:
+    """ Buffered RangedObject, its `.raw` keeps the request and byte counts. """
+    return io.BufferedReader(RangedObject(s3, bucket, key, size, block_size), block_size)
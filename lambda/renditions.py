@@ -0,0 +1,22 @@
+""" derivatives written by thumbnail_gen, shared with the functions that clean them up """
+import json
+import os
+
+# every upload is decoded once and written as each of these renditions under `<prefix><key>`,
+# can be overridden with a JSON list in THUMBNAIL_RENDITIONS, which the delete functions
+# need to see as well to find the derivatives
+DEFAULT_RENDITIONS = [
+    {"name": "full", "prefix": "gen/full/", "maxSize": 2048,
+        "format": "JPEG", "quality": 85},
+    {"name": "preview", "prefix": "gen/preview/", "maxSize": 1024,
+        "format": "WEBP", "quality": 80},
+    {"name": "thumb", "prefix": "gen/thumbs/", "maxSize": 256,
+        "format": "WEBP", "quality": 75},
+]
+RENDITIONS = json.loads(os.environ["THUMBNAIL_RENDITIONS"]) \
+    if os.environ.get("THUMBNAIL_RENDITIONS") else DEFAULT_RENDITIONS
+# short silent preview clips of videos, next to the poster renditions
+CLIP_RENDITION = {"name": "clip", "prefix": "gen/clips/", "contentType": "video/mp4"}
+# every prefix a derivative of `<key>` can be written under
+DERIVATIVE_PREFIXES = list(dict.fromkeys(
+    [rendition["prefix"] for rendition in RENDITIONS] + [CLIP_RENDITION["prefix"]]))
@@ -0,0 +1,106 @@
+""" compact JSON responses shared by the HTTP handlers, compressed when the client accepts it """
+import base64
+import gzip
+import importlib.util
+import json
+import os
+from typing import Optional
+from metrics import count, span
+
+# optional, used when installed in the deployment package
+ORJSON_AVAILABLE = importlib.util.find_spec("orjson") is not None
+BROTLI_AVAILABLE = importlib.util.find_spec("brotli") is not None
+COMPRESSION_ENABLED = os.environ.get(
+    "RESPONSE_COMPRESSION", "true").lower() == "true"
+# below this the encoding headers and base64 cost more than compression saves
+COMPRESS_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESS_MIN_BYTES", 1024))
+# fast levels, presign batches compress well even without searching hard
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+MAX_ERROR_LENGTH = 512
+
+if ORJSON_AVAILABLE:
+    import orjson
+if BROTLI_AVAILABLE:
+    import brotli
+
+
+def dumps(payload) -> str:
+    """ Compact JSON, through orjson when available. """
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(payload).decode("utf-8")
+        except TypeError:
+            # e.g. integers beyond 64 bits, the standard encoder handles everything json does
+            pass
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def json_response(status_code: int, payload, event: Optional[dict] = None,
+                  headers: Optional[dict] = None) -> dict:
+    """ API Gateway proxy response with `payload` as its JSON body, encoded for `event`'s client. """
+    with span("serialize"):
+        body = dumps(payload)
+    return negotiate_encoding({
+        "statusCode": status_code,
+        "headers": {"Content-Type": "application/json", **(headers or {})},
+        "body": body
+    }, event)
+
+
+def error_response(status_code: int, message: str, event: Optional[dict] = None) -> dict:
+    """ `{"error": message}` with the message cut to MAX_ERROR_LENGTH, never any request data. """
+    if len(message) > MAX_ERROR_LENGTH:
+        message = message[:MAX_ERROR_LENGTH - 3] + "..."
+    return json_response(status_code, {"error": message}, event)
+
+
+def negotiate_encoding(response: dict, event: Optional[dict]) -> dict:
+    """ Compresses a text response body with br or gzip if the request's Accept-Encoding allows it. """
+    body = response.get("body")
+    if (not COMPRESSION_ENABLED or event is None or response.get("isBase64Encoded")
+            or not isinstance(body, str) or len(body) < COMPRESS_MIN_BYTES):
+        return response
+    encoding = _preferred_encoding(_header(event, "accept-encoding"))
+    if encoding is None:
+        return response
+
+    with span("compress"):
+        raw = body.encode("utf-8")
+        if encoding == "br":
+            compressed = brotli.compress(raw, quality=BROTLI_QUALITY)
+        else:
+            compressed = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+        encoded_body = base64.b64encode(compressed).decode("ascii")
+    count("bytesUncompressed", len(raw))
+    count("bytesCompressed", len(compressed))
+    return {
+        **response,
+        "headers": {**response.get("headers", {}), "Content-Encoding": encoding,
+                    "Vary": "Accept-Encoding"},
+        # API Gateway hands the decoded bytes to the client, which inflates them
+        "isBase64Encoded": True,
+        "body": encoded_body
+    }
+
+
+def _header(event: dict, name: str) -> str:
+    for key, value in (event.get("headers") or {}).items():
+        if key.lower() == name:
+            return value or ""
+    return ""
+
+
+def _preferred_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().lower().partition(";")
+        # `q=0` explicitly refuses an encoding
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip())
+    if BROTLI_AVAILABLE and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
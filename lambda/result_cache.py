@@ -0,0 +1,123 @@
+""" content-addressed cache of generated images, an in-process LRU in front of a bucket prefix """
+import hashlib
+import json
+import threading
+from typing import Callable, Optional, Tuple
+from botocore.exceptions import ClientError
+from bounded_cache import BoundedCache
+from object_exists import MISSING_OBJECT_CODES
+
+CACHE_PREFIX = "gen/cache/"
+# entries are never deleted by the functions, the bucket expires them with this rule
+# (see lifecycle_rule()), a later request for an expired entry just computes it again
+CACHE_EXPIRATION_DAYS = 30
+# part of every key, bump it whenever the same inputs start producing different outputs
+CACHE_VERSION = "2"
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def digest_source(source) -> str:
+    """ SHA-256 of a seekable file object, which is left at the position it was found at. """
+    position = source.tell()
+    source.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(DIGEST_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    source.seek(position)
+    return digest.hexdigest()
+
+
+def cache_key(input_digest: str, settings: dict) -> str:
+    """ Key of the output produced from the input with `input_digest` using `settings`. """
+    payload = json.dumps(settings, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{CACHE_VERSION}:{input_digest}:{payload}".encode()).hexdigest()
+
+
+def lifecycle_rule(prefix: str = CACHE_PREFIX, days: int = CACHE_EXPIRATION_DAYS) -> dict:
+    """ Bucket lifecycle rule expiring cached results, for `put_bucket_lifecycle_configuration`.
+
+    S3 and R2 both accept it, e.g. `s3.put_bucket_lifecycle_configuration(Bucket=bucket,
+    LifecycleConfiguration={"Rules": [lifecycle_rule()]})` next to any existing rules.
+    """
+    return {"ID": "expire-result-cache", "Status": "Enabled",
+            "Filter": {"Prefix": prefix}, "Expiration": {"Days": days}}
+
+
+class ResultCache:
+    """ Two tier cache of `(output bytes, metadata)` entries.
+
+    Lookups go to the bounded in-process LRU first, then to `<prefix><key>` in the bucket,
+    whose hits are promoted into the LRU. `get_client` is called on first bucket access so
+    the shared client is only built when needed, leaving it None disables the bucket tier.
+    The bucket tier never fails a lookup or a store, any error there is a miss or a skipped write.
+    """
+
+    def __init__(self, max_entries: int, get_client: Optional[Callable] = None,
+                 bucket: Optional[str] = None, prefix: str = CACHE_PREFIX,
+                 max_bytes: Optional[int] = None):
+        # outputs can be megabytes each, the LRU is bounded by their total size as well
+        self.memory = BoundedCache(max_entries, max_bytes)
+        self.bucket = bucket if get_client is not None else None
+        self.prefix = prefix
+        self.bucket_hits = 0
+        self.bucket_misses = 0
+        self.bucket_writes = 0
+        self.bucket_errors = 0
+        self._get_client = get_client
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.max_entries > 0 or self.bucket is not None
+
+    def get(self, key: str) -> Optional[Tuple[bytes, dict]]:
+        entry = self.memory.get(key)
+        if entry is not None or self.bucket is None:
+            return entry
+        try:
+            response = self._get_client().get_object(
+                Bucket=self.bucket, Key=self.prefix + key)
+            entry = (response["Body"].read(),
+                     json.loads(response.get("Metadata", {}).get("result", "{}")))
+        except ClientError as e:
+            missing = e.response.get("Error", {}).get("Code") in MISSING_OBJECT_CODES
+            self._count("bucket_misses" if missing else "bucket_errors")
+            return None
+        except Exception as e:
+            # unreachable endpoint, missing credentials, unreadable metadata and the like
+            print(f"result cache: failed to read {key}: {str(e)}")
+            self._count("bucket_errors")
+            return None
+        self._count("bucket_hits")
+        self.memory.set(key, entry, size=len(entry[0]))
+        return entry
+
+    def set(self, key: str, data: bytes, metadata: dict, content_type: str = "binary/octet-stream"):
+        self.memory.set(key, (data, metadata), size=len(data))
+        if self.bucket is None:
+            return
+        try:
+            # bucket metadata keys come back lowercased, so the metadata travels as one JSON value
+            self._get_client().put_object(
+                Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type,
+                Metadata={"result": json.dumps(metadata, separators=(",", ":"))})
+            self._count("bucket_writes")
+        except Exception as e:
+            # a failed write only costs a future recompute
+            print(f"result cache: failed to store {key}: {str(e)}")
+            self._count("bucket_errors")
+
+    def stats(self) -> dict:
+        with self._lock:
+            bucket = {
+                "enabled": self.bucket is not None,
+                "hits": self.bucket_hits,
+                "misses": self.bucket_misses,
+                "writes": self.bucket_writes,
+                "errors": self.bucket_errors
+            }
+        return {"memory": self.memory.stats(), "bucket": bucket}
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
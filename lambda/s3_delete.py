@@ -1,10 +1,13 @@
 """ delete files from s3 bucket """
 
-from s3configs import S3_BUCKET_NAME, s3
+from s3configs import S3_BUCKET_NAME, S3_BUCKET_NAME_2, get_s3
+from batch_delete import delete_keys, delete_prefix, is_own_prefix
+from metrics import count, instrumented, record_error, span
+from responses import error_response, json_response
 import json
-import sys
 
 
+@instrumented("s3_delete_bynames")
 def delete_bynames_handler(event, context):
     try:
         # Extract user context
@@ -13,7 +16,8 @@ def delete_bynames_handler(event, context):
         uid = authorizer.get('uid')
 
         # Parse input
-        body = json.loads(event["body"])
+        with span("parse"):
+            body = json.loads(event["body"])
         filenames = body["fileNames"]  # Expecting a list
         folder = body['folder']
 
@@ -23,36 +27,33 @@ def delete_bynames_handler(event, context):
             for filename in filenames
         ]
 
-        # Perform batch delete
-        response = s3.delete_objects(
-            Bucket=S3_BUCKET_NAME,
-            Delete={"Objects": objects_to_delete}
-        )
+        # Perform batch delete, chunked to the 1000 keys per request limit
+        with span("delete"):
+            deleted, errors, derivatives = delete_keys(
+                get_s3(), S3_BUCKET_NAME, [obj["Key"] for obj in objects_to_delete],
+                include_derivatives=body.get("includeThumbnails", False),
+                derivatives_bucket=S3_BUCKET_NAME_2
+            )
 
+        count("keysDeleted", len(deleted))
         returning_results = {
-            "deleted": response.get("Deleted", []),
-            "errors": response.get("Errors", []),
+            "deleted": deleted,
+            "errors": errors,
             "requestContext": {"authorizer": authorizer}
         }
+        if body.get("includeThumbnails", False):
+            # reported apart, `deleted` only ever lists the requested keys
+            returning_results["deletedDerivatives"] = derivatives["deleted"]
+            returning_results["derivativeErrors"] = derivatives["errors"]
 
-        return {
-            "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps(returning_results, indent=2)
-        }
+        return json_response(200, returning_results, event)
 
     except Exception as e:
-        typee, value, traceback = sys.exc_info()
-        types = {"request_context": type(request_context), "authorizer": type(authorizer), "uid": type(uid), "body": type(body), "filenames": type(filenames), "folder": type(
-            folder), "objects_to_delete": type(objects_to_delete), "response": type(response), "returning_results": type(returning_results)},
-        return {
-            "statusCode": 500,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps({"error": str(e), "details": {"type": str(typee), "value": str(value), "traceback": str(traceback)},
-                                "types": {types}, "body": event["body"]})
-        }
+        record_error(e)
+        return error_response(500, str(e), event)
 
 
+@instrumented("s3_delete_bykeys")
 def delete_bykeys_handler(event, context):
     try:
         # Extract user context
@@ -61,7 +62,8 @@ def delete_bykeys_handler(event, context):
         uid = authorizer.get('uid')
 
         # Parse input
-        body = json.loads(event["body"])
+        with span("parse"):
+            body = json.loads(event["body"])
         objectKeys = body["objectKeys"]  # Expecting a list
 
         # Prepare objects to delete
@@ -70,31 +72,67 @@ def delete_bykeys_handler(event, context):
             for key in objectKeys
         ]
 
-        # Perform batch delete
-        response = s3.delete_objects(
-            Bucket=S3_BUCKET_NAME,
-            Delete={"Objects": objects_to_delete}
-        )
+        # Perform batch delete, chunked to the 1000 keys per request limit
+        with span("delete"):
+            deleted, errors, derivatives = delete_keys(
+                get_s3(), S3_BUCKET_NAME, [obj["Key"] for obj in objects_to_delete],
+                include_derivatives=body.get("includeThumbnails", False),
+                derivatives_bucket=S3_BUCKET_NAME_2
+            )
 
+        count("keysDeleted", len(deleted))
         returning_results = {
-            "deleted": response.get("Deleted", []),
-            "errors": response.get("Errors", []),
+            "deleted": deleted,
+            "errors": errors,
             "requestContext": {"authorizer": authorizer}
         }
+        if body.get("includeThumbnails", False):
+            # reported apart, `deleted` only ever lists the requested keys
+            returning_results["deletedDerivatives"] = derivatives["deleted"]
+            returning_results["derivativeErrors"] = derivatives["errors"]
 
-        return {
-            "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps(returning_results, indent=2)
-        }
+        return json_response(200, returning_results, event)
 
     except Exception as e:
-        typee, value, traceback = sys.exc_info()
-        types = {"request_context": type(request_context), "authorizer": type(authorizer), "uid": type(uid), "body": type(body), "objectKeys": type(
-            objectKeys), "objects_to_delete": type(objects_to_delete), "response": type(response), "returning_results": type(returning_results)},
-        return {
-            "statusCode": 500,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps({"error": str(e), "details": {"type": str(typee), "value": str(value), "traceback": str(traceback)},
-                                "types": {types}, "body": event["body"]})
-        }
+        record_error(e)
+        return error_response(500, str(e), event)
+
+
+@instrumented("s3_delete_byprefix")
+def delete_byprefix_handler(event, context):
+    try:
+        # Extract user context
+        request_context = event.get('requestContext', {})
+        authorizer = request_context.get('authorizer', {})
+        uid = authorizer.get('uid')
+
+        # Parse input
+        with span("parse"):
+            body = json.loads(event["body"])
+        prefix = body["prefix"].strip("/")
+        if not prefix:
+            return error_response(400, "'prefix' must not be empty", event)
+        if not is_own_prefix(prefix, uid):
+            return error_response(403, "'prefix' must be inside one of your upload folders", event)
+
+        # Delete page by page, resumable through the returned continuationToken
+        with span("delete"):
+            returning_results = delete_prefix(
+                get_s3(), S3_BUCKET_NAME, prefix,
+                dry_run=body.get("dryRun", False),
+                orphans_only=body.get("orphansOnly", False),
+                derivatives_bucket=S3_BUCKET_NAME_2,
+                continuation_token=body.get("continuationToken"),
+                context=context
+            )
+        returning_results["requestContext"] = {"authorizer": authorizer}
+
+        return json_response(200, returning_results, event)
+
+    except ValueError as e:
+        # a malformed body or continuationToken
+        record_error(e)
+        return error_response(400, str(e), event)
+    except Exception as e:
+        record_error(e)
+        return error_response(500, str(e), event)
@@ -1,58 +1,45 @@
 """ generate upload urls to upload to s3 bucket """
 
-from s3configs import S3_BUCKET_NAME, s3
+from s3configs import S3_BUCKET_NAME, get_s3
+import multipart
+import upload_urls
+import dedupe_index
+from metrics import count, instrumented, record_error, span
+from responses import error_response, json_response
 import json
 
 
+@instrumented("s3_upload")
 def upload_handler(event, context):
+    return upload_urls.handle_request(event, get_s3, S3_BUCKET_NAME)
+
+
+# large files and videos, uploaded in parts straight to the bucket (see multipart.py)
+
+@instrumented("s3_upload_multipart_create")
+def multipart_create_handler(event, context):
+    return multipart.handle_request("create", event, get_s3, S3_BUCKET_NAME)
+
+
+@instrumented("s3_upload_multipart_complete")
+def multipart_complete_handler(event, context):
+    return multipart.handle_request("complete", event, get_s3, S3_BUCKET_NAME)
+
+
+@instrumented("s3_upload_multipart_abort")
+def multipart_abort_handler(event, context):
+    return multipart.handle_request("abort", event, get_s3, S3_BUCKET_NAME)
+
+
+@instrumented("s3_upload_dedupe_rebuild")
+def dedupe_rebuild_handler(event, context):
+    """ Scheduled maintenance, rewrites the dedupe index from the ETags in the bucket. """
     try:
-        # Get requestContext or empty dict if missing
-        request_context = event.get('requestContext', {})
-        # Get authorizer or empty dict if missing
-        authorizer = request_context.get('authorizer', {})
-        uid = authorizer.get('uid')  # Get uid or None if missing
-        body = json.loads(event["body"])
-        folder = body.get("folder", "")
-
-        filenames = []
-        if "fileName" in body:  # Single file upload
-            filenames = [body["fileName"]]
-        elif "fileNames" in body:  # Multiple file uploads
-            filenames = body["fileNames"]
-        else:
-            return {
-                "statusCode": 400,
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({"error": "Missing 'fileName' or 'fileNames'"})
-            }
-
-        results = []
-        for filename in filenames:
-            key = f"{folder}/{filename}".strip("/")
-            url = s3.generate_presigned_url(
-                "put_object",
-                Params={"Bucket": S3_BUCKET_NAME,
-                        "Key": key},
-                ExpiresIn=600,
-                HttpMethod="PUT"
-            )
-            results.append({
-                "fileName": filename,
-                "key": key,
-                "url": url
-            })
-
-        returning_results = {"results": (results if len(results) > 1 else results[0]), "requestContext": {
-            "authorizer": authorizer}}
-
-        return {
-            "statusCode": 200,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps(returning_results, indent=2)
-        }
+        with span("rebuild"):
+            result = dedupe_index.rebuild_index(get_s3(), S3_BUCKET_NAME)
+        count("checksumsIndexed", result["checksumsIndexed"])
+        print(f"Rebuilt the dedupe index: {json.dumps(result)}")
+        return json_response(200, result, event)
     except Exception as e:
-        return {
-            "statusCode": 500,
-            "headers": {"Content-Type": "application/json"},
-            "body": json.dumps({"error": str(e)})
-        }
+        record_error(e)
+        return error_response(500, str(e), event)
@@ -1,6 +1,5 @@
 import os
-import boto3
-from botocore.client import Config
+import threading
 
 TESTING = True
 
@@ -13,5 +12,30 @@ else:
     S3_BUCKET_NAME_2 = os.environ["S3_BUCKET_NAME_2"]
 
 SIGNATURE_VERSION = "s3v4"
+# the shared client is used from worker threads (EXISTS_MAX_WORKERS, DEDUPE_MAX_WORKERS...),
+# botocore's default pool of 10 connections would make the extra workers wait for one
+MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 32))
 
-s3 = boto3.client("s3", config=Config(signature_version=SIGNATURE_VERSION))
+# built on first use and then reused by every warm invocation of the container
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                # boto3 is only imported once a handler actually needs the client
+                import boto3
+                from botocore.client import Config
+                _s3 = boto3.client(
+                    "s3", config=Config(signature_version=SIGNATURE_VERSION,
+                                        max_pool_connections=MAX_POOL_CONNECTIONS))
+    return _s3
+
+
+def set_s3(client):
+    """ Replaces the shared client, e.g. with a local stand-in for runners and benchmarks. """
+    global _s3
+    _s3 = client
@@ -0,0 +1,124 @@
+""" size targeting image encoder shared by the thumbnail generators """
+import io
+import math
+from typing import Dict, Optional, Tuple
+from PIL import Image
+
+MIN_QUALITY = 10
+MAX_QUALITY = 100
+MAX_DOWNSCALE_ROUNDS = 4
+MIN_SCALE_FACTOR = 0.25
+MAX_SCALE_FACTOR = 0.9
+MIN_DIMENSION = 16
+# formats whose encoder ignores the quality setting, searching quality is pointless
+QUALITY_AGNOSTIC_FORMATS = {"png", "gif", "bmp", "tiff"}
+
+
+def encode_image(image: Image.Image, fmt: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    save_format = "JPEG" if fmt in ("jpg", "jpeg") else fmt.upper()
+    image.save(buffer, format=save_format, quality=quality)
+    return buffer.getvalue()
+
+
+class SizeTargetEncoder:
+    """ Finds the highest quality (and, if needed, the largest size) that fits a byte budget.
+
+    Qualities are binary searched instead of stepped down linearly and every encode
+    is memoised per image size, so a quality is never encoded twice.
+    """
+
+    def __init__(self, image: Image.Image, fmt: str, min_quality: int = MIN_QUALITY):
+        self.image = image
+        self.fmt = fmt.lower()
+        self.min_quality = min_quality
+        self.attempts = 0
+        self._encoded: Dict[Tuple[Tuple[int, int], int], bytes] = {}
+
+    def encode(self, image: Image.Image, quality: int) -> bytes:
+        cache_key = (image.size, quality)
+        data = self._encoded.get(cache_key)
+        if data is None:
+            data = encode_image(image, self.fmt, quality)
+            self._encoded[cache_key] = data
+            self.attempts += 1
+        return data
+
+    def fit(self, quality: int, max_bytes: Optional[int]) -> Tuple[Image.Image, int, bytes]:
+        """ Returns `(image, quality, data)` of the best encode within `max_bytes`.
+
+        When no quality fits, the image is downscaled until the floor quality fits and the
+        quality is searched again at that size, downscaling alone usually leaves room for more.
+        If it still does not fit after `MAX_DOWNSCALE_ROUNDS`, the smallest encode is returned.
+        """
+        quality = max(self.min_quality, min(int(quality), MAX_QUALITY))
+        # make sure pixel data is decoded once up front rather than by the first save
+        self.image.load()
+        image = self.image
+        data = self.encode(image, quality)
+        if not max_bytes or len(data) <= max_bytes:
+            return image, quality, data
+
+        found = self._search_quality(image, quality, max_bytes)
+        if found is not None:
+            return image, found[0], found[1]
+
+        floor = self._floor_quality(quality)
+        data = self.encode(image, floor)
+        for _ in range(MAX_DOWNSCALE_ROUNDS):
+            scaled = self._downscale(image, len(data), max_bytes)
+            if scaled is None:
+                break
+            image = scaled
+            data = self.encode(image, floor)
+            if len(data) <= max_bytes:
+                found = self._search_quality(image, quality, max_bytes)
+                if found is not None:
+                    return image, found[0], found[1]
+                break
+        return image, floor, data
+
+    def _floor_quality(self, quality: int) -> int:
+        if self.fmt in QUALITY_AGNOSTIC_FORMATS:
+            return quality
+        return min(self.min_quality, quality)
+
+    def _search_quality(self, image: Image.Image, quality: int, max_bytes: int) -> Optional[Tuple[int, bytes]]:
+        """ Highest quality up to `quality` whose encode fits `max_bytes`. """
+        if self.fmt in QUALITY_AGNOSTIC_FORMATS or quality <= self.min_quality:
+            return None
+        # probe the floor first, if even that is too big there is nothing to search
+        low, low_size = self.min_quality, len(self.encode(image, self.min_quality))
+        if low_size > max_bytes:
+            return None
+        high, high_size = quality, len(self.encode(image, quality))
+        if high_size <= max_bytes:
+            return high, self.encode(image, high)
+
+        interpolate = True
+        while high - low > 1:
+            # alternate size-interpolated and plain bisection probes, interpolation usually
+            # lands next to the answer while bisection keeps the worst case logarithmic
+            mid = (low + high) // 2
+            if interpolate and high_size > low_size:
+                ratio = (math.log(max_bytes) - math.log(low_size)) / \
+                    (math.log(high_size) - math.log(low_size))
+                mid = min(max(low + round((high - low) * ratio), low + 1), high - 1)
+            interpolate = not interpolate
+            size = len(self.encode(image, mid))
+            if size <= max_bytes:
+                low, low_size = mid, size
+            else:
+                high, high_size = mid, size
+        return low, self.encode(image, low)
+
+    def _downscale(self, image: Image.Image, current_bytes: int, max_bytes: int) -> Optional[Image.Image]:
+        # encoded size scales roughly with pixel count, so shrink each side by the square root
+        factor = math.sqrt(max_bytes / current_bytes) * 0.95
+        factor = max(MIN_SCALE_FACTOR, min(factor, MAX_SCALE_FACTOR))
+        width = int(image.width * factor)
+        height = int(image.height * factor)
+        if min(width, height) < MIN_DIMENSION:
+            return None
+        # always resample from the source so quality loss does not compound across rounds
+        return self.image.resize((width, height), Image.Resampling.LANCZOS)
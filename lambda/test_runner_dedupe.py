@@ -0,0 +1,101 @@
+""" test runner for dedupe uploads and the index rebuild, against the in-process s3 stand-in """
+
+import hashlib
+import json
+import os
+from auth_mock import get_mock_authorizer
+from local_s3 import LocalS3
+import dedupe_index
+import r2configs
+from uploads import handler as upload_handler, dedupe_rebuild_handler
+
+
+def _store() -> LocalS3:
+    store = LocalS3()
+    store.create_bucket(Bucket=r2configs.R2_BUCKET_NAME)
+    r2configs.set_s3(store)
+    # each runner starts from an empty bucket, forget shards cached by the previous one
+    dedupe_index._shards.clear()
+    return store
+
+
+def _upload(body: dict) -> dict:
+    event = get_mock_authorizer()
+    event["body"] = json.dumps(body)
+    result = upload_handler(event, None)
+    print("UPLOAD RESULT:", result["statusCode"], result["body"][:300])
+    return result
+
+
+def _put(store: LocalS3, key: str, data: bytes):
+    # what the client's PUT to the presigned url does
+    store.put_object(Bucket=r2configs.R2_BUCKET_NAME, Key=key, Body=data)
+
+
+def test_dedupe_upload():
+    store = _store()
+    photo, other = os.urandom(1000), os.urandom(1000)
+    checksums = [hashlib.md5(photo).hexdigest(), hashlib.md5(other).hexdigest()]
+    first = json.loads(_upload({"folder": "albums/a", "fileNames": ["photo.jpg", "other.jpg"],
+                                "checksums": checksums, "dedupe": True})["body"])["results"]
+    assert [result["duplicate"] for result in first] == [False, False]
+    assert all(result["url"] for result in first)
+    # the index points at the keys before they are uploaded, but only trusts uploaded content,
+    # so until the first upload arrives the partner gets a url too
+    again = json.loads(_upload({"folder": "albums/b", "fileName": "copy.jpg",
+                                "checksum": checksums[0], "dedupe": True})["body"])["results"]
+    assert not again["duplicate"] and again["url"], again
+
+    _put(store, "albums/a/photo.jpg", photo)
+    # the partner shares the same photo, no url comes back for it
+    shared = json.loads(_upload({"folder": "albums/b", "fileName": "copy.jpg",
+                                 "checksum": checksums[0].upper(), "dedupe": True})["body"])["results"]
+    assert shared["duplicate"] and shared["url"] is None, shared
+    assert shared["key"] == "albums/b/copy.jpg", shared
+    assert shared["duplicateOf"]["key"] == "albums/a/photo.jpg" and shared["duplicateOf"]["size"] == len(photo)
+
+    # overwritten content no longer matches its index entry
+    _put(store, "albums/a/photo.jpg", other)
+    replaced = json.loads(_upload({"folder": "albums/b", "fileName": "copy.jpg",
+                                   "checksum": checksums[0], "dedupe": True})["body"])["results"]
+    assert not replaced["duplicate"] and replaced["duplicateOf"] is None and replaced["url"], replaced
+
+
+def test_dedupe_errors():
+    _store()
+    for body in [{"fileName": "photo.jpg", "dedupe": True},
+                 {"fileName": "photo.jpg", "checksum": "not-an-md5", "dedupe": True},
+                 {"fileNames": ["a.jpg", "b.jpg"], "checksums": ["0" * 32], "dedupe": True}]:
+        assert _upload(body)["statusCode"] == 400
+    # without dedupe checksums are ignored
+    result = json.loads(_upload({"fileName": "photo.jpg", "checksum": "x"})["body"])["results"]
+    assert "duplicate" not in result and result["url"], result
+
+
+def test_dedupe_rebuild():
+    store = _store()
+    photo = os.urandom(1000)
+    checksum = hashlib.md5(photo).hexdigest()
+    _put(store, "albums/a/photo.jpg", photo)
+    _put(store, "albums/b/copy.jpg", photo)
+    _put(store, "gen/thumbs/albums/a/photo.jpg", os.urandom(100))
+    # a stale shard left behind by objects deleted since
+    _put(store, dedupe_index.INDEX_PREFIX + "ff.json", json.dumps({"f" * 32: ["gone.jpg"]}).encode())
+
+    result = dedupe_rebuild_handler({}, None)
+    print("REBUILD RESULT:", json.dumps(result, indent=2))
+    stats = json.loads(result["body"])
+    assert stats["objectsScanned"] == 2 and stats["checksumsIndexed"] == 1, stats
+    assert stats["shardsWritten"] == 1 and stats["shardsDeleted"] == 1, stats
+
+    dedupe_index._shards.clear()
+    shared = json.loads(_upload({"folder": "albums/c", "fileName": "photo.jpg",
+                                 "checksum": checksum, "dedupe": True})["body"])["results"]
+    # the oldest of the identical objects
+    assert shared["duplicate"] and shared["duplicateOf"]["key"] == "albums/a/photo.jpg", shared
+
+
+if __name__ == "__main__":
+    test_dedupe_upload()
+    test_dedupe_errors()
+    test_dedupe_rebuild()
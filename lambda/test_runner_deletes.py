@@ -0,0 +1,108 @@
+""" test runner for prefix deletes, against the in-process s3 stand-in """
+
+import json
+from auth_mock import get_mock_authorizer
+from local_s3 import LocalS3
+import batch_delete
+import r2configs
+from deletes import handler as delete_handler
+
+FOLDER = "uploads/20210507T063025Z-test-user"
+
+
+class _Context:
+    """ Lambda context whose remaining time drops by `step_ms` on every check. """
+
+    def __init__(self, remaining_ms: int, step_ms: int):
+        self.remaining_ms = remaining_ms
+        self.step_ms = step_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        self.remaining_ms -= self.step_ms
+        return self.remaining_ms
+
+
+def _store(keys) -> LocalS3:
+    store = LocalS3()
+    store.create_bucket(Bucket=r2configs.R2_BUCKET_NAME)
+    r2configs.set_s3(store)
+    for key in keys:
+        store.put_object(Bucket=r2configs.R2_BUCKET_NAME, Key=key, Body=b"data")
+    return store
+
+
+def _keys(store: LocalS3) -> list:
+    return sorted(store._buckets[r2configs.R2_BUCKET_NAME])
+
+
+def _delete(body: dict, uid: str = "test-user", context=None) -> dict:
+    event = get_mock_authorizer(uid=uid)
+    event["body"] = json.dumps(body)
+    result = delete_handler(event, context)
+    print("DELETE RESULT:", result["statusCode"], result["body"][:300])
+    return result
+
+
+def test_ownership():
+    store = _store([f"{FOLDER}/photo.jpg", "uploads/20210507T063025Z-other-user/photo.jpg"])
+    for prefix in ["uploads/20210507T063025Z-other-user", "uploads", "albums/a",
+                   f"{FOLDER}/../20210507T063025Z-other-user", ""]:
+        assert _delete({"prefix": prefix})["statusCode"] in (400, 403), prefix
+    assert _delete({"prefix": "uploads/20210507T063025Z-other-user"})["statusCode"] == 403
+    assert _delete({"prefix": FOLDER}, uid="other-user")["statusCode"] == 403
+    assert len(_keys(store)) == 2
+
+
+def test_dry_run():
+    keys = [f"{FOLDER}/a.jpg", f"{FOLDER}/b.jpg", f"gen/thumbs/{FOLDER}/a.jpg"]
+    store = _store(keys)
+    result = json.loads(_delete({"prefix": FOLDER, "dryRun": True})["body"])
+    assert result["dryRun"] and result["matchedCount"] == 3 and result["deletedCount"] == 0, result
+    assert _keys(store) == sorted(keys)
+
+    result = json.loads(_delete({"prefix": FOLDER})["body"])
+    assert result["matchedCount"] == 3 and result["deletedCount"] == 3, result
+    assert _keys(store) == []
+
+
+def test_orphans_only():
+    store = _store([f"{FOLDER}/kept.jpg", f"gen/thumbs/{FOLDER}/kept.jpg",
+                    f"gen/preview/{FOLDER}/kept.jpg", f"gen/thumbs/{FOLDER}/gone.jpg",
+                    f"gen/full/{FOLDER}/gone.jpg"])
+    result = json.loads(_delete({"prefix": FOLDER, "orphansOnly": True})["body"])
+    assert result["matchedCount"] == 2 and result["deletedCount"] == 2, result
+    assert _keys(store) == sorted([f"{FOLDER}/kept.jpg", f"gen/preview/{FOLDER}/kept.jpg",
+                                   f"gen/thumbs/{FOLDER}/kept.jpg"])
+
+
+def test_continuation():
+    store = _store([f"{FOLDER}/{i:03}.jpg" for i in range(25)]
+                   + [f"gen/thumbs/{FOLDER}/{i:03}.jpg" for i in range(25)])
+    max_keys = batch_delete.MAX_KEYS_PER_REQUEST
+    batch_delete.MAX_KEYS_PER_REQUEST = 10
+    try:
+        # enough time for a couple of pages, the rest is left for the next call
+        context = _Context(batch_delete.TIME_MARGIN_MS * 4, batch_delete.TIME_MARGIN_MS)
+        first = json.loads(_delete({"prefix": FOLDER}, context=context)["body"])
+        assert first["continuationToken"] and 0 < first["deletedCount"] < 50, first
+        assert first["deletedCount"] == first["matchedCount"], first
+        assert len(_keys(store)) == 50 - first["deletedCount"]
+
+        # a token is only accepted for the prefix it was handed out for
+        assert _delete({"prefix": f"{FOLDER}/other",
+                        "continuationToken": first["continuationToken"]})["statusCode"] == 400
+        assert _delete({"prefix": FOLDER, "continuationToken": "not-a-token"})["statusCode"] == 400
+
+        rest = json.loads(_delete({"prefix": FOLDER, "continuationToken": first["continuationToken"]})["body"])
+        assert rest["continuationToken"] is None, rest
+        assert first["deletedCount"] + rest["deletedCount"] == 50, rest
+        assert _keys(store) == []
+    finally:
+        batch_delete.MAX_KEYS_PER_REQUEST = max_keys
+
+
+if __name__ == "__main__":
+    test_ownership()
+    test_dry_run()
+    test_orphans_only()
+    test_continuation()
@@ -0,0 +1,132 @@
+""" test runner for the multipart upload lambda functions, against the in-process s3 stand-in """
+
+import json
+import os
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from auth_mock import get_mock_authorizer
+from local_s3 import LocalS3
+import r2configs
+from uploads import multipart_create_handler, multipart_complete_handler, multipart_abort_handler
+
+MiB = 1024 * 1024
+FILE_SIZE = 12 * MiB + 123
+
+
+def _store() -> LocalS3:
+    store = LocalS3()
+    store.create_bucket(Bucket=r2configs.R2_BUCKET_NAME)
+    r2configs.set_s3(store)
+    return store
+
+
+def _event(body: dict) -> dict:
+    event = get_mock_authorizer()
+    event["body"] = json.dumps(body)
+    return event
+
+
+def _create(file_size: int = FILE_SIZE) -> dict:
+    result = multipart_create_handler(_event({
+        "folder": "albums/test",
+        "fileName": "video.mp4",
+        "fileSize": file_size,
+        "partSize": 5 * MiB,
+        "contentType": "video/mp4"
+    }), None)
+    print("CREATE RESULT:", result["statusCode"], result["body"][:200])
+    assert result["statusCode"] == 200, result
+    return json.loads(result["body"])
+
+
+def _put_part(store: LocalS3, upload: dict, part: dict, data: bytes) -> dict:
+    # what the client's PUT of the slice to the part's presigned url does
+    assert "X-Local-Method=upload_part" in part["url"] and upload["uploadId"] in part["url"]
+    chunk = data[part["offset"]:part["offset"] + part["size"]]
+    etag = store.upload_part(Bucket=r2configs.R2_BUCKET_NAME, Key=upload["key"], UploadId=upload["uploadId"],
+                             PartNumber=part["partNumber"], Body=chunk)["ETag"]
+    return {"partNumber": part["partNumber"], "eTag": etag}
+
+
+def test_multipart_upload():
+    store = _store()
+    data = os.urandom(FILE_SIZE)
+    upload = _create()
+    assert upload["key"] == "albums/test/video.mp4"
+    assert [part["size"] for part in upload["parts"]] == [5 * MiB, 5 * MiB, 2 * MiB + 123]
+
+    # parts go up in parallel and finish in any order, a failed part is just sent again
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        parts = list(pool.map(lambda part: _put_part(store, upload, part, data),
+                              reversed(upload["parts"])))
+    parts[0] = _put_part(store, upload, upload["parts"][-1], data)
+
+    result = multipart_complete_handler(_event({
+        "key": upload["key"], "uploadId": upload["uploadId"], "parts": parts}), None)
+    print("COMPLETE RESULT:", json.dumps(result, indent=2))
+    assert result["statusCode"] == 200, result
+    assert json.loads(result["body"])["eTag"].endswith('-3"')
+    stored = store.get_object(Bucket=r2configs.R2_BUCKET_NAME, Key=upload["key"])
+    assert stored["Body"].read() == data and stored["ContentType"] == "video/mp4"
+
+
+def test_multipart_complete_errors():
+    store = _store()
+    data = os.urandom(FILE_SIZE)
+    upload = _create()
+    parts = [_put_part(store, upload, part, data) for part in upload["parts"]]
+    for body, status in [
+        ({"key": upload["key"], "uploadId": upload["uploadId"], "parts": []}, 400),
+        ({"key": upload["key"], "uploadId": upload["uploadId"], "parts": parts + parts[:1]}, 400),
+        ({"key": upload["key"], "uploadId": upload["uploadId"],
+          "parts": [{**parts[0], "eTag": '"stale"'}] + parts[1:]}, 400),
+        ({"key": upload["key"], "uploadId": "missing", "parts": parts}, 404),
+    ]:
+        result = multipart_complete_handler(_event(body), None)
+        print("COMPLETE ERROR:", result["statusCode"], result["body"])
+        assert result["statusCode"] == status, result
+
+
+def test_multipart_abort():
+    store = _store()
+    upload = _create()
+    result = multipart_abort_handler(_event(
+        {"key": upload["key"], "uploadId": upload["uploadId"]}), None)
+    print("ABORT RESULT:", json.dumps(result, indent=2))
+    assert result["statusCode"] == 200, result
+    again = multipart_abort_handler(_event(
+        {"key": upload["key"], "uploadId": upload["uploadId"]}), None)
+    assert again["statusCode"] == 404, again
+    assert store.list_multipart_uploads(Bucket=r2configs.R2_BUCKET_NAME)["Uploads"] == []
+
+
+def test_multipart_abort_stale():
+    store = _store()
+    stale = _create()
+    fresh = _create()
+    # backdate one upload past the stale age
+    store._uploads[stale["uploadId"]]["Initiated"] -= timedelta(days=2)
+    # a scheduled invocation carries no body
+    result = multipart_abort_handler({}, None)
+    print("ABORT STALE RESULT:", json.dumps(result, indent=2))
+    aborted = json.loads(result["body"])["aborted"]
+    assert [upload["uploadId"] for upload in aborted] == [stale["uploadId"]]
+    remaining = store.list_multipart_uploads(Bucket=r2configs.R2_BUCKET_NAME)["Uploads"]
+    assert [upload["UploadId"] for upload in remaining] == [fresh["uploadId"]]
+
+
+def test_multipart_create_errors():
+    _store()
+    for body in [{"fileName": "video.mp4"}, {"fileName": "video.mp4", "fileSize": 0},
+                 {"fileName": "video.mp4", "fileSize": "12"}]:
+        result = multipart_create_handler(_event(body), None)
+        print("CREATE ERROR:", result["statusCode"], result["body"])
+        assert result["statusCode"] == 400, result
+
+
+if __name__ == "__main__":
+    test_multipart_upload()
+    test_multipart_complete_errors()
+    test_multipart_abort()
+    test_multipart_abort_stale()
+    test_multipart_create_errors()
@@ -0,0 +1,63 @@
+""" test runner for the result cache tiers, against the directory backed s3 stand-in """
+
+import os
+import tempfile
+from local_s3 import DirectoryS3
+from result_cache import CACHE_PREFIX, ResultCache
+
+BUCKET = "results"
+
+
+def _cache(root: str, max_entries: int = 8, max_bytes: int = None) -> ResultCache:
+    # a new store over the same directory is what a cold container sees
+    store = DirectoryS3(root)
+    store.create_bucket(Bucket=BUCKET)
+    return ResultCache(max_entries, lambda: store, BUCKET, max_bytes=max_bytes)
+
+
+def test_bucket_tier():
+    with tempfile.TemporaryDirectory() as root:
+        cache = _cache(root)
+        assert cache.get("a" * 64) is None
+        print("MISS:", cache.stats())
+        assert cache.stats()["bucket"]["misses"] == 1
+
+        data = os.urandom(1000)
+        cache.set("a" * 64, data, {"width": 10, "height": 20}, "image/jpeg")
+        print("WRITE:", cache.stats())
+        assert cache.stats()["bucket"]["writes"] == 1
+        assert os.listdir(os.path.join(root, BUCKET))
+
+        cold = _cache(root)
+        entry = cold.get("a" * 64)
+        print("HIT:", cold.stats())
+        assert entry == (data, {"width": 10, "height": 20}), entry
+        assert cold.stats()["bucket"]["hits"] == 1
+        head = cold._get_client().head_object(Bucket=BUCKET, Key=CACHE_PREFIX + "a" * 64)
+        assert head["ContentType"] == "image/jpeg", head
+
+        # promoted into the memory tier, the bucket isn't read again
+        assert cold.get("a" * 64) == entry
+        assert cold.stats()["bucket"]["hits"] == 1 and cold.stats()["memory"]["hits"] == 1
+
+
+def test_memory_budget():
+    with tempfile.TemporaryDirectory() as root:
+        cache = _cache(root, max_bytes=2500)
+        for name in "abc":
+            cache.set(name * 64, os.urandom(1000), {})
+        memory = cache.stats()["memory"]
+        print("BUDGET:", memory)
+        assert memory["size"] == 2 and memory["bytes"] == 2000 and memory["evictions"] == 1, memory
+
+        # too large for memory, still stored in and served from the bucket
+        cache.set("d" * 64, os.urandom(5000), {})
+        assert cache.stats()["memory"]["bytes"] == 2000
+        assert cache.get("d" * 64) is not None and cache.stats()["bucket"]["hits"] == 1
+        # the evicted entry comes back from the bucket as well
+        assert cache.get("a" * 64) is not None and cache.stats()["bucket"]["hits"] == 2
+
+
+if __name__ == "__main__":
+    test_bucket_tier()
+    test_memory_budget()
@@ -1,49 +1,389 @@
 """ auto thumbnail generator lambda function """
 
 # import datetime
-import uuid
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
 from urllib.parse import unquote_plus
-from PIL import Image, UnidentifiedImageError
-from s3configs import s3, S3_BUCKET_NAME, S3_BUCKET_NAME_2
-
-# HEIC support
-try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-    HEIF_SUPPORTED = True
-except ImportError:
-    HEIF_SUPPORTED = False
+from PIL import Image, ImageOps, UnidentifiedImageError
+from botocore.exceptions import ClientError
+from s3configs import get_s3, S3_BUCKET_NAME, S3_BUCKET_NAME_2
+from image_decode import fit_within, open_for_size
+from metrics import count, instrumented, span
+from object_exists import MISSING_OBJECT_CODES
+from ranged_object import open_ranged
+from placeholder import placeholders
+from dedupe_index import INDEX_PREFIX as DEDUPE_INDEX_PREFIX
+from renditions import CLIP_RENDITION, RENDITIONS
+# HEIC support, pillow_heif is only loaded once a HEIF upload shows up
+from image_codecs import HEIF_SUPPORTED, ensure_codec
+# videos get a poster frame in every rendition, PyAV is only loaded once a video shows up
+from video_frames import VIDEO_SUPPORTED, extract_poster, is_video_key, render_preview_clip
 
 SUPPORTED_FORMATS = {"jpeg", "jpg", "png", "webp",
                      "gif", "heic" if HEIF_SUPPORTED else None}
 
+# objects up to this size are kept in memory, anything larger spills to ephemeral storage
+SPOOL_MAX_BYTES = int(os.environ.get(
+    "THUMBNAIL_SPOOL_MAX_BYTES", 32 * 1024 * 1024))
+# resized outputs above this size are uploaded as multipart instead of a single put_object
+MULTIPART_THRESHOLD = int(os.environ.get(
+    "THUMBNAIL_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 1024 * 1024
+# records are processed concurrently, network I/O overlaps with Pillow which releases the GIL
+MAX_WORKERS = int(os.environ.get("THUMBNAIL_MAX_WORKERS", 8))
+# optionally move decode/resize/encode into worker processes, needs /dev/shm so not on Lambda
+USE_PROCESS_POOL = os.environ.get(
+    "THUMBNAIL_USE_PROCESSES", "false").lower() == "true"
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_cpu_pool_lock = threading.Lock()
+# short silent preview clips of videos (CLIP_RENDITION), next to the poster renditions
+VIDEO_CLIPS = os.environ.get("VIDEO_PREVIEW_CLIPS", "false").lower() == "true"
+# videos are read with ranged requests and decoding stops after this long,
+# so a long video can't run into the Lambda timeout
+VIDEO_DECODE_TIMEOUT_SECONDS = float(os.environ.get(
+    "VIDEO_DECODE_TIMEOUT_SECONDS", 20))
+# derivatives record the source ETag and the settings they were made with, an event for a
+# source they are already up to date with is skipped after a single head_object
+SKIP_UP_TO_DATE = os.environ.get(
+    "THUMBNAIL_SKIP_UP_TO_DATE", "true").lower() == "true"
+# bump whenever the same settings start producing different outputs
+RENDITIONS_CODE_VERSION = "1"
+RENDITIONS_VERSION = hashlib.sha256(json.dumps(
+    [RENDITIONS_CODE_VERSION, RENDITIONS, VIDEO_CLIPS], sort_keys=True).encode()).hexdigest()[:16]
+SOURCE_ETAG_METADATA = "source-etag"
+RENDITIONS_VERSION_METADATA = "renditions-version"
 
-def resize_image(image_path, resized_path):
-    try:
-        with Image.open(image_path) as image:
-            image.thumbnail(tuple(x / 2 for x in image.size))
-            image.save(resized_path)
-    except UnidentifiedImageError:
-        print("Could not identify image file.")
-    except Exception as e:
-        print(f"Error resizing image: {str(e)}")
+
+def render_renditions(source, renditions: Optional[List[dict]] = None) -> Tuple[List[Tuple[dict, bytes]], dict]:
+    """ Decodes `source` (a path, file object or bytes) once and encodes every rendition.
+
+    The source is decoded at the smallest scale that still covers the largest rendition, and
+    each rendition is downscaled from the previous (larger) one rather than from the source.
+    """
+    renditions = sorted(renditions or RENDITIONS,
+                        key=lambda rendition: rendition["maxSize"], reverse=True)
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    ensure_codec(source)
+    largest = renditions[0]["maxSize"]
+    with open_for_size(source, (largest, largest)) as image:
+        return encode_renditions(ImageOps.exif_transpose(image), renditions)
+
+
+def encode_renditions(image: Image.Image, renditions: List[dict]) -> Tuple[List[Tuple[dict, bytes]], dict]:
+    """ Encodes every rendition of an upright image, each downscaled from the previous one.
+
+    Returns the `(rendition, bytes)` outputs and the placeholders computed from the smallest.
+    """
+    current = _normalize_mode(image)
+    outputs = []
+    for rendition in sorted(renditions, key=lambda rendition: rendition["maxSize"], reverse=True):
+        current = fit_within(
+            current, (rendition["maxSize"], rendition["maxSize"]))
+        outputs.append((rendition, _encode(current, rendition)))
+    with span("placeholder"):
+        return outputs, placeholders(current)
 
 
+def _normalize_mode(image: Image.Image) -> Image.Image:
+    # palette and exotic modes resample poorly (or not at all), work in RGB/RGBA
+    if image.mode in ("RGB", "RGBA", "L"):
+        return image
+    has_alpha = "A" in image.mode or "transparency" in image.info
+    return image.convert("RGBA" if has_alpha else "RGB")
+
+
+def _encode(image: Image.Image, rendition: dict) -> bytes:
+    save_format = rendition["format"].upper()
+    if save_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=save_format,
+               quality=int(rendition.get("quality", 80)))
+    return buffer.getvalue()
+
+
+@instrumented("thumbnail_gen")
 def lambda_handler(event, context):
+    """ Handles direct S3 notifications, SQS-wrapped S3 notifications and S3 Batch Operations.
+
+    Every record is processed independently. SQS and Batch Operations failures are reported
+    per record through the partial batch response of the invoking service. Asynchronous S3
+    invocations ignore the response, so a failed direct notification raises once all records
+    ran, which leaves the retries and the dead-letter queue to Lambda.
+    """
+    if "tasks" in event:
+        return _handle_batch_operations(event)
+
+    items = []  # (item identifier, object key, source ETag if the record has it)
+    from_sqs = False
     for record in event['Records']:
-        # decode the object key
-        original_obj_key = unquote_plus(record['s3']['object']['key'])
-        file_name = original_obj_key.split('/')[-1]
-        tmpkey = original_obj_key.replace('/', '')
-        # date_time = datetime.datetime.now(
-        #     datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
-        # ephemeral storage path of the lambda function to store the downloaded file
-        download_path = '/tmp/{}{}'.format(uuid.uuid4(), tmpkey)
-        # ephemeral storage path of the lambda function to store the resized file
-        upload_path = '/tmp/resized-{}'.format(tmpkey)
-        # get the original image from s3 bucket
-        s3.download_file(S3_BUCKET_NAME, original_obj_key, download_path)
-        resize_image(download_path, upload_path)
-        # upload the resized image to s3 bucket
-        s3.upload_file(upload_path, S3_BUCKET_NAME_2,
-                       'gen/thumbs/{}'.format(original_obj_key))
+        if record.get('eventSource') == 'aws:sqs':
+            from_sqs = True
+            for s3_record in json.loads(record['body']).get('Records', []):
+                items.append((record['messageId'], _record_key(s3_record),
+                              _record_etag(s3_record)))
+        else:
+            key = _record_key(record)
+            items.append((key, key, _record_etag(record)))
+
+    failures = []
+    for item_id, _key, error in _process_all(items):
+        if error is not None and item_id not in failures:
+            failures.append(item_id)
+    if failures and not from_sqs:
+        raise RuntimeError(f"thumbnail generation failed for {len(failures)} of {len(items)} "
+                           f"records: {', '.join(failures)}")
+    return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in failures]}
+
+
+def _handle_batch_operations(event) -> dict:
+    items = [(task['taskId'], unquote_plus(task['s3Key']), None)
+             for task in event['tasks']]
+    results = []
+    for task_id, _key, error in _process_all(items):
+        results.append({
+            "taskId": task_id,
+            "resultCode": "Succeeded" if error is None else "PermanentFailure",
+            "resultString": "" if error is None else error
+        })
+    return {
+        "invocationSchemaVersion": event.get("invocationSchemaVersion", "1.0"),
+        "treatMissingKeysAs": "PermanentFailure",
+        "invocationId": event.get("invocationId"),
+        "results": results
+    }
+
+
+def _record_key(record) -> str:
+    # decode the object key
+    return unquote_plus(record['s3']['object']['key'])
+
+
+def _record_etag(record) -> Optional[str]:
+    # present in S3 notifications for object creation, not in delete events or batch tasks
+    return record['s3']['object'].get('eTag')
+
+
+def _process_all(items: List[Tuple[str, str, Optional[str]]]) -> List[Tuple[str, str, Optional[str]]]:
+    """ Runs every `(item identifier, key, ETag)` through the pipeline, returning `(id, key, error)`.
+
+    Records for the same key are coalesced into one run whose outcome they all share.
+    """
+    count("records", len(items))
+    etags = {}
+    for _, key, etag in items:
+        etags.setdefault(key, set()).add(etag)
+    count("duplicatesCoalesced", len(items) - len(etags))
+    cpu_pool = _get_cpu_pool() if USE_PROCESS_POOL else None
+    with ThreadPoolExecutor(max_workers=max(1, MAX_WORKERS)) as io_pool:
+        # records that disagree on the ETag leave it to the pipeline to look up
+        futures = {key: io_pool.submit(_process_object, key, cpu_pool,
+                                       next(iter(key_etags)) if len(key_etags) == 1 else None)
+                   for key, key_etags in etags.items()}
+        errors = {}
+        for key, future in futures.items():
+            try:
+                count(future.result())
+                errors[key] = None
+            except Exception as e:
+                print(f"thumbnail {key}: failed: {str(e)}")
+                count("failures")
+                errors[key] = str(e)
+        return [(item_id, key, errors[key]) for item_id, key, _ in items]
+
+
+def _get_cpu_pool() -> ProcessPoolExecutor:
+    """ Worker processes started on first use and kept for the warm invocations that follow. """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor()
+        return _cpu_pool
+
+
+def _replace_cpu_pool(broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    """ A new pool in place of `broken`, once for all the records that found it broken. """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is broken or _cpu_pool is None:
+            broken.shutdown(wait=False)
+            _cpu_pool = ProcessPoolExecutor()
+        return _cpu_pool
+
+
+def _render_in_pool(cpu_pool: ProcessPoolExecutor, data: bytes):
+    try:
+        return cpu_pool.submit(render_renditions, data, RENDITIONS).result()
+    except BrokenProcessPool:
+        # a worker that died, e.g. out of memory, breaks the pool for good,
+        # this record is rendered again once in a fresh pool
+        count("cpuPoolRestarts")
+        return _replace_cpu_pool(cpu_pool).submit(render_renditions, data, RENDITIONS).result()
+
+
+def _process_object(original_obj_key: str, cpu_pool: Optional[ProcessPoolExecutor] = None,
+                    etag: Optional[str] = None) -> str:
+    """ Generates every derivative of one source, returns the outcome as a metric name. """
+    if original_obj_key.startswith(DEDUPE_INDEX_PREFIX):
+        # shards of the upload dedupe index, written to the same bucket as the uploads
+        return "skippedIndex"
+    video = is_video_key(original_obj_key)
+    if video and not VIDEO_SUPPORTED:
+        print(f"thumbnail {original_obj_key}: skipped, video support needs PyAV")
+        return "skippedUnsupported"
+    if SKIP_UP_TO_DATE:
+        with span("idempotencyCheck"):
+            etag = _normalize_etag(etag) or _source_etag(original_obj_key)
+            up_to_date = _is_up_to_date(original_obj_key, etag, video)
+        if up_to_date:
+            print(f"thumbnail {original_obj_key}: skipped, derivatives are up to date with {etag}")
+            return "skippedUpToDate"
+    if video:
+        _process_video(original_obj_key, etag)
+        return "generated"
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as source:
+        # stream the original image straight from the get_object body
+        started = time.perf_counter()
+        with span("download"):
+            response = get_s3().get_object(
+                Bucket=S3_BUCKET_NAME, Key=original_obj_key)
+            shutil.copyfileobj(response['Body'], source, STREAM_CHUNK_SIZE)
+        # what was actually rendered, even if the object was replaced since the event
+        etag = _normalize_etag(response.get('ETag')) or etag
+        bytes_in = source.tell()
+        count("bytesIn", bytes_in)
+        source.seek(0)
+        download_ms = _elapsed_ms(started)
+
+        started = time.perf_counter()
+        try:
+            with span("render"):
+                if cpu_pool is not None:
+                    outputs, metadata = _render_in_pool(cpu_pool, source.read())
+                else:
+                    outputs, metadata = render_renditions(source)
+        except UnidentifiedImageError:
+            raise ValueError(
+                f"could not identify image file '{original_obj_key}'")
+        resize_ms = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    _upload_outputs(original_obj_key, outputs, metadata, etag)
+    upload_ms = _elapsed_ms(started)
+
+    sizes = ", ".join(
+        f"{rendition['name']} {len(data)} B" for rendition, data in outputs)
+    print(f"thumbnail {original_obj_key}: download {bytes_in} B in {download_ms} ms, "
+          f"resize in {resize_ms} ms, upload [{sizes}] in {upload_ms} ms"
+          f"{' (spilled to disk)' if bytes_in > SPOOL_MAX_BYTES else ''}")
+    return "generated"
+
+
+def _process_video(original_obj_key: str, etag: Optional[str] = None):
+    """ Poster frame renditions, and optionally a preview clip, of a video.
+
+    The video is never downloaded as a whole, the decoders seek through ranged reads.
+    """
+    count("videos")
+    deadline = time.monotonic() + VIDEO_DECODE_TIMEOUT_SECONDS
+    started = time.perf_counter()
+    with open_ranged(get_s3(), S3_BUCKET_NAME, original_obj_key) as source:
+        with span("poster"):
+            poster = extract_poster(source, deadline=deadline)
+        with span("render"):
+            outputs, metadata = encode_renditions(poster, RENDITIONS)
+        if VIDEO_CLIPS:
+            source.seek(0)
+            with span("clip"):
+                outputs.append((CLIP_RENDITION, render_preview_clip(source, deadline=deadline)))
+        bytes_in = source.raw.bytes_read
+        requests = source.raw.requests
+        video_size = source.raw.size
+    count("bytesIn", bytes_in)
+    render_ms = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    _upload_outputs(original_obj_key, outputs, metadata, etag)
+    upload_ms = _elapsed_ms(started)
+
+    sizes = ", ".join(
+        f"{rendition['name']} {len(data)} B" for rendition, data in outputs)
+    print(f"thumbnail {original_obj_key}: read {bytes_in} of {video_size} B in {requests} requests, "
+          f"render in {render_ms} ms, upload [{sizes}] in {upload_ms} ms")
+
+
+def _upload_outputs(original_obj_key: str, outputs: List[Tuple[dict, bytes]], metadata: dict,
+                    etag: Optional[str] = None):
+    # upload every rendition to the derivatives bucket, each carrying the placeholders
+    # so whichever rendition the client heads or fetches first has them
+    metadata = {**metadata, RENDITIONS_VERSION_METADATA: RENDITIONS_VERSION}
+    if etag:
+        metadata[SOURCE_ETAG_METADATA] = etag
+    # outputs are uploaded in the order _marker_key() relies on, the marker last
+    with span("upload"):
+        for rendition, data in outputs:
+            content_type = rendition.get("contentType") or Image.MIME.get(
+                rendition["format"].upper(), "application/octet-stream")
+            _upload(rendition["prefix"] + original_obj_key, data, content_type, metadata)
+    count("bytesOut", sum(len(data) for _, data in outputs))
+
+
+def _upload(key: str, data: bytes, content_type: str, metadata: Optional[dict] = None):
+    s3 = get_s3()
+    if len(data) > MULTIPART_THRESHOLD:
+        s3.upload_fileobj(io.BytesIO(data), S3_BUCKET_NAME_2, key,
+                          ExtraArgs={"ContentType": content_type, "Metadata": metadata or {}})
+    else:
+        s3.put_object(Bucket=S3_BUCKET_NAME_2, Key=key,
+                      Body=data, ContentType=content_type, Metadata=metadata or {})
+
+
+def _marker_key(original_obj_key: str, video: bool) -> str:
+    # the derivative uploaded last, it only exists once all the others were written
+    if video and VIDEO_CLIPS:
+        return CLIP_RENDITION["prefix"] + original_obj_key
+    return sorted(RENDITIONS, key=lambda rendition: rendition["maxSize"], reverse=True)[-1]["prefix"] \
+        + original_obj_key
+
+
+def _is_up_to_date(original_obj_key: str, etag: Optional[str], video: bool) -> bool:
+    if not etag:
+        return False
+    try:
+        metadata = get_s3().head_object(
+            Bucket=S3_BUCKET_NAME_2, Key=_marker_key(original_obj_key, video)).get("Metadata", {})
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in MISSING_OBJECT_CODES:
+            print(f"thumbnail {original_obj_key}: idempotency check failed: {str(e)}")
+        return False
+    return metadata.get(SOURCE_ETAG_METADATA) == etag \
+        and metadata.get(RENDITIONS_VERSION_METADATA) == RENDITIONS_VERSION
+
+
+def _source_etag(original_obj_key: str) -> Optional[str]:
+    try:
+        return _normalize_etag(get_s3().head_object(
+            Bucket=S3_BUCKET_NAME, Key=original_obj_key).get("ETag"))
+    except ClientError as e:
+        # the download reports a missing source, the check just doesn't skip anything
+        print(f"thumbnail {original_obj_key}: could not read source ETag: {str(e)}")
+        return None
+
+
+def _normalize_etag(etag: Optional[str]) -> Optional[str]:
+    # notifications carry the bare ETag, head_object and get_object return it quoted
+    return etag.strip('"') if etag else None
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
@@ -0,0 +1,94 @@
+""" presigned upload urls for a batch of files, shared by the upload lambda functions
+
+A request names one `fileName` or a list of `fileNames` inside an optional `folder`. With
+`checkExisting` keys already in the bucket get no url and are described instead, with `dedupe`
+files whose MD5 `checksum` matches an object already uploaded get no url either and point at
+that object (see dedupe_index.py).
+"""
+import json
+from typing import Callable, List
+from presign import presign_urls
+from object_exists import head_objects
+import dedupe_index
+from metrics import count, record_error, span
+from responses import error_response, json_response
+
+URL_EXPIRES = 600
+
+
+def create_urls(s3, bucket: str, body: dict) -> List[dict]:
+    """ One `{"fileName", "key", "url"}` result per requested file, raises ValueError on invalid requests. """
+    folder = body.get("folder", "")
+    if "fileName" in body:  # Single file upload
+        filenames = [body["fileName"]]
+    elif "fileNames" in body:  # Multiple file uploads
+        filenames = body["fileNames"]
+    else:
+        raise ValueError("Missing 'fileName' or 'fileNames'")
+
+    keys = [f"{folder}/{filename}".strip("/") for filename in filenames]
+    # optionally skip files already in the bucket, checked here in one request
+    # instead of one round trip per file from the client
+    check_existing = body.get("checkExisting", False)
+    existing = [None] * len(keys)
+    if check_existing:
+        with span("head"):
+            existing = head_objects(s3, bucket, keys)
+        count("keysExisting", sum(obj is not None for obj in existing))
+    # optionally hand back the key of an object that already holds the same content,
+    # looked up by the MD5 the client computed, instead of a url to upload it again
+    dedupe = body.get("dedupe", False)
+    duplicates = [None] * len(keys)
+    if dedupe:
+        checksums = dedupe_index.parse_checksums(body)
+        if checksums is None:
+            raise ValueError("'dedupe' needs an MD5 'checksum' or 'checksums' for every file")
+        with span("dedupe"):
+            duplicates = dedupe_index.find_duplicates(
+                s3, bucket, [checksum if obj is None else None for checksum, obj in zip(checksums, existing)])
+        count("duplicates", sum(duplicate is not None for duplicate in duplicates))
+    missing_keys = [key for key, obj, duplicate in zip(keys, existing, duplicates)
+                    if obj is None and duplicate is None]
+    with span("presign"):
+        # signing key and canonical request parts are derived once for the whole batch
+        urls = dict(zip(missing_keys, presign_urls(s3, "put_object", bucket, missing_keys,
+                                                   expires_in=URL_EXPIRES, http_method="PUT")))
+    count("urls", len(urls))
+    if dedupe and urls:
+        with span("dedupeRecord"):
+            dedupe_index.record(s3, bucket, {
+                checksum: key for checksum, key in zip(checksums, keys) if key in urls})
+
+    results = []
+    for filename, key, obj, duplicate in zip(filenames, keys, existing, duplicates):
+        result = {
+            "fileName": filename,
+            "key": key,
+            "url": urls.get(key)
+        }
+        if check_existing:
+            result["exists"] = obj is not None
+            result.update(obj or {})
+        if dedupe:
+            # the requested key stays as it is, the existing object is described apart
+            result["duplicate"] = duplicate is not None
+            result["duplicateOf"] = duplicate
+        results.append(result)
+    return results
+
+
+def handle_request(event, get_client: Callable, bucket: str) -> dict:
+    """ Answers an API Gateway `event` asking for upload urls, a single result stays unwrapped. """
+    try:
+        authorizer = event.get('requestContext', {}).get('authorizer', {})
+        with span("parse"):
+            body = json.loads(event["body"])
+        results = create_urls(get_client(), bucket, body)
+        return json_response(200, {"results": (results if len(results) > 1 else results[0]),
+                                   "requestContext": {"authorizer": authorizer}}, event)
+    except ValueError as e:
+        record_error(e)
+        return error_response(400, str(e), event)
+    except Exception as e:
+        record_error(e)
+        return error_response(500, str(e), event)
@@ -1,11 +1,40 @@
-import firebase_admin
-from firebase_admin import credentials, auth
+import hashlib
+import os
+import threading
+import time
+from bounded_cache import BoundedCache
+from metrics import count, instrumented, record_error, span
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate("serviceAccountKey.json")
-firebase_admin.initialize_app(cred)
+# verified tokens are cached by hash until their `exp`, the app reuses one token for up to an hour
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get("VERIFY_TOKEN_CACHE_SIZE", 1024))
+# also ask Firebase whether the token was revoked, which costs a network round trip
+CHECK_REVOKED = os.environ.get(
+    "VERIFY_CHECK_REVOKED", "false").lower() == "true"
+# with revocation checks on, a cached token is trusted for at most this long before re-checking
+REVOCATION_RECHECK_SECONDS = int(
+    os.environ.get("VERIFY_REVOCATION_RECHECK_SECONDS", 300))
 
+_token_cache = BoundedCache(TOKEN_CACHE_MAX_ENTRIES)
 
+# Firebase Admin SDK is imported and initialized on the first verification,
+# then shared by every warm invocation of the container
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                import firebase_admin
+                from firebase_admin import credentials
+                cred = credentials.Certificate("serviceAccountKey.json")
+                _app = firebase_admin.initialize_app(cred)
+    return _app
+
+
+@instrumented("verify")
 def verify_handler(event, context):
     token = event.get("headers", {}).get("authorization", "")
     if token.startswith("Bearer "):
@@ -15,7 +44,8 @@ def verify_handler(event, context):
         return {"isAuthorized": False}
 
     try:
-        decoded_token = auth.verify_id_token(token)
+        with span("verifyToken"):
+            decoded_token = _verify_token(token)
         uid = decoded_token["uid"]
         email = decoded_token.get("email")
         return {
@@ -26,5 +56,31 @@ def verify_handler(event, context):
             }
         }
     except Exception as e:
+        record_error(e)
         print("Error verifying token:", e)
         return {"isAuthorized": False}
+
+
+def cache_stats() -> dict:
+    return _token_cache.stats()
+
+
+def _verify_token(token: str) -> dict:
+    cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    decoded_token = _token_cache.get(cache_key)
+    if decoded_token is None:
+        decoded_token = _verify_with_firebase(token)
+        expires_at = decoded_token["exp"]
+        if CHECK_REVOKED:
+            expires_at = min(expires_at, time.time() +
+                             REVOCATION_RECHECK_SECONDS)
+        _token_cache.set(cache_key, decoded_token, expires_at)
+    else:
+        count("tokenCacheHits")
+    return decoded_token
+
+
+def _verify_with_firebase(token: str) -> dict:
+    app = get_app()
+    from firebase_admin import auth
+    return auth.verify_id_token(token, app=app, check_revoked=CHECK_REVOKED)
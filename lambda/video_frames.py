@@ -0,0 +1,123 @@
+""" poster frames and preview clips of uploaded videos, decoded with PyAV when it is installed """
+import importlib.util
+import os
+import tempfile
+import time
+from fractions import Fraction
+from typing import Iterator, Optional, Tuple
+from PIL import Image
+
+# checked without importing, PyAV and its ffmpeg libraries come from the video layer
+# (requirements-video.txt) of thumbnail_gen and are only loaded for video uploads
+VIDEO_SUPPORTED = importlib.util.find_spec("av") is not None
+VIDEO_EXTENSIONS = {"mp4", "m4v", "mov", "3gp", "webm", "mkv", "avi"}
+# the poster is the keyframe at or before this point, clamped to the middle of short videos
+POSTER_SECONDS = float(os.environ.get("VIDEO_POSTER_SECONDS", 1.0))
+CLIP_SECONDS = float(os.environ.get("VIDEO_CLIP_SECONDS", 3.0))
+CLIP_MAX_SIZE = int(os.environ.get("VIDEO_CLIP_MAX_SIZE", 480))
+CLIP_BITRATE = int(os.environ.get("VIDEO_CLIP_BITRATE", 400_000))
+CLIP_FPS = 15
+
+
+def is_video_key(key: str) -> bool:
+    return key.rsplit(".", 1)[-1].lower() in VIDEO_EXTENSIONS if "." in key else False
+
+
+def extract_poster(source, seconds: float = POSTER_SECONDS, deadline: Optional[float] = None) -> Image.Image:
+    """ Upright poster frame of the video in `source` (a path or seekable file object).
+
+    Seeks to the keyframe at or before `seconds` and decodes only that keyframe, whatever
+    the length of the video. Raises TimeoutError once `time.monotonic()` passes `deadline`.
+    """
+    import av
+    with av.open(source) as container:
+        stream = container.streams.video[0]
+        # frames in between keyframes are demuxed but never decoded
+        stream.codec_context.skip_frame = "NONKEY"
+        duration = container.duration / av.time_base if container.duration else None
+        target = seconds if duration is None else min(seconds, duration / 2)
+        if target > 0 and stream.time_base:
+            start = stream.start_time or 0
+            container.seek(start + int(target / stream.time_base), stream=stream,
+                           backward=True, any_frame=False)
+        for packet in container.demux(stream):
+            _check_deadline(deadline)
+            for frame in packet.decode():
+                return _upright(frame.to_image(), frame.rotation)
+    raise ValueError("the video has no decodable frame")
+
+
+def render_preview_clip(source, max_size: int = CLIP_MAX_SIZE, seconds: float = CLIP_SECONDS,
+                        bit_rate: int = CLIP_BITRATE, deadline: Optional[float] = None) -> bytes:
+    """ Silent low bitrate H.264 mp4 of the first `seconds` of the video, at most `max_size` pixels.
+
+    Clips are cut short rather than failing when `deadline` passes while encoding.
+    """
+    import av
+    with av.open(source) as container, tempfile.TemporaryDirectory() as temp_dir:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        path = os.path.join(temp_dir, "clip.mp4")
+        # faststart puts the index first, players start before the whole clip arrived
+        with av.open(path, "w", format="mp4", options={"movflags": "+faststart"}) as output:
+            clip = None
+            for index, frame in enumerate(_sampled_frames(container, stream, seconds)):
+                if index and deadline is not None and time.monotonic() > deadline:
+                    break
+                sideways = frame.rotation in (90, -90, 270, -270)
+                if clip is None:
+                    upright_size = (frame.height, frame.width) if sideways else (frame.width, frame.height)
+                    clip = output.add_stream(_h264_encoder(), rate=CLIP_FPS)
+                    clip.width, clip.height = _clip_size(upright_size, max_size)
+                    clip.pix_fmt = "yuv420p"
+                    clip.bit_rate = bit_rate
+                # scaled down by swscale before anything else touches the pixels
+                width, height = (clip.height, clip.width) if sideways else (clip.width, clip.height)
+                image = _upright(frame.reformat(width=width, height=height, format="rgb24").to_image(),
+                                 frame.rotation)
+                out_frame = av.VideoFrame.from_image(image)
+                out_frame.pts = index
+                output.mux(clip.encode(out_frame))
+            if clip is None:
+                raise ValueError("the video has no decodable frame")
+            output.mux(clip.encode())
+        with open(path, "rb") as file:
+            return file.read()
+
+
+def _sampled_frames(container, stream, seconds: float) -> Iterator:
+    # decoded frames of the first `seconds`, at most CLIP_FPS of them per second
+    start = stream.start_time or 0
+    next_time = Fraction(0)
+    for packet in container.demux(stream):
+        for frame in packet.decode():
+            if frame.pts is None:
+                continue
+            frame_time = (frame.pts - start) * stream.time_base
+            if frame_time > seconds:
+                return
+            if frame_time >= next_time:
+                next_time = frame_time + Fraction(1, CLIP_FPS)
+                yield frame
+
+
+def _upright(image: Image.Image, rotation: int) -> Image.Image:
+    # phones record sideways and store the display rotation, counterclockwise degrees
+    return image.rotate(rotation, expand=True) if rotation else image
+
+
+def _clip_size(size: Tuple[int, int], max_size: int) -> Tuple[int, int]:
+    scale = min(1.0, max_size / max(size))
+    # yuv420p needs even dimensions
+    return (max(2, int(size[0] * scale) // 2 * 2), max(2, int(size[1] * scale) // 2 * 2))
+
+
+def _h264_encoder() -> str:
+    import av
+    # the PyAV wheels bundle libx264, a custom ffmpeg build may only have the native encoder
+    return "libx264" if "libx264" in av.codecs_available else "h264"
+
+
+def _check_deadline(deadline: Optional[float]):
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError("video decode exceeded its time limit")
@@ -86,6 +86,18 @@ class Utils {
     return "gen/thumbs/$objectKey";
   }
 
+  /// Utility function to retrieve the key of a server generated rendition of a given [objectKey].
+  ///
+  /// [rendition] is one of the rendition prefixes written by the thumbnail generator:
+  /// `thumbs` (256px), `preview` (1024px) or `full` (2048px). For videos these hold the
+  /// poster frame, and `clips` holds a short silent mp4 preview when clips are enabled.
+  ///
+  /// Returns a [String] of the rendition key.
+  static String getRenditionKeyFromObjectKey(String objectKey,
+      {String rendition = "thumbs"}) {
+    return "gen/$rendition/$objectKey";
+  }
+
   /// Returns a folder path used to create an object key
   static String getFolderPath(String userId) {
     return "uploads/${DateTimeUtils.getUtcTimestampString()}-$userId";